@@ -1,3 +1,8 @@
+__version__ = '0.1.8'
+
 import apu
+import cache
+import corpus
+import synth
 import convert
 import cycle
@@ -1,3 +1,6 @@
+import numpy as np
+
+
 # System master clock rates by console region
 ntsc_clock = (21477272. / 12.) # ~1789772.67
 pal_clock = 1662607.
@@ -143,28 +146,142 @@ register_function_bitmasks = {
 register_function_bitmasks['p2'] = register_function_bitmasks['p1']
 
 
+def _mask_shift(mask):
+  # Position of the lowest set bit
+  return max(0, (mask & -mask).bit_length() - 1)
+
+
+def _mask_nbits(mask):
+  return bin(mask).count('1')
+
+
+# Channels and their functions in register order (ids index the tables below)
+channels = ['p1', 'p2', 'tr', 'no', 'dm', 'ch', 'fc']
+channel_functions = [
+    [fu for _, bitmasks in sorted(register_function_bitmasks[ch].items()) for fu, _ in bitmasks]
+    for ch in channels]
+
+
+def _build_func_table():
+  # (ch, fu) -> (register offset, bitmask, shift, number of values)
+  func_table = {}
+  for ch in channels:
+    for offset, bitmasks in register_function_bitmasks[ch].items():
+      for fu, mask in bitmasks:
+        func_table[(ch, fu)] = (offset, mask, _mask_shift(mask), 2 ** _mask_nbits(mask))
+  return func_table
+
+
+def _build_register_decode_table():
+  # Register address -> (ch, offset, per-value tuple of (fu, function value))
+  register_decode_table = {}
+  for ch, base in register_memory_offsets.items():
+    for offset, bitmasks in register_function_bitmasks[ch].items():
+      decoded = []
+      for val in xrange(256):
+        decoded.append(tuple([(fu, (val & mask) >> _mask_shift(mask)) for fu, mask in bitmasks]))
+      register_decode_table[base + offset] = (ch, offset, decoded)
+  return register_decode_table
+
+
+func_table = _build_func_table()
+register_decode_table = _build_register_decode_table()
+
+
 def func_to_bitmask(ch, fu):
-  for offset, bitmasks in register_function_bitmasks[ch].items():
-    for fu_name, bitmask in bitmasks:
-      if fu_name == fu:
-        return bitmask
-  raise ValueError()
+  try:
+    return func_table[(ch, fu)][1]
+  except KeyError:
+    raise ValueError()
 
 
 def func_to_max(ch, fu):
-  bitmask = func_to_bitmask(ch, fu)
-  mask_bin = '{:08b}'.format(bitmask)
-  nbits = mask_bin.count('1')
-  return (2 ** nbits)
+  try:
+    return func_table[(ch, fu)][3]
+  except KeyError:
+    raise ValueError()
 
 
 def func_to_offset(ch, fu):
-  for offset, bitmasks in register_function_bitmasks[ch].items():
-    for fu_name, bitmask in bitmasks:
-      if fu_name == fu:
-        return offset
-  raise ValueError()
+  try:
+    return func_table[(ch, fu)][0]
+  except KeyError:
+    raise ValueError()
+
+
+def _build_arrays():
+  # Dense versions of the tables above indexed by channel and function ids
+  nch = len(channels)
+  nfu = max([len(fus) for fus in channel_functions])
+  nreg_fu = max([len(bitmasks) for ch in channels for bitmasks in register_function_bitmasks[ch].values()])
+
+  func_offset = np.zeros((nch, nfu), dtype=np.uint8)
+  func_mask = np.zeros((nch, nfu), dtype=np.uint32)
+  func_shift = np.zeros((nch, nfu), dtype=np.uint32)
+  func_nvals = np.zeros((nch, nfu), dtype=np.int64)
+  func_encode = np.zeros((nch, nfu, 256), dtype=np.uint8)
+  register_nfuncs = np.zeros((nch, 4), dtype=np.int64)
+  register_funcs = np.full((nch, 4, nreg_fu), -1, dtype=np.int8)
+  register_values = np.zeros((nch, 4, 256, nreg_fu), dtype=np.uint8)
+  addr_ch = np.full(256, -1, dtype=np.int8)
+  addr_offset = np.arange(256).astype(np.uint8)
+  ch_base = np.array([register_memory_offsets[ch] for ch in channels], dtype=np.uint32)
+
+  vals = np.arange(256)
+  for i, ch in enumerate(channels):
+    for offset, bitmasks in register_function_bitmasks[ch].items():
+      register_nfuncs[i, offset] = len(bitmasks)
+      addr_ch[ch_base[i] + offset] = i
+      addr_offset[ch_base[i] + offset] = offset
+      for k, (fu, mask) in enumerate(bitmasks):
+        j = channel_functions[i].index(fu)
+        shift = _mask_shift(mask)
+        func_offset[i, j] = offset
+        func_mask[i, j] = mask
+        func_shift[i, j] = shift
+        func_nvals[i, j] = 2 ** _mask_nbits(mask)
+        func_encode[i, j] = (vals << shift) & mask
+        register_funcs[i, offset, k] = j
+        register_values[i, offset, :, k] = (vals & mask) >> shift
+
+  return (func_offset, func_mask, func_shift, func_nvals, func_encode,
+      register_nfuncs, register_funcs, register_values, addr_ch, addr_offset, ch_base)
+
+
+# func_*_table[ch, fu]: register offset, bitmask, shift and number of values
+# func_encode_table[ch, fu, val]: register bits for a function value
+# register_nfuncs_table[ch, offset]: number of functions in a register
+# register_funcs_table[ch, offset, k]: k-th function of a register (-1 pads)
+# register_values_table[ch, offset, val, k]: value of k-th function for a write
+# addr_ch_table[addr], addr_offset_table[addr]: channel (-1 if unknown), offset
+# ch_base_table[ch]: address of a channel's first register
+(func_offset_table, func_mask_table, func_shift_table, func_nvals_table, func_encode_table,
+ register_nfuncs_table, register_funcs_table, register_values_table,
+ addr_ch_table, addr_offset_table, ch_base_table) = _build_arrays()
 
 
 # Number of frame counter ticks for various settings of the length counter
 length_counter_table = [10, 254, 20, 2, 40, 4, 80, 6, 160, 8, 60, 10, 14, 12, 26, 14, 12, 16, 24, 18, 48, 20, 96, 22, 192, 24, 72, 26, 16, 28, 32, 30]
+
+
+# Pulse waveform for each duty cycle setting (one period of the sequencer)
+pulse_duty_table = [
+    [0, 1, 0, 0, 0, 0, 0, 0],
+    [0, 1, 1, 0, 0, 0, 0, 0],
+    [0, 1, 1, 1, 1, 0, 0, 0],
+    [1, 0, 0, 1, 1, 1, 1, 1]
+]
+
+
+# Triangle waveform (one period of the sequencer)
+triangle_table = range(15, -1, -1) + range(16)
+
+
+# Number of CPU cycles between noise shift register clocks by console region
+noise_period_table_ntsc = [4, 8, 16, 32, 64, 96, 128, 160, 202, 254, 380, 508, 762, 1016, 2034, 4068]
+noise_period_table_pal = [4, 8, 14, 30, 60, 88, 118, 148, 188, 236, 354, 472, 708, 944, 1890, 3778]
+
+
+# Number of CPU cycles between DMC output clocks by console region
+dmc_rate_table_ntsc = [428, 380, 340, 320, 286, 254, 226, 214, 190, 160, 142, 128, 106, 84, 72, 54]
+dmc_rate_table_pal = [398, 354, 316, 298, 276, 236, 210, 198, 176, 148, 132, 118, 98, 78, 66, 50]
@@ -0,0 +1,236 @@
+import cPickle as pickle
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+
+# Content-addressed cache for conversion stages
+#
+# Caching is opt-in (configure() or --cache_dir in nesmdb_convert). Each stage
+# result is stored under a key derived from the package version, the stage name
+# and function, its parameters and the key of its input. Keys for a chain of
+# stages can therefore be computed before running anything, and a chain
+# resumes from its last cached stage without touching earlier ones.
+
+
+class StageCache(object):
+  def __init__(self, cache_dir, max_bytes=None):
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    self._nbytes = None
+
+  def input_key(self, x):
+    h = hashlib.sha1()
+    if isinstance(x, str):
+      h.update(x)
+    else:
+      _hash_value(h, x)
+    return _hash('input', h.hexdigest())
+
+  def stage_key(self, in_key, stage, params=None, fn=None):
+    import nesmdb
+    params = repr(sorted((params or {}).items()))
+    return _hash(nesmdb.__version__, stage, _qualname(fn), params, in_key)
+
+  def _fp(self, key):
+    return os.path.join(self.cache_dir, key[:2], key + '.pkl')
+
+  def has(self, key):
+    return os.path.isfile(self._fp(key))
+
+  def get(self, key):
+    fp = self._fp(key)
+    try:
+      with open(fp, 'rb') as f:
+        value = pickle.load(f)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+      raise KeyError(key)
+
+    # Mark as recently used
+    try:
+      os.utime(fp, None)
+    except OSError:
+      pass
+
+    return value
+
+  def put(self, key, value):
+    fp = self._fp(key)
+    fp_dir = os.path.dirname(fp)
+    if not os.path.isdir(fp_dir):
+      try:
+        os.makedirs(fp_dir)
+      except OSError:
+        if not os.path.isdir(fp_dir):
+          raise
+
+    # Write to a temporary file and rename so readers never see partial entries
+    fd, tmp_fp = tempfile.mkstemp(dir=fp_dir, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+      pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+    nbytes = os.path.getsize(tmp_fp)
+    os.rename(tmp_fp, fp)
+
+    if self.max_bytes is not None:
+      if self._nbytes is None:
+        self._nbytes = sum([e[2] for e in self._entries()])
+      else:
+        self._nbytes += nbytes
+      if self._nbytes > self.max_bytes:
+        self.evict()
+
+  def evict(self, max_bytes=None):
+    # Remove least recently used entries until under the size cap
+    if max_bytes is None:
+      max_bytes = self.max_bytes
+    entries = sorted(self._entries())
+    nbytes = sum([e[2] for e in entries])
+    for _, fp, size in entries:
+      if nbytes <= max_bytes:
+        break
+      try:
+        os.remove(fp)
+        nbytes -= size
+      except OSError:
+        pass
+    self._nbytes = nbytes
+
+  def clear(self):
+    self.evict(0)
+
+  def _entries(self):
+    entries = []
+    if not os.path.isdir(self.cache_dir):
+      return entries
+    for shard in os.listdir(self.cache_dir):
+      shard_dir = os.path.join(self.cache_dir, shard)
+      if not os.path.isdir(shard_dir):
+        continue
+      for fn in os.listdir(shard_dir):
+        if not fn.endswith('.pkl'):
+          continue
+        fp = os.path.join(shard_dir, fn)
+        try:
+          st = os.stat(fp)
+        except OSError:
+          continue
+        entries.append((st.st_mtime, fp, st.st_size))
+    return entries
+
+
+def _hash(*parts):
+  return hashlib.sha1('\0'.join(parts)).hexdigest()
+
+
+_PLAIN_TYPES = frozenset([str, unicode, int, long, float, bool, type(None)])
+
+
+def _is_plain(x):
+  for v in x:
+    t = type(v)
+    if t is tuple or t is list:
+      if not _is_plain(v):
+        return False
+    elif t not in _PLAIN_TYPES:
+      return False
+  return True
+
+
+def _hash_value(h, x):
+  # Feeds h an encoding of x that only depends on its value. Pickles also
+  # depend on object sharing (e.g. interned vs. distinct equal strings), so
+  # equal inputs could get different keys.
+  if isinstance(x, np.ndarray):
+    if x.dtype.hasobject:
+      h.update('O{!r}:'.format(x.shape))
+      for v in x.flat:
+        _hash_value(h, v)
+    else:
+      h.update('A{!r}{!r}:'.format(x.dtype.descr, x.shape))
+      h.update(np.ascontiguousarray(x).tobytes())
+  elif isinstance(x, (list, tuple)) and _is_plain(x):
+    # Reprs of (nested) lists and tuples of scalars are already canonical
+    h.update('R')
+    h.update(repr(x))
+  elif isinstance(x, (list, tuple)):
+    h.update('{}{}:'.format('L' if isinstance(x, list) else 'T', len(x)))
+    for v in x:
+      _hash_value(h, v)
+  elif isinstance(x, dict):
+    h.update('D{}:'.format(len(x)))
+    for k, v in sorted(x.items()):
+      _hash_value(h, k)
+      _hash_value(h, v)
+  elif isinstance(x, str):
+    h.update('S{}:'.format(len(x)))
+    h.update(x)
+  else:
+    # Numbers, None and other scalars
+    h.update('{}:{!r};'.format(type(x).__name__, x))
+
+
+def _qualname(fn):
+  if fn is None:
+    return ''
+  return '{}.{}'.format(getattr(fn, '__module__', None), getattr(fn, '__name__', type(fn).__name__))
+
+
+_CACHE = None
+_BYPASS = False
+
+
+def get_cache():
+  if _BYPASS:
+    return None
+  return _CACHE
+
+
+def configure(cache_dir, max_bytes=None):
+  global _CACHE
+  _CACHE = None if cache_dir is None else StageCache(cache_dir, max_bytes)
+  return _CACHE
+
+
+def set_bypass(bypass):
+  global _BYPASS
+  _BYPASS = bypass
+
+
+def run_stages(x, stages):
+  """Runs x through stages [(name, fn, params), ...] using the stage cache.
+
+  Returns the output of the last stage. Without a configured cache (or with
+  the bypass flag set) this is simply fn(x, **params) applied in order.
+  """
+  stages = [s if len(s) == 3 else (s[0], s[1], {}) for s in stages]
+
+  cache = get_cache()
+  if cache is None:
+    for _, fn, params in stages:
+      x = fn(x, **params)
+    return x
+
+  keys = []
+  key = cache.input_key(x)
+  for name, fn, params in stages:
+    key = cache.stage_key(key, name, params, fn)
+    keys.append(key)
+
+  # Resume from the last stage with a cached result
+  start = 0
+  for i in xrange(len(stages) - 1, -1, -1):
+    if cache.has(keys[i]):
+      try:
+        x = cache.get(keys[i])
+      except KeyError:
+        continue
+      start = i + 1
+      break
+
+  for (_, fn, params), key in zip(stages[start:], keys[start:]):
+    x = fn(x, **params)
+    cache.put(key, x)
+
+  return x
@@ -1,5 +1,9 @@
 import cPickle as pickle
+import hashlib
+import json
 import os
+import time
+import traceback
 
 import numpy as np
 from scipy.io.wavfile import write as wavwrite
@@ -7,6 +11,8 @@ from scipy.misc import imsave as imwrite
 
 import nesmdb.vgm
 import nesmdb.score
+import nesmdb.synth
+import nesmdb.cache
 
 
 def _verify_type(fp, expected):
@@ -39,22 +45,26 @@ def vgm_shorten(vgm, vgm_shorten_start, vgm_shorten_nmax):
 
 
 def vgm_to_ndr(vgm):
-  ndr = nesmdb.vgm.vgm_to_ndr(vgm)
+  ndr = nesmdb.cache.run_stages(vgm, [
+      ('vgm_to_ndr', nesmdb.vgm.vgm_to_ndr)])
   return ndr
 
 
 def ndr_to_txt(ndr):
-  txt = nesmdb.vgm.nd_to_txt(ndr)
+  txt = nesmdb.cache.run_stages(ndr, [
+      ('nd_to_txt', nesmdb.vgm.nd_to_txt)])
   return txt
 
 
 def txt_to_ndr(txt):
-  ndr = nesmdb.vgm.txt_to_nd(txt)
+  ndr = nesmdb.cache.run_stages(txt, [
+      ('txt_to_nd', nesmdb.vgm.txt_to_nd)])
   return ndr
 
 
 def ndr_to_vgm(ndr):
-  vgm = nesmdb.vgm.ndr_to_vgm(ndr)
+  vgm = nesmdb.cache.run_stages(ndr, [
+      ('ndr_to_vgm', nesmdb.vgm.ndr_to_vgm)])
   return vgm
 
 
@@ -62,24 +72,28 @@ def ndr_to_vgm(ndr):
 
 
 def vgm_to_ndf(vgm):
-  ndr = nesmdb.vgm.vgm_to_ndr(vgm)
-  ndf = nesmdb.vgm.ndr_to_ndf(ndr)
+  ndf = nesmdb.cache.run_stages(vgm, [
+      ('vgm_to_ndr', nesmdb.vgm.vgm_to_ndr),
+      ('ndr_to_ndf', nesmdb.vgm.ndr_to_ndf)])
   return ndf
 
 
 def ndf_to_txt(ndf):
-  txt = nesmdb.vgm.nd_to_txt(ndf)
+  txt = nesmdb.cache.run_stages(ndf, [
+      ('nd_to_txt', nesmdb.vgm.nd_to_txt)])
   return txt
 
 
 def txt_to_ndf(txt):
-  ndf = nesmdb.vgm.txt_to_nd(txt)
+  ndf = nesmdb.cache.run_stages(txt, [
+      ('txt_to_nd', nesmdb.vgm.txt_to_nd)])
   return ndf
 
 
 def ndf_to_vgm(ndf):
-  ndr = nesmdb.vgm.ndf_to_ndr(ndf)
-  vgm = nesmdb.vgm.ndr_to_vgm(ndr)
+  vgm = nesmdb.cache.run_stages(ndf, [
+      ('ndf_to_ndr', nesmdb.vgm.ndf_to_ndr),
+      ('ndr_to_vgm', nesmdb.vgm.ndr_to_vgm)])
   return vgm
 
 
@@ -87,121 +101,417 @@ def ndf_to_vgm(ndf):
 
 
 def vgm_to_nlm(vgm):
-  ndr = nesmdb.vgm.vgm_to_ndr(vgm)
-  ndf = nesmdb.vgm.ndr_to_ndf(ndr)
-  nlm = nesmdb.vgm.ndf_to_nlm(ndf)
+  nlm = nesmdb.cache.run_stages(vgm, [
+      ('vgm_to_ndr', nesmdb.vgm.vgm_to_ndr),
+      ('ndr_to_ndf', nesmdb.vgm.ndr_to_ndf),
+      ('ndf_to_nlm', nesmdb.vgm.ndf_to_nlm)])
   return nlm
 
 
 def nlm_to_vgm(nlm):
-  ndf = nesmdb.vgm.nlm_to_ndf(nlm)
-  ndr = nesmdb.vgm.ndf_to_ndr(ndf)
-  vgm = nesmdb.vgm.ndr_to_vgm(ndr)
+  vgm = nesmdb.cache.run_stages(nlm, [
+      ('nlm_to_ndf', nesmdb.vgm.nlm_to_ndf),
+      ('ndf_to_ndr', nesmdb.vgm.ndf_to_ndr),
+      ('ndr_to_vgm', nesmdb.vgm.ndr_to_vgm)])
   return vgm
 
 
 # NES-MDB score formats
 
 
+def _ndf_to_exprsco(ndf, rate):
+  if rate is not None and abs(rate - 44100.) < 1e-6:
+    rawsco = nesmdb.score.ndf_to_rawsco(ndf)
+    exprsco = nesmdb.score.rawsco_to_exprsco(rawsco)
+    exprsco = nesmdb.score.exprsco_downsample(exprsco, rate, False)
+  else:
+    # Downsample straight from the emulator's runs; never builds the 44.1 kHz score
+    rawsco_runs = nesmdb.score.ndf_to_rawsco_runs(ndf)
+    exprsco_runs = nesmdb.score.rawsco_runs_to_exprsco_runs(rawsco_runs)
+    exprsco = nesmdb.score.exprsco_runs_downsample(exprsco_runs, rate)
+  return exprsco
+
+
 def ndf_to_exprsco(ndf, ndf_to_exprsco_rate):
-  rawsco = nesmdb.score.ndf_to_rawsco(ndf)
-  exprsco = nesmdb.score.rawsco_to_exprsco(rawsco)
-  exprsco = nesmdb.score.exprsco_downsample(exprsco, ndf_to_exprsco_rate, False)
+  exprsco = nesmdb.cache.run_stages(ndf, [
+      ('ndf_to_exprsco', _ndf_to_exprsco, {'rate': ndf_to_exprsco_rate})])
   return exprsco
 
 
 def ndf_to_midi(ndf):
-  rawsco = nesmdb.score.ndf_to_rawsco(ndf)
-  exprsco = nesmdb.score.rawsco_to_exprsco(rawsco)
-  midi = nesmdb.score.exprsco_to_midi(exprsco)
+  midi = nesmdb.cache.run_stages(ndf, [
+      ('ndf_to_rawsco', nesmdb.score.ndf_to_rawsco),
+      ('rawsco_to_exprsco', nesmdb.score.rawsco_to_exprsco),
+      ('exprsco_to_midi', nesmdb.score.exprsco_to_midi)])
   return midi
 
 
 def exprsco_to_seprsco(exprsco):
-  seprsco = nesmdb.score.exprsco_to_seprsco(exprsco)
+  seprsco = nesmdb.cache.run_stages(exprsco, [
+      ('exprsco_to_seprsco', nesmdb.score.exprsco_to_seprsco)])
   return seprsco
 
 
 def exprsco_to_blndsco(exprsco):
-  blndsco = nesmdb.score.exprsco_to_blndsco(exprsco)
+  blndsco = nesmdb.cache.run_stages(exprsco, [
+      ('exprsco_to_blndsco', nesmdb.score.exprsco_to_blndsco)])
   return blndsco
 
 
 # WAV converters
 
 
-def vgm_to_wav(vgm):
-  wav = nesmdb.vgm.vgm_to_wav(vgm)
+def _ndf_to_wav_stages(renderer):
+  return [
+      ('ndf_to_ndr', nesmdb.vgm.ndf_to_ndr),
+      ('ndr_to_vgm', nesmdb.vgm.ndr_to_vgm),
+      ('vgm_to_wav', nesmdb.vgm.vgm_to_wav, {'renderer': renderer})]
+
+
+_EXPRSCO_TO_NDF = [
+    ('exprsco_to_rawsco', nesmdb.score.exprsco_to_rawsco),
+    ('rawsco_to_ndf', nesmdb.score.rawsco_to_ndf)
+]
+
+
+def vgm_to_wav(vgm, renderer='vgm2wav'):
+  wav = nesmdb.cache.run_stages(vgm, [
+      ('vgm_to_wav', nesmdb.vgm.vgm_to_wav, {'renderer': renderer})])
   return wav
 
 
-def ndr_to_wav(ndr):
-  vgm = nesmdb.vgm.ndr_to_vgm(ndr)
-  wav = nesmdb.vgm.vgm_to_wav(vgm)
+def ndr_to_wav(ndr, renderer='vgm2wav'):
+  wav = nesmdb.cache.run_stages(ndr, [
+      ('ndr_to_vgm', nesmdb.vgm.ndr_to_vgm),
+      ('vgm_to_wav', nesmdb.vgm.vgm_to_wav, {'renderer': renderer})])
   return wav
 
 
-def ndf_to_wav(ndf):
-  ndr = nesmdb.vgm.ndf_to_ndr(ndf)
-  vgm = nesmdb.vgm.ndr_to_vgm(ndr)
-  wav = nesmdb.vgm.vgm_to_wav(vgm)
+def ndf_to_wav(ndf, renderer='vgm2wav'):
+  wav = nesmdb.cache.run_stages(ndf, _ndf_to_wav_stages(renderer))
   return wav
 
 
-def nlm_to_wav(nlm):
-  ndf = nesmdb.vgm.nlm_to_ndf(nlm)
-  ndr = nesmdb.vgm.ndf_to_ndr(ndf)
-  vgm = nesmdb.vgm.ndr_to_vgm(ndr)
-  wav = nesmdb.vgm.vgm_to_wav(vgm)
+def nlm_to_wav(nlm, renderer='vgm2wav'):
+  wav = nesmdb.cache.run_stages(nlm, [
+      ('nlm_to_ndf', nesmdb.vgm.nlm_to_ndf)] + _ndf_to_wav_stages(renderer))
   return wav
 
 
-def midi_to_wav(midi, midi_to_wav_rate=None):
-  exprsco = nesmdb.score.midi_to_exprsco(midi)
+def midi_to_wav(midi, midi_to_wav_rate=None, renderer='vgm2wav'):
+  stages = [('midi_to_exprsco', nesmdb.score.midi_to_exprsco)]
   if midi_to_wav_rate is not None:
-    exprsco = nesmdb.score.exprsco_downsample(exprsco, midi_to_wav_rate, False)
-  rawsco = nesmdb.score.exprsco_to_rawsco(exprsco)
-  ndf = nesmdb.score.rawsco_to_ndf(rawsco)
-  ndr = nesmdb.vgm.ndf_to_ndr(ndf)
-  vgm = nesmdb.vgm.ndr_to_vgm(ndr)
-  wav = nesmdb.vgm.vgm_to_wav(vgm)
+    stages.append(('exprsco_downsample', nesmdb.score.exprsco_downsample, {'rate': midi_to_wav_rate, 'adaptive': False}))
+  stages += _EXPRSCO_TO_NDF + _ndf_to_wav_stages(renderer)
+  wav = nesmdb.cache.run_stages(midi, stages)
   return wav
 
 
-def exprsco_to_wav(exprsco):
-  rawsco = nesmdb.score.exprsco_to_rawsco(exprsco)
-  ndf = nesmdb.score.rawsco_to_ndf(rawsco)
-  ndr = nesmdb.vgm.ndf_to_ndr(ndf)
-  vgm = nesmdb.vgm.ndr_to_vgm(ndr)
-  wav = nesmdb.vgm.vgm_to_wav(vgm)
+def exprsco_to_wav(exprsco, renderer='vgm2wav'):
+  wav = nesmdb.cache.run_stages(exprsco, _EXPRSCO_TO_NDF + _ndf_to_wav_stages(renderer))
   return wav
 
 
-def seprsco_to_wav(seprsco):
-  exprsco = nesmdb.score.seprsco_to_exprsco(seprsco)
-  rawsco = nesmdb.score.exprsco_to_rawsco(exprsco)
-  ndf = nesmdb.score.rawsco_to_ndf(rawsco)
-  ndr = nesmdb.vgm.ndf_to_ndr(ndf)
-  vgm = nesmdb.vgm.ndr_to_vgm(ndr)
-  wav = nesmdb.vgm.vgm_to_wav(vgm)
+def seprsco_to_wav(seprsco, renderer='vgm2wav'):
+  wav = nesmdb.cache.run_stages(seprsco, [
+      ('seprsco_to_exprsco', nesmdb.score.seprsco_to_exprsco)] + _EXPRSCO_TO_NDF + _ndf_to_wav_stages(renderer))
   return wav
 
 
-def blndsco_to_wav(blndsco):
-  exprsco = nesmdb.score.blndsco_to_exprsco(blndsco)
-  rawsco = nesmdb.score.exprsco_to_rawsco(exprsco)
-  ndf = nesmdb.score.rawsco_to_ndf(rawsco)
-  ndr = nesmdb.vgm.ndf_to_ndr(ndf)
-  vgm = nesmdb.vgm.ndr_to_vgm(ndr)
-  wav = nesmdb.vgm.vgm_to_wav(vgm)
+def blndsco_to_wav(blndsco, renderer='vgm2wav'):
+  wav = nesmdb.cache.run_stages(blndsco, [
+      ('blndsco_to_exprsco', nesmdb.score.blndsco_to_exprsco)] + _EXPRSCO_TO_NDF + _ndf_to_wav_stages(renderer))
   return wav
 
 
-def main():
+# Conversion planner
+
+
+def _midi_to_exprsco(midi, rate):
+  exprsco = nesmdb.score.midi_to_exprsco(midi)
+  if rate is not None:
+    exprsco = nesmdb.score.exprsco_downsample(exprsco, rate, False)
+  return exprsco
+
+
+def _rawsco_to_exprsco(rawsco, rate):
+  exprsco = nesmdb.score.rawsco_to_exprsco(rawsco)
+  if rate is not None:
+    exprsco = nesmdb.score.exprsco_downsample(exprsco, rate, False)
+  return exprsco
+
+
+format_to_ext = {
+    'vgm': '.vgm',
+    'ndr': '.ndr.pkl',
+    'ndf': '.ndf.pkl',
+    'nlm': '.nlm.pkl',
+    'rawsco': '.rawsco.pkl',
+    'exprsco': '.exprsco.pkl',
+    'seprsco': '.seprsco.pkl',
+    'blndsco': '.blndsco.pkl',
+    'midi': '.mid',
+    'ndr_txt': '.ndr.txt',
+    'ndf_txt': '.ndf.txt',
+    'wav': '.wav',
+}
+
+
+# (source, target, stage name, function, whether it takes score_rate)
+_FORMAT_EDGES = [
+    ('vgm', 'ndr', 'vgm_to_ndr', nesmdb.vgm.vgm_to_ndr, False),
+    ('ndr', 'vgm', 'ndr_to_vgm', nesmdb.vgm.ndr_to_vgm, False),
+    ('ndr', 'ndf', 'ndr_to_ndf', nesmdb.vgm.ndr_to_ndf, False),
+    ('ndf', 'ndr', 'ndf_to_ndr', nesmdb.vgm.ndf_to_ndr, False),
+    ('ndf', 'nlm', 'ndf_to_nlm', nesmdb.vgm.ndf_to_nlm, False),
+    ('nlm', 'ndf', 'nlm_to_ndf', nesmdb.vgm.nlm_to_ndf, False),
+    ('ndr', 'ndr_txt', 'nd_to_txt', nesmdb.vgm.nd_to_txt, False),
+    ('ndf', 'ndf_txt', 'nd_to_txt', nesmdb.vgm.nd_to_txt, False),
+    ('ndr_txt', 'ndr', 'txt_to_nd', nesmdb.vgm.txt_to_nd, False),
+    ('ndf_txt', 'ndf', 'txt_to_nd', nesmdb.vgm.txt_to_nd, False),
+    ('ndf', 'exprsco', 'ndf_to_exprsco', _ndf_to_exprsco, True),
+    ('ndf', 'rawsco', 'ndf_to_rawsco', nesmdb.score.ndf_to_rawsco, False),
+    ('rawsco', 'ndf', 'rawsco_to_ndf', nesmdb.score.rawsco_to_ndf, False),
+    ('rawsco', 'exprsco', 'rawsco_to_exprsco', _rawsco_to_exprsco, True),
+    ('exprsco', 'rawsco', 'exprsco_to_rawsco', nesmdb.score.exprsco_to_rawsco, False),
+    ('exprsco', 'seprsco', 'exprsco_to_seprsco', nesmdb.score.exprsco_to_seprsco, False),
+    ('seprsco', 'exprsco', 'seprsco_to_exprsco', nesmdb.score.seprsco_to_exprsco, False),
+    ('exprsco', 'blndsco', 'exprsco_to_blndsco', nesmdb.score.exprsco_to_blndsco, False),
+    ('blndsco', 'exprsco', 'blndsco_to_exprsco', nesmdb.score.blndsco_to_exprsco, False),
+    ('exprsco', 'midi', 'exprsco_to_midi', nesmdb.score.exprsco_to_midi, False),
+    ('midi', 'exprsco', 'midi_to_exprsco', _midi_to_exprsco, True),
+    ('vgm', 'wav', 'vgm_to_wav', nesmdb.vgm.vgm_to_wav, False),
+]
+
+
+def _format_paths(src):
+  # Breadth-first search from src (edges are tried in the order listed);
+  # returns the edge reaching each reachable format
+  prev = {src: None}
+  queue = [src]
+  while len(queue) > 0:
+    fmt = queue.pop(0)
+    for edge in _FORMAT_EDGES:
+      if edge[0] == fmt and edge[1] not in prev:
+        prev[edge[1]] = edge
+        queue.append(edge[1])
+  return prev
+
+
+def plan_conversion(src, dst, score_rate=None):
+  """Returns the shortest list of stages converting format src to dst.
+
+  Stages are (name, fn, params) tuples as accepted by nesmdb.cache.run_stages.
+  score_rate is the rate of any expressive score created along the way. If
+  None, scores computed from NDF use an estimated rate (as ndf_to_exprsco
+  does) and scores read from MIDI or raw scores keep 44.1 kHz.
+  """
+  for fmt in [src, dst]:
+    if fmt not in format_to_ext:
+      raise ValueError('Unknown format \'{}\''.format(fmt))
+
+  prev = _format_paths(src)
+  if dst not in prev:
+    raise ValueError('No conversion from {} to {}'.format(src, dst))
+
+  stages = []
+  fmt = dst
+  while prev[fmt] is not None:
+    fmt_src, _, name, fn, rated = prev[fmt]
+    stages.insert(0, (name, fn, {'rate': score_rate} if rated else {}))
+    fmt = fmt_src
+
+  return stages
+
+
+def convert(x, src, dst, score_rate=None):
+  stages = plan_conversion(src, dst, score_rate=score_rate)
+  return nesmdb.cache.run_stages(x, stages)
+
+
+# Every <src>_to_<dst> conversion the format graph can plan
+_PLANNED = ['{}_to_{}'.format(src, dst) for src in format_to_ext for dst in _format_paths(src) if src != dst]
+
+
+# Fan-out export
+
+
+export_formats = ['ndr', 'ndf', 'nlm', 'ndr_txt', 'ndf_txt', 'rawsco', 'exprsco', 'seprsco', 'blndsco', 'midi', 'wav']
+
+
+def vgm_export(vgm, formats=None, score_rate=None, renderer='vgm2wav'):
+  """Converts one VGM to several formats, parsing and emulating it once.
+
+  Returns a list of (format, output) in the order of formats (by default the
+  NES-MDB dataset formats: ndr, ndf, nlm, exprsco, seprsco, blndsco, midi).
+  Outputs match the dedicated conversions (vgm_to_ndr, vgm_to_ndf, vgm_to_nlm,
+  ndr_to_txt, ndf_to_txt, ndf_to_exprsco with score_rate,
+  exprsco_to_seprsco/blndsco of that score, ndf_to_midi and vgm_to_wav with
+  renderer).
+  """
+  if formats is None:
+    formats = ['ndr', 'ndf', 'nlm', 'exprsco', 'seprsco', 'blndsco', 'midi']
+  for fmt in formats:
+    if fmt not in export_formats:
+      raise ValueError('Cannot export format \'{}\''.format(fmt))
+  formats = list(formats)
+  need = lambda fmts: any([fmt in formats for fmt in fmts])
+
+  fmt_to_out = {}
+  fmt_to_out['ndr'] = nesmdb.vgm.vgm_to_ndr(vgm)
+  fmt_to_out['ndf'] = nesmdb.vgm.ndr_to_ndf(fmt_to_out['ndr'])
+  if need(['nlm']):
+    fmt_to_out['nlm'] = nesmdb.vgm.ndf_to_nlm(fmt_to_out['ndf'])
+  if need(['ndr_txt']):
+    fmt_to_out['ndr_txt'] = nesmdb.vgm.nd_to_txt(fmt_to_out['ndr'])
+  if need(['ndf_txt']):
+    fmt_to_out['ndf_txt'] = nesmdb.vgm.nd_to_txt(fmt_to_out['ndf'])
+
+  if need(['rawsco', 'exprsco', 'seprsco', 'blndsco', 'midi']):
+    rawsco_runs = nesmdb.score.ndf_to_rawsco_runs(fmt_to_out['ndf'])
+    if need(['rawsco']):
+      fmt_to_out['rawsco'] = nesmdb.score.rawsco_runs_to_rawsco(rawsco_runs)
+  if need(['wav']):
+    if renderer == 'native':
+      fmt_to_out['wav'] = nesmdb.synth.ndr_to_wav(fmt_to_out['ndr'])
+    else:
+      fmt_to_out['wav'] = nesmdb.vgm.vgm_to_wav(vgm, renderer=renderer)
+
+  if need(['exprsco', 'seprsco', 'blndsco', 'midi']):
+    exprsco_runs = nesmdb.score.rawsco_runs_to_exprsco_runs(rawsco_runs)
+    if need(['midi']):
+      exprsco_full = nesmdb.score.exprsco_runs_to_exprsco(exprsco_runs)
+      fmt_to_out['midi'] = nesmdb.score.exprsco_to_midi(exprsco_full)
+    if need(['exprsco', 'seprsco', 'blndsco']):
+      if score_rate is not None and abs(score_rate - 44100.) < 1e-6:
+        exprsco = nesmdb.score.exprsco_runs_to_exprsco(exprsco_runs)
+        exprsco = nesmdb.score.exprsco_downsample(exprsco, score_rate, False)
+      else:
+        exprsco = nesmdb.score.exprsco_runs_downsample(exprsco_runs, score_rate)
+      fmt_to_out['exprsco'] = exprsco
+      if need(['seprsco']):
+        fmt_to_out['seprsco'] = nesmdb.score.exprsco_to_seprsco(exprsco)
+      if need(['blndsco']):
+        fmt_to_out['blndsco'] = nesmdb.score.exprsco_to_blndsco(exprsco)
+
+  return [(fmt, fmt_to_out[fmt]) for fmt in formats]
+
+
+def _convert_file(job):
+  conversion, in_fp, out_fp, in_type, out_type, kwargs = job
+  start = time.time()
+
+  try:
+    # Load input file
+    in_ext = in_type.split('.')[-1]
+    if in_ext == 'pkl':
+      with open(in_fp, 'rb') as f:
+        in_file = pickle.load(f)
+    elif in_ext in ['mid', 'vgm']:
+      with open(in_fp, 'rb') as f:
+        in_file = f.read()
+    elif in_ext == 'txt':
+      with open(in_fp, 'r') as f:
+        in_file = f.read()
+    else:
+      raise NotImplementedError('Input extension .{} not recognized'.format(in_ext))
+
+    if conversion in globals():
+      out_file = globals()[conversion](in_file, **kwargs)
+    else:
+      src, dst = conversion.split('_to_')
+      out_file = convert(in_file, src, dst, **kwargs)
+
+    if conversion == 'vgm_export':
+      outputs = [(out_fp + format_to_ext[fmt], format_to_ext[fmt], out) for fmt, out in out_file]
+    else:
+      outputs = [(out_fp, out_type, out_file)]
+    for out_fp, out_type, out_file in outputs:
+      _save_file(out_fp, out_type, out_file)
+  except:
+    # Tracebacks don't survive pickling, so format it in the worker
+    return in_fp, traceback.format_exc(), time.time() - start
+
+  return in_fp, None, time.time() - start
+
+
+def _save_file(out_fp, out_type, out_file):
+  # Save output file (renamed into place so interrupted runs leave no partial outputs)
+  out_ext = out_type.split('.')[-1]
+  part_fp = out_fp + '.part'
+  try:
+    if out_ext == 'pkl':
+      with open(part_fp, 'wb') as f:
+        pickle.dump(out_file, f)
+    elif out_ext in ['mid', 'vgm']:
+      with open(part_fp, 'wb') as f:
+        f.write(out_file)
+    elif out_ext == 'txt':
+      with open(part_fp, 'w') as f:
+        f.write(out_file)
+    elif out_ext == 'wav':
+      wav = out_file
+      wav *= 32767.
+      wav = np.clip(wav, -32767., 32767.)
+      wav = wav.astype(np.int16)
+      with open(part_fp, 'wb') as f:
+        wavwrite(f, 44100, wav)
+    else:
+      raise NotImplementedError('Output extension .{} not recognized'.format(out_ext))
+    os.rename(part_fp, out_fp)
+  finally:
+    if os.path.exists(part_fp):
+      os.remove(part_fp)
+
+
+# Incremental conversion manifest (one JSON record per line, appended as files finish)
+
+
+def _file_hash(fp):
+  with open(fp, 'rb') as f:
+    return hashlib.sha1(f.read()).hexdigest()
+
+
+def _load_manifest(manifest_fp):
+  # Latest record for each output file
+  out_fp_to_record = {}
+  if os.path.isfile(manifest_fp):
+    with open(manifest_fp, 'r') as f:
+      for line in f:
+        try:
+          record = json.loads(line)
+        except ValueError:
+          # Truncated final line from an interrupted run
+          continue
+        out_fp_to_record[record['out_fp']] = record
+  return out_fp_to_record
+
+
+def _manifest_up_to_date(record, in_hash, signature):
+  if not (record is not None
+      and record['status'] == 'ok'
+      and record['in_hash'] == in_hash
+      and record['signature'] == signature):
+    return False
+
+  # Outputs must still exist and be unchanged since they were written
+  out_fps = record.get('out_fps', [record['out_fp']])
+  out_hashes = record.get('out_hashes', [None] * len(out_fps))
+  return all([os.path.isfile(fp) and _file_hash(fp) == h for fp, h in zip(out_fps, out_hashes)])
+
+
+def _manifest_append(f, record):
+  f.write(json.dumps(record, sort_keys=True) + '\n')
+  f.flush()
+  os.fsync(f.fileno())
+
+
+def main(argv=None):
   import argparse
+  import itertools
+  import multiprocessing
   import os
   import sys
-  import traceback
 
   from tqdm import tqdm
 
@@ -212,6 +522,9 @@ def main():
       'vgm_simplify': ('.vgm', '.simp.vgm'),
       'vgm_shorten': ('.vgm', '.short.vgm'),
 
+      # Fan-out export (writes one file per --export_formats entry)
+      'vgm_export': ('.vgm', ''),
+
       # NES disassembly raw
       'vgm_to_ndr': ('.vgm', '.ndr.pkl'),
       'ndr_to_txt': ('.ndr.pkl', '.ndr.txt'),
@@ -252,7 +565,9 @@ def main():
       'midi_to_wav': ['midi_to_wav_rate'],
   }
 
-  parser.add_argument('conversion', type=str, choices=conversion_to_types.keys())
+  # Conversions without a dedicated function are planned through the format graph
+  conversion_choices = set(conversion_to_types.keys()) | set(_PLANNED)
+  parser.add_argument('conversion', type=str, choices=sorted(conversion_choices))
   parser.add_argument('fps', type=str, nargs='+')
   parser.add_argument('--out_dir', type=str)
   parser.add_argument('--skip_verify', action='store_true', dest='skip_verify')
@@ -264,6 +579,15 @@ def main():
   parser.add_argument('--vgm_simplify_nono', action='store_true', dest='vgm_simplify_nono')
   parser.add_argument('--ndf_to_exprsco_rate', type=float)
   parser.add_argument('--midi_to_wav_rate', type=float)
+  parser.add_argument('--export_formats', type=str)
+  parser.add_argument('--jobs', type=int)
+  parser.add_argument('--chunksize', type=int)
+  parser.add_argument('--unordered', action='store_true', dest='unordered')
+  parser.add_argument('--cache_dir', type=str)
+  parser.add_argument('--cache_max_mb', type=float)
+  parser.add_argument('--no_cache', action='store_true', dest='no_cache')
+  parser.add_argument('--incremental', action='store_true', dest='incremental')
+  parser.add_argument('--manifest', type=str)
 
   parser.set_defaults(
       conversion=None,
@@ -277,11 +601,24 @@ def main():
       vgm_simplify_notr=False,
       vgm_simplify_nono=False,
       ndf_to_exprsco_rate=None,
-      midi_to_wav_rate=None)
-
-  args = parser.parse_args()
-
-  in_type, out_type = conversion_to_types[args.conversion]
+      midi_to_wav_rate=None,
+      export_formats=','.join(['ndr', 'ndf', 'nlm', 'exprsco', 'seprsco', 'blndsco', 'midi']),
+      jobs=1,
+      chunksize=None,
+      unordered=False,
+      cache_dir=None,
+      cache_max_mb=None,
+      no_cache=False,
+      incremental=False,
+      manifest=None)
+
+  args = parser.parse_args(argv)
+
+  if args.conversion in conversion_to_types:
+    in_type, out_type = conversion_to_types[args.conversion]
+  else:
+    src, dst = args.conversion.split('_to_')
+    in_type, out_type = format_to_ext[src], format_to_ext[dst]
   fps = args.fps
 
   if len(fps) > 1 and args.out_dir is None:
@@ -294,60 +631,113 @@ def main():
     out_fps = [os.path.join(args.out_dir, fn) for fn in out_fns]
 
     if os.path.exists(args.out_dir):
-      print 'WARNING: Output directory {} already exists'.format(args.out_dir)
+      if not args.incremental:
+        print 'WARNING: Output directory {} already exists'.format(args.out_dir)
     else:
       os.makedirs(args.out_dir)
 
-  for in_fp, out_fp in tqdm(zip(fps, out_fps)):
-    if not args.skip_verify:
+  if args.no_cache:
+    nesmdb.cache.set_bypass(True)
+  elif args.cache_dir is not None:
+    max_bytes = None if args.cache_max_mb is None else int(args.cache_max_mb * 1024 * 1024)
+    nesmdb.cache.configure(args.cache_dir, max_bytes)
+
+  kwargs = {}
+  if args.conversion in conversion_to_kwargs:
+    kwargs = {kw:getattr(args, kw) for kw in conversion_to_kwargs[args.conversion]}
+  elif args.conversion == 'vgm_export':
+    kwargs = {'formats': args.export_formats.split(','), 'score_rate': args.ndf_to_exprsco_rate}
+  elif args.conversion not in conversion_to_types:
+    kwargs = {'score_rate': args.ndf_to_exprsco_rate}
+
+  if not args.skip_verify:
+    for in_fp, out_fp in zip(fps, out_fps):
       _verify_type(in_fp, in_type)
-      _verify_type(out_fp, out_type)
-
-    # Load input file
-    in_ext = in_type.split('.')[-1]
-    if in_ext == 'pkl':
-      with open(in_fp, 'rb') as f:
-        in_file = pickle.load(f)
-    elif in_ext in ['mid', 'vgm']:
-      with open(in_fp, 'rb') as f:
-        in_file = f.read()
-    elif in_ext == 'txt':
-      with open(in_fp, 'r') as f:
-        in_file = f.read()
+      if len(out_type) > 0:
+        _verify_type(out_fp, out_type)
+
+  jobs = [(args.conversion, in_fp, out_fp, in_type, out_type, kwargs) for in_fp, out_fp in zip(fps, out_fps)]
+
+  # Skip outputs recorded as up to date in the manifest
+  manifest_f = None
+  if args.incremental or args.manifest is not None:
+    manifest_fp = args.manifest
+    if manifest_fp is None:
+      manifest_fp = os.path.join(os.path.dirname(out_fps[0]), 'nesmdb_manifest.jsonl')
+    out_fp_to_record = _load_manifest(manifest_fp)
+    signature = json.dumps([args.conversion, sorted(kwargs.items()), nesmdb.__version__])
+
+    in_fp_to_hash = {}
+    todo = []
+    for job in jobs:
+      in_fp, out_fp = job[1:3]
+      try:
+        in_hash = _file_hash(in_fp)
+      except (IOError, OSError):
+        # Converting it fails too, which records the failure
+        in_hash = None
+      in_fp_to_hash[in_fp] = in_hash
+      if not (args.incremental and _manifest_up_to_date(out_fp_to_record.get(out_fp), in_hash, signature)):
+        todo.append(job)
+    if len(todo) < len(jobs):
+      print 'Skipping {} of {} files that are up to date'.format(len(jobs) - len(todo), len(jobs))
+    in_fp_to_out_fp = {job[1]:job[2] for job in jobs}
+    jobs = todo
+    manifest_f = open(manifest_fp, 'a')
+
+  pool = None
+  failed = []
+  try:
+    if args.jobs > 1:
+      chunksize = args.chunksize
+      if chunksize is None:
+        chunksize = max(1, len(jobs) // (args.jobs * 8))
+      pool = multiprocessing.Pool(args.jobs)
+      imap = pool.imap_unordered if args.unordered else pool.imap
+      results = imap(_convert_file, jobs, chunksize=chunksize)
     else:
-      raise NotImplementedError('Input extension .{} not recognized'.format(in_ext))
-
-    kwargs = {}
-    if args.conversion in conversion_to_kwargs:
-      kwargs = {kw:getattr(args, kw) for kw in conversion_to_kwargs[args.conversion]}
-
-    try:
-      out_file = globals()[args.conversion](in_file, **kwargs)
-    except:
-      print '-' * 80
+      results = itertools.imap(_convert_file, jobs)
+
+    for in_fp, error, elapsed in tqdm(results, total=len(jobs)):
+      if error is not None:
+        print '-' * 80
+        print in_fp
+        sys.stderr.write(error)
+        failed.append(in_fp)
+
+      if manifest_f is not None:
+        record = {
+          'in_fp': in_fp,
+          'in_hash': in_fp_to_hash[in_fp],
+          'out_fp': in_fp_to_out_fp[in_fp],
+          'signature': signature,
+          'status': 'ok' if error is None else 'failed',
+          'time': elapsed,
+        }
+        out_fps = [record['out_fp']]
+        if args.conversion == 'vgm_export':
+          out_fps = [record['out_fp'] + format_to_ext[fmt] for fmt in kwargs['formats']]
+          record['out_fps'] = out_fps
+        if error is None:
+          record['out_hashes'] = [_file_hash(fp) for fp in out_fps]
+        _manifest_append(manifest_f, record)
+  except:
+    # Stop workers right away on errors and KeyboardInterrupt
+    if pool is not None:
+      pool.terminate()
+    raise
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+    if manifest_f is not None:
+      manifest_f.close()
+
+  if len(failed) > 0:
+    print '-' * 80
+    print 'Failed to convert {} of {} files:'.format(len(failed), len(jobs))
+    for in_fp in failed:
       print in_fp
-      traceback.print_exc()
-      continue
-
-    # Save output file
-    out_ext = out_type.split('.')[-1]
-    if out_ext == 'pkl':
-      with open(out_fp, 'wb') as f:
-        pickle.dump(out_file, f)
-    elif out_ext in ['mid', 'vgm']:
-      with open(out_fp, 'wb') as f:
-        f.write(out_file)
-    elif out_ext == 'txt':
-      with open(out_fp, 'w') as f:
-        f.write(out_file)
-    elif out_ext == 'wav':
-      wav = out_file
-      wav *= 32767.
-      wav = np.clip(wav, -32767., 32767.)
-      wav = wav.astype(np.int16)
-      wavwrite(out_fp, 44100, wav)
-    else:
-      raise NotImplementedError('Output extension .{} not recognized'.format(out_ext))
 
 
 if __name__ == '__main__':
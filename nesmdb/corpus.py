@@ -0,0 +1,115 @@
+import json
+import os
+
+import numpy as np
+
+
+# Packed corpus
+#
+# Items (e.g. the frames of a song or the tokens of a document) are
+# concatenated along their first axis into a few flat shard files. index.json
+# stores the item dtype and shape, the shard filenames, corpus metadata and,
+# for each item, its id, shard, offset, length and any extra fields. Reading
+# memory-maps the shards on first use, so loading is independent of corpus
+# size and items are returned as views into the mapped files.
+
+_INDEX_FN = 'index.json'
+
+
+def write_corpus(corpus_dir, items, dtype, item_shape=(), meta=None, shard_fn='{:05d}.bin', shard_nbytes=None):
+  """Writes (item_id, array, extra...) tuples to a packed corpus in corpus_dir.
+
+  items may be any iterable (e.g. a generator loading one item at a time).
+  Extra fields must be JSON serializable. shard_fn is formatted with the shard
+  number; a new shard starts once shard_nbytes is exceeded.
+  """
+  dtype = np.dtype(dtype)
+  item_shape = tuple(item_shape)
+  row_nbytes = dtype.itemsize * int(np.prod(item_shape))
+
+  if not os.path.isdir(corpus_dir):
+    os.makedirs(corpus_dir)
+
+  shard_fns = [shard_fn.format(0)]
+  index = []
+  f = open(os.path.join(corpus_dir, shard_fns[-1]), 'wb')
+  shard_offset = 0
+  try:
+    for item in items:
+      item_id, x, extra = item[0], item[1], list(item[2:])
+      x = np.ascontiguousarray(x, dtype=dtype)
+      if x.shape[1:] != item_shape:
+        raise ValueError('Expected items of shape {}; got {}'.format(item_shape, x.shape[1:]))
+
+      if shard_nbytes is not None and shard_offset > 0 and (shard_offset + x.shape[0]) * row_nbytes > shard_nbytes:
+        f.close()
+        shard_fns.append(shard_fn.format(len(shard_fns)))
+        f = open(os.path.join(corpus_dir, shard_fns[-1]), 'wb')
+        shard_offset = 0
+
+      f.write(x.tobytes())
+      index.append([str(item_id), len(shard_fns) - 1, shard_offset, x.shape[0]] + extra)
+      shard_offset += x.shape[0]
+  finally:
+    f.close()
+
+  with open(os.path.join(corpus_dir, _INDEX_FN), 'w') as f:
+    json.dump({
+      'meta': meta or {},
+      'dtype': dtype.str,
+      'item_shape': list(item_shape),
+      'shards': shard_fns,
+      'items': index,
+    }, f)
+
+
+class Corpus(object):
+  """Read-only view of a corpus written by write_corpus.
+
+  corpus[i] or corpus[item_id] returns the item as a view into its
+  memory-mapped shard. Subclasses override _item to attach extra fields.
+  """
+
+  def __init__(self, corpus_dir):
+    with open(os.path.join(corpus_dir, _INDEX_FN), 'r') as f:
+      index = json.load(f)
+
+    self.corpus_dir = corpus_dir
+    self.meta = index['meta']
+    self.dtype = np.dtype(str(index['dtype']))
+    self.item_shape = tuple(index['item_shape'])
+    self._shard_fns = index['shards']
+    self._shards = [None] * len(self._shard_fns)
+    self._items = index['items']
+    self.item_ids = [item[0] for item in self._items]
+    self._item_id_to_idx = {item_id:i for i, item_id in enumerate(self.item_ids)}
+
+  def __len__(self):
+    return len(self._items)
+
+  def __iter__(self):
+    for i in xrange(len(self)):
+      yield self[i]
+
+  def __getitem__(self, key):
+    if isinstance(key, basestring):
+      key = self._item_id_to_idx[key]
+    item = self._items[key]
+    _, shard, offset, n = item[:4]
+
+    return self._item(self._shard(shard)[offset:offset + n], item[4:])
+
+  def _item(self, x, extra):
+    return x
+
+  def _shard(self, shard):
+    # Map shards on first use
+    if self._shards[shard] is None:
+      fp = os.path.join(self.corpus_dir, self._shard_fns[shard])
+      if os.path.getsize(fp) == 0:
+        x = np.zeros((0,) + self.item_shape, dtype=self.dtype)
+      else:
+        x = np.memmap(fp, dtype=self.dtype, mode='r')
+        x = x.reshape((-1,) + self.item_shape)
+      self._shards[shard] = x
+    return self._shards[shard]
@@ -106,12 +106,15 @@ def vgm_cycle(source_vgm, representation='ndf', keep_wav=False, **kwargs):
   return cycle_vgm
 
 
-def vgm_dist(a_vgm, b_vgm):
+def vgm_dist(a_vgm, b_vgm, render_pool=None):
   import librosa
 
   # Convert to wav
-  a_wav = nesmdb.vgm.vgm_to_wav(a_vgm)
-  b_wav = nesmdb.vgm.vgm_to_wav(b_vgm)
+  if render_pool is None:
+    a_wav = nesmdb.vgm.vgm_to_wav(a_vgm)
+    b_wav = nesmdb.vgm.vgm_to_wav(b_vgm)
+  else:
+    a_wav, b_wav = render_pool.render([a_vgm, b_vgm])
   assert a_wav.shape == b_wav.shape
 
   # Compute distance in log-Mel spectrogram space
@@ -140,6 +143,7 @@ if __name__ == '__main__':
   parser.add_argument('--keep_wav', action='store_true', dest='keep_wav')
   parser.add_argument('--score_rate', type=float)
   parser.add_argument('--quiet', action='store_true', dest='quiet')
+  parser.add_argument('--render_workers', type=int)
 
   parser.set_defaults(
       fps=None,
@@ -147,7 +151,8 @@ if __name__ == '__main__':
       keep_vgm=False,
       keep_wav=False,
       score_rate=None,
-      quiet=False)
+      quiet=False,
+      render_workers=1)
 
   args = parser.parse_args()
 
@@ -159,33 +164,43 @@ if __name__ == '__main__':
 
   progress_fps = args.fps if args.quiet else tqdm(args.fps)
 
+  # Render serially (one vgm2wav call at a time) unless several workers are
+  # requested
+  render_pool = None
+  if args.render_workers > 1:
+    render_pool = nesmdb.vgm.VGMRenderPool(args.render_workers)
+
   vgm_fp_to_dist = {}
-  for vgm_fp in progress_fps:
-    with open(vgm_fp, 'rb') as f:
-      vgm = f.read()
-
-    source_vgm, delcmds = nesmdb.vgm.vgm_simplify(vgm)
-
-    try:
-      cycle_vgm = vgm_cycle(source_vgm, representation=args.representation, **kwargs)
-    except:
-      print '-' * 80
-      print vgm_fp
-      print traceback.print_exc()
-      continue
-
-    dist, source_wav, cycle_wav = vgm_dist(source_vgm, cycle_vgm)
-    vgm_fp_to_dist[vgm_fp] = dist
+  try:
+    for vgm_fp in progress_fps:
+      with open(vgm_fp, 'rb') as f:
+        vgm = f.read()
+
+      source_vgm, delcmds = nesmdb.vgm.vgm_simplify(vgm)
+
+      try:
+        cycle_vgm = vgm_cycle(source_vgm, representation=args.representation, **kwargs)
+      except:
+        print '-' * 80
+        print vgm_fp
+        print traceback.print_exc()
+        continue
+
+      dist, source_wav, cycle_wav = vgm_dist(source_vgm, cycle_vgm, render_pool=render_pool)
+      vgm_fp_to_dist[vgm_fp] = dist
     
-    if args.keep_vgm:
-      with open(vgm_fp.replace('.vgm', '.source.vgm'), 'wb') as f:
-        f.write(source_vgm)
-      with open(vgm_fp.replace('.vgm', '.cycle.vgm'), 'wb') as f:
-        f.write(cycle_vgm)
-
-    if args.keep_wav:
-      nesmdb.vgm.save_vgmwav(vgm_fp.replace('.vgm', '.source.wav'), source_wav)
-      nesmdb.vgm.save_vgmwav(vgm_fp.replace('.vgm', '.cycle.wav'), cycle_wav)
+      if args.keep_vgm:
+        with open(vgm_fp.replace('.vgm', '.source.vgm'), 'wb') as f:
+          f.write(source_vgm)
+        with open(vgm_fp.replace('.vgm', '.cycle.vgm'), 'wb') as f:
+          f.write(cycle_vgm)
+
+      if args.keep_wav:
+        nesmdb.vgm.save_vgmwav(vgm_fp.replace('.vgm', '.source.wav'), source_wav)
+        nesmdb.vgm.save_vgmwav(vgm_fp.replace('.vgm', '.cycle.wav'), cycle_wav)
+  finally:
+    if render_pool is not None:
+      render_pool.close()
 
   dists = vgm_fp_to_dist.values()
   print 'Mean distance (n={}): {} (std={})'.format(len(dists), np.mean(dists), np.std(dists))
@@ -1,5 +1,6 @@
-from rawsco import ndf_to_rawsco, rawsco_to_ndf
-from exprsco import rawsco_to_exprsco, exprsco_downsample, exprsco_to_rawsco
+from rawsco import ndf_to_rawsco, ndf_to_rawsco_runs, rawsco_runs_to_rawsco, rawsco_to_ndf
+from exprsco import rawsco_to_exprsco, rawsco_runs_to_exprsco_runs, exprsco_to_exprsco_runs, exprsco_runs_to_exprsco, exprsco_estimate_rate, exprsco_runs_estimate_rate, exprsco_downsample, exprsco_runs_downsample, exprsco_to_rawsco
 from seprsco import exprsco_to_seprsco, seprsco_to_exprsco
-from blndsco import exprsco_to_blndsco, blndsco_to_exprsco
+from blndsco import exprsco_to_blndsco, blndsco_to_exprsco, exprsco_to_blndsco_ragged, blndsco_ragged_to_exprsco, blndsco_to_blndsco_ragged, blndsco_ragged_to_blndsco
 from midi import exprsco_to_midi, midi_to_exprsco
+from corpus import write_score_corpus, ScoreCorpus
@@ -1,28 +1,66 @@
 import numpy as np
 
 
-def exprsco_to_blndsco(exprsco):
+# Ragged blended score
+#
+# (rate, nsamps, notes, offsets): notes is a flat uint8 array of the sounding
+# notes of every frame (ascending within a frame) and frame i is
+# notes[offsets[i]:offsets[i + 1]]. The list-of-lists blended score is the
+# same data with one Python list per frame.
+
+
+def exprsco_to_blndsco_ragged(exprsco):
   rate, nsamps, score = exprsco
 
-  blndsco = []
-  for i in xrange(score.shape[0]):
-    score_slice = list(score[i, :3, 0])
-    score_slice = sorted(filter(lambda x: x > 0, score_slice))
-    blndsco.append(score_slice)
+  frames = np.sort(score[:, :3, 0], axis=1)
+  sounding = frames > 0
+  notes = frames[sounding]
+  offsets = np.append(0, np.cumsum(np.sum(sounding, axis=1))).astype(np.int64)
 
-  return (rate, nsamps, blndsco)
+  return (rate, nsamps, notes, offsets)
 
 
-def blndsco_to_exprsco(blndsco):
+def blndsco_ragged_to_exprsco(blndsco_ragged):
+  rate, nsamps, notes, offsets = blndsco_ragged
+
+  # Notes beyond the third of a frame are dropped
+  nframes = offsets.shape[0] - 1
+  frame = np.repeat(np.arange(nframes), np.diff(offsets))
+  voice = np.arange(notes.shape[0]) - offsets[frame]
+  keep = voice < 3
+  frame = frame[keep]
+  voice = voice[keep]
+
+  exprsco = np.zeros((nframes, 4, 3), dtype=np.uint8)
+  exprsco[frame, voice, 0] = notes[keep]
+  exprsco[frame, voice, 1] = np.where(voice == 2, 0, 15)
+
+  return (rate, nsamps, exprsco)
+
+
+def blndsco_to_blndsco_ragged(blndsco):
   rate, nsamps, score = blndsco
 
-  score_len = len(score)
+  counts = np.array([len(frame) for frame in score], dtype=np.int64)
+  notes = np.array([note for frame in score for note in frame], dtype=np.uint8)
+  offsets = np.append(0, np.cumsum(counts)).astype(np.int64)
 
-  exprsco = np.zeros((score_len, 4, 3), dtype=np.uint8)
+  return (rate, nsamps, notes, offsets)
 
-  for i, frame in enumerate(score):
-    for j, note in enumerate(frame[:3]):
-      exprsco[i, j, 0] = note
-      exprsco[i, j, 1] = 0 if j == 2 else 15
 
-  return (rate, nsamps, exprsco)
+def blndsco_ragged_to_blndsco(blndsco_ragged):
+  rate, nsamps, notes, offsets = blndsco_ragged
+
+  notes = notes.tolist()
+  offsets = offsets.tolist()
+  blndsco = [notes[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+  return (rate, nsamps, blndsco)
+
+
+def exprsco_to_blndsco(exprsco):
+  return blndsco_ragged_to_blndsco(exprsco_to_blndsco_ragged(exprsco))
+
+
+def blndsco_to_exprsco(blndsco):
+  return blndsco_ragged_to_exprsco(blndsco_to_blndsco_ragged(blndsco))
@@ -0,0 +1,55 @@
+import numpy as np
+
+from nesmdb.corpus import write_corpus, Corpus
+
+
+# Packed score corpus
+#
+# Frames of many songs are concatenated into a few flat uint8 shard files
+# (<kind>.<shard>.bin) of a nesmdb.corpus corpus; each song also stores its
+# rate and nsamps.
+
+_KIND_TO_FRAME_SHAPE = {
+    'exprsco': (4, 3),
+    'seprsco': (4,),
+}
+
+
+def write_score_corpus(corpus_dir, songs, kind='exprsco', shard_nbytes=(1 << 30)):
+  """Writes (song_id, score) pairs to a packed corpus in corpus_dir.
+
+  score is an exprsco or seprsco tuple (rate, nsamps, frames), e.g. the
+  output of exprsco_downsample. songs may be any iterable (e.g. a generator
+  loading one song at a time); a new shard starts once shard_nbytes is
+  exceeded.
+  """
+  if kind not in _KIND_TO_FRAME_SHAPE:
+    raise ValueError('Unknown score kind \'{}\''.format(kind))
+
+  items = ((song_id, score, float(rate), int(nsamps)) for song_id, (rate, nsamps, score) in songs)
+  write_corpus(
+      corpus_dir,
+      items,
+      np.uint8,
+      item_shape=_KIND_TO_FRAME_SHAPE[kind],
+      meta={'kind': kind},
+      shard_fn=kind + '.{:05d}.bin',
+      shard_nbytes=shard_nbytes)
+
+
+class ScoreCorpus(Corpus):
+  """Read-only view of a corpus written by write_score_corpus.
+
+  corpus[i] or corpus[song_id] returns (rate, nsamps, frames) like the score
+  pickles, where frames is a view into the memory-mapped shard.
+  """
+
+  def __init__(self, corpus_dir):
+    super(ScoreCorpus, self).__init__(corpus_dir)
+    self.kind = self.meta['kind']
+    self.frame_shape = self.item_shape
+    self.song_ids = self.item_ids
+
+  def _item(self, frames, extra):
+    rate, nsamps = extra
+    return (rate, nsamps, frames)
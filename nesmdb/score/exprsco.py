@@ -1,15 +1,9 @@
-from collections import defaultdict, Counter
-import math
+from collections import Counter
 
 import numpy as np
-from scipy.stats import mode
 
 
-def rawsco_to_exprsco(rawsco, midi_valid_range=(21, 108)):
-  clock, rate, nsamps, rawsco = rawsco
-  assert rate == 44100
-  assert rawsco.shape[0] == nsamps
-
+def _rawsco_frames_to_exprsco(clock, rawsco, midi_valid_range):
   nsamps = rawsco.shape[0]
 
   t = rawsco[:, :3, :2].astype(np.uint16)
@@ -43,83 +37,213 @@ def rawsco_to_exprsco(rawsco, midi_valid_range=(21, 108)):
   # Set extra
   exprsco[:, :, 2] = rawsco[:, :, 3]
 
+  return exprsco
+
+
+def rawsco_to_exprsco(rawsco, midi_valid_range=(21, 108)):
+  clock, rate, nsamps, rawsco = rawsco
+  assert rate == 44100
+  assert rawsco.shape[0] == nsamps
+
+  nsamps = rawsco.shape[0]
+
+  exprsco = _rawsco_frames_to_exprsco(clock, rawsco, midi_valid_range)
+
   return (rate, nsamps, exprsco)
 
 
-def exprsco_downsample(exprsco, rate, adaptive):
-  rate_prev, nsamps, exprsco = exprsco
+def rawsco_runs_to_exprsco_runs(rawsco_runs, midi_valid_range=(21, 108)):
+  clock, rate, nsamps, run_starts, run_frames = rawsco_runs
+  assert rate == 44100
+
+  run_frames = _rawsco_frames_to_exprsco(clock, run_frames, midi_valid_range)
+
+  # Distinct raw frames (e.g. timer changes within a semitone) may collapse
+  if run_starts.shape[0] > 1:
+    changed = np.any(run_frames[1:] != run_frames[:-1], axis=(1, 2))
+    keep = np.concatenate([[True], changed])
+    run_starts = run_starts[keep]
+    run_frames = run_frames[keep]
+
+  return (rate, nsamps, run_starts, run_frames)
+
+
+def exprsco_to_exprsco_runs(exprsco):
+  rate, nsamps, exprsco = exprsco
+
+  # Find frames that differ from their predecessor
+  if exprsco.shape[0] > 0:
+    changed = np.any(exprsco[1:] != exprsco[:-1], axis=(1, 2))
+    run_starts = np.concatenate([[0], np.where(changed)[0] + 1]).astype(np.int64)
+  else:
+    run_starts = np.zeros(0, dtype=np.int64)
+  run_frames = exprsco[run_starts]
+
+  return (rate, nsamps, run_starts, run_frames)
+
+
+def exprsco_runs_to_exprsco(exprsco_runs):
+  rate, nsamps, run_starts, run_frames = exprsco_runs
+
+  run_ends = np.append(run_starts[1:], nsamps)
+  exprsco = np.repeat(run_frames, run_ends - run_starts, axis=0)
+
+  return (rate, nsamps, exprsco)
+
+
+def _weighted_mode(groups, values, weights, ngroups):
+  # Most common value per group, ties broken toward the smallest value (like
+  # scipy.stats.mode)
+  modes = np.zeros(ngroups, dtype=values.dtype)
+  if groups.shape[0] == 0:
+    return modes
+
+  # Total weight of each (group, value) pair
+  order = np.lexsort((values, groups))
+  groups, values, weights = groups[order], values[order], weights[order]
+  new = np.ones(groups.shape[0], dtype=np.bool)
+  new[1:] = np.logical_or(groups[1:] != groups[:-1], values[1:] != values[:-1])
+  idxs = np.where(new)[0]
+  weights = np.add.reduceat(weights, idxs)
+  groups, values = groups[idxs], values[idxs]
+
+  # Heaviest value in each group
+  order = np.lexsort((values, -weights, groups))
+  groups, values = groups[order], values[order]
+  first = np.ones(groups.shape[0], dtype=np.bool)
+  first[1:] = groups[1:] != groups[:-1]
+  modes[groups[first]] = values[first]
+
+  return modes
+
+
+def exprsco_runs_downsample(exprsco_runs, rate):
+  rate_prev, nsamps, run_starts, run_frames = exprsco_runs
   assert abs(rate_prev - 44100.) < 1e-6
-  if abs(rate - 44100.) < 1e-6:
-    return (rate_prev, nsamps, exprsco)
 
   if rate is None:
-    # Find note onsets
-    ch_to_last_note = {ch:0 for ch in xrange(4)}
-    ch_to_onsets = defaultdict(list)
-    for i in xrange(exprsco.shape[0]):
-      for j in xrange(4):
-        last_note = ch_to_last_note[j]
-        note = exprsco[i, j, 0]
-        if note > 0 and note != last_note:
-          ch_to_onsets[j].append(i)
-        ch_to_last_note[j] = note
-
-    # Find note intervals
-    intervals = Counter()
-    for _, onsets in ch_to_onsets.items():
-      for i in xrange(1, len(onsets)):
-        interval = onsets[i] - onsets[i - 1]
-        # Minimum length 1ms
-        if interval > 44:
-          intervals[interval] += 1
-    intervals_t = {i / 44100.:c for i, c in intervals.items()}
-
-    # Raise error if we don't have enough info to estimate tempo
-    num_intervals = sum(intervals.values())
-    if num_intervals < 10:
-      raise Exception('Too few intervals ({}) to estimate tempo'.format(num_intervals))
-
-    # Determine how well each rate divides the intervals
-    # TODO: Make 1/24/disc variables
-    disc = 0.001
-    rate_errors = []
-    for rate in np.arange(1., 24. + disc, disc):
-      error = 0.
-      for interval, count in intervals_t.items():
-        quotient = math.floor(interval * rate + 1e-8)
-        remainder = interval - (quotient / rate)
-        if remainder < 0 and abs(remainder) < 1e-8:
-          remainder = 0
-        assert remainder >= 0
-        error += remainder * count
-      rate_errors.append((rate, error))
-
-    # Find best rate
-    rate_errors = sorted(rate_errors, key=lambda x: x[1])
-    rate = float(rate_errors[0][0])
+    rate, _, _ = exprsco_runs_estimate_rate(exprsco_runs)
 
-  # Downsample
+  # Window boundaries (same arithmetic as exprsco_downsample)
   rate = float(rate)
   ndown = int((nsamps / 44100.) * rate)
-  score_low = np.zeros((ndown, 4, 3), dtype=np.uint8)
-  for i in xrange(ndown):
-    t_lo = i / rate
-    t_hi = (i + 1) / rate
-    # TODO: round these instead of casting?
-    samp_lo, samp_hi = [int(t * 44100.) for t in [t_lo, t_hi]]
-    score_slice = exprsco[samp_lo:samp_hi]
-    for ch in xrange(4):
-      score_slice_ch = score_slice[:, ch, :]
-      on_frames = np.where(score_slice_ch[:, 0] != 0)[0]
-      if len(on_frames) > 0:
-        score_low[i, ch, :] = mode(score_slice_ch[on_frames])[0][0]
-      else:
-        score_low[i, ch, :2] = 0
-        score_low[i, ch, 2] = mode(score_slice_ch[:, 2])[0][0]
+  bounds = ((np.arange(ndown + 1, dtype=np.float64) / rate) * 44100.).astype(np.int64)
+  bounds = np.minimum(bounds, nsamps)
+
+  # Split runs at window boundaries so every segment lies in a single window
+  cuts = np.union1d(run_starts, bounds)
+  cuts = cuts[np.logical_and(cuts >= bounds[0], cuts <= bounds[-1])]
+  seg_starts, seg_lens = cuts[:-1], np.diff(cuts)
+  valid = seg_lens > 0
+  seg_starts, seg_lens = seg_starts[valid], seg_lens[valid]
+  seg_wins = np.searchsorted(bounds, seg_starts, side='right') - 1
+  seg_runs = np.searchsorted(run_starts, seg_starts, side='right') - 1
+  seg_frames = run_frames[seg_runs]
+
+  # Take mode of each field over frames with notes, falling back to timbre
+  # mode over all frames for windows where the channel is silent
+  nsegs = seg_starts.shape[0]
+  ngroups = ndown * 4
+  groups = (seg_wins[:, np.newaxis] * 4 + np.arange(4)[np.newaxis, :]).reshape(-1)
+  weights = np.repeat(seg_lens, 4)
+  seg_frames = seg_frames.reshape(nsegs * 4, 3)
+  on = seg_frames[:, 0] != 0
+
+  score_low = np.zeros((ngroups, 3), dtype=np.uint8)
+  for j in xrange(3):
+    score_low[:, j] = _weighted_mode(groups[on], seg_frames[on, j], weights[on], ngroups)
+  has_on = np.bincount(groups[on], minlength=ngroups) > 0
+  timbre_off = _weighted_mode(groups, seg_frames[:, 2], weights, ngroups)
+  score_low[~has_on, :2] = 0
+  score_low[~has_on, 2] = timbre_off[~has_on]
+
+  score_low = score_low.reshape(ndown, 4, 3)
 
   return (rate, nsamps, score_low)
 
 
+def exprsco_runs_estimate_rate(exprsco_runs, rate_min=1., rate_max=24., disc=0.001, coarse_disc=None):
+  rate_prev, nsamps, run_starts, run_frames = exprsco_runs
+  assert abs(rate_prev - 44100.) < 1e-6
+
+  # Find note onsets (within a run the note cannot change)
+  notes = run_frames[:, :, 0]
+  notes_last = np.zeros_like(notes)
+  notes_last[1:] = notes[:-1]
+  onset = np.logical_and(notes > 0, notes != notes_last)
+
+  # Find note intervals
+  intervals = Counter()
+  for j in xrange(4):
+    onsets = run_starts[np.where(onset[:, j])[0]]
+    for interval in np.diff(onsets):
+      # Minimum length 1ms
+      if interval > 44:
+        intervals[int(interval)] += 1
+  intervals_t = {i / 44100.:c for i, c in intervals.items()}
+
+  # Raise error if we don't have enough info to estimate tempo
+  num_intervals = sum(intervals.values())
+  if num_intervals < 10:
+    raise Exception('Too few intervals ({}) to estimate tempo'.format(num_intervals))
+
+  # Error is summed interval by interval (in dict order) so results are
+  # reproducible with previous releases
+  intervals_t = intervals_t.items()
+  interval_ts = np.array([i for i, _ in intervals_t], dtype=np.float64)
+  interval_counts = np.array([c for _, c in intervals_t], dtype=np.float64)
+
+  # Determine how well each rate divides the intervals
+  def rate_errors(rates):
+    errors = np.zeros_like(rates)
+    chunk = max(1, (1 << 21) // max(1, rates.shape[0]))
+    for i in xrange(0, interval_ts.shape[0], chunk):
+      interval = interval_ts[i:i+chunk, np.newaxis]
+      quotient = np.floor(interval * rates[np.newaxis, :] + 1e-8)
+      remainder = interval - (quotient / rates[np.newaxis, :])
+      remainder[np.logical_and(remainder < 0, np.abs(remainder) < 1e-8)] = 0
+      assert np.all(remainder >= 0)
+      remainder *= interval_counts[i:i+chunk, np.newaxis]
+      for r in remainder:
+        errors += r
+    return errors
+
+  rates = np.arange(rate_min, rate_max + disc, disc)
+  if coarse_disc is None:
+    errors = rate_errors(rates)
+  else:
+    # Search a coarse grid then refine around the best coarse candidates
+    step = max(1, int(round(coarse_disc / disc)))
+    idxs = np.arange(0, rates.shape[0], step)
+    coarse_errors = rate_errors(rates[idxs])
+    best = idxs[np.argsort(coarse_errors, kind='mergesort')[:8]]
+    idxs = np.unique(np.concatenate([np.arange(i - step, i + step + 1) for i in best]))
+    idxs = idxs[np.logical_and(idxs >= 0, idxs < rates.shape[0])]
+    rates = rates[idxs]
+    errors = rate_errors(rates)
+
+  # Find best rate (lowest rate wins ties)
+  rate = float(rates[np.argmin(errors)])
+
+  return rate, rates, errors
+
+
+def exprsco_estimate_rate(exprsco, **kwargs):
+  exprsco_runs = exprsco_to_exprsco_runs(exprsco)
+  return exprsco_runs_estimate_rate(exprsco_runs, **kwargs)
+
+
+def exprsco_downsample(exprsco, rate, adaptive):
+  rate_prev, nsamps, exprsco = exprsco
+  assert abs(rate_prev - 44100.) < 1e-6
+  if rate is not None and abs(rate - 44100.) < 1e-6:
+    return (rate_prev, nsamps, exprsco)
+
+  # Downsample
+  exprsco_runs = exprsco_to_exprsco_runs((rate_prev, nsamps, exprsco))
+  return exprsco_runs_downsample(exprsco_runs, rate)
+
+
 def exprsco_to_rawsco(exprsco, clock=1789773.):
   rate, nsamps, exprsco = exprsco
 
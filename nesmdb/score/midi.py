@@ -1,160 +1,348 @@
-from collections import defaultdict
+import struct
+
 import numpy as np
-import tempfile
 
 
-def exprsco_to_midi(exprsco):
-  import pretty_midi
+# NES-MDB MIDI layout
+#
+# Type 1 SMF at 120 BPM with a resolution of 22050 ticks per beat, i.e. one
+# tick per 44.1 kHz sample. Track 0 holds the tempo and two time signatures;
+# the second marks the end of the song. Tracks 1-4 are the named voices with
+# notes, velocity (CC11) and timbre (CC12). Event order and note pairing follow
+# pretty_midi, which wrote the released files, so those load unchanged.
 
-  rate, nsamps, exprsco = exprsco
+_MIDI_RESOLUTION = 22050
+_MIDI_TEMPO = 500000
+_MIDI_VOICES = ['p1', 'p2', 'tr', 'no']
+_MIDI_PROGRAMS = [80, 81, 38, 121]
+_MIDI_CHANNELS = [0, 1, 2, 9]
 
-  # Create MIDI instruments
-  p1_prog = pretty_midi.instrument_name_to_program('Lead 1 (square)')
-  p2_prog = pretty_midi.instrument_name_to_program('Lead 2 (sawtooth)')
-  tr_prog = pretty_midi.instrument_name_to_program('Synth Bass 1')
-  no_prog = pretty_midi.instrument_name_to_program('Breath Noise')
-  p1 = pretty_midi.Instrument(program=p1_prog, name='p1', is_drum=False)
-  p2 = pretty_midi.Instrument(program=p2_prog, name='p2', is_drum=False)
-  tr = pretty_midi.Instrument(program=tr_prog, name='tr', is_drum=False)
-  no = pretty_midi.Instrument(program=no_prog, name='no', is_drum=True)
-
-  # Iterate through score to extract channel notes
-  notes = {}
-  ccs = {}
-  for i, ch in enumerate(np.split(exprsco, 4, axis=1)):
-    ch = ch[:, 0, :]
-
-    # MIDI doesn't allow velocity 0 messages so set tr velocity to 1
-    if i == 2:
-      ch[:, 1] = 1
-      last_velocity = 1
-    else:
-      last_velocity = 0
-
-    last_note = 0
-    last_timbre = 0
-    note_starts = []
-    note_ends = []
-    ch_ccs = []
-    for s, (note, velocity, timbre) in enumerate(ch):
-      if note != last_note:
-        if note == 0:
-          note_ends.append(s)
-        else:
-          if last_note == 0:
-            note_starts.append((s, note, velocity))
-          else:
-            note_ends.append(s)
-            note_starts.append((s, note, velocity))
-      else:
-        if velocity != last_velocity:
-          ch_ccs.append((s, 11, velocity))
-
-      if timbre != last_timbre:
-        ch_ccs.append((s, 12, timbre))
-
-      last_note = note
-      last_velocity = velocity
-      last_timbre = timbre
-    if last_note != 0:
-      note_ends.append(s + 1)
-
-    assert len(note_starts) == len(note_ends)
-    notes[i] = zip(note_starts, note_ends)
-    ccs[i] = ch_ccs
-
-  # Add notes to MIDI instruments
-  for i, ins in enumerate([p1, p2, tr, no]):
-    for (start_samp, note, velocity), end_samp in notes[i]:
-      assert end_samp > start_samp
-      start_t, end_t = start_samp / 44100., end_samp / 44100.
-      note = pretty_midi.Note(velocity=velocity, pitch=note, start=start_t, end=end_t)
-      ins.notes.append(note)
-
-    for samp, cc_num, arg in ccs[i]:
-      cc = pretty_midi.ControlChange(cc_num, arg, samp / 44100.)
-      ins.control_changes.append(cc)
-
-  # Add instruments to MIDI file
-  midi = pretty_midi.PrettyMIDI(initial_tempo=120, resolution=22050)
-  midi.instruments.extend([p1, p2, tr, no])
-
-  # Create indicator for end of song
-  eos = pretty_midi.TimeSignature(1, 1, nsamps / 44100.)
-  midi.time_signature_changes.append(eos)
-
-  # Write/read MIDI file
-  mf = tempfile.NamedTemporaryFile('rb')
-  midi.write(mf.name)
-  midi = mf.read()
-  mf.close()
-
-  return midi
+_MIDI_HEADER = struct.Struct('>4sIHHH')
+_MIDI_CHUNK = struct.Struct('>4sI')
 
 
-def midi_to_exprsco(midi):
-  import pretty_midi
+def _midi_varint(n):
+  out = [n & 0x7f]
+  n >>= 7
+  while n > 0:
+    out.append(0x80 | (n & 0x7f))
+    n >>= 7
+  return bytearray(out[::-1])
+
+
+def _midi_varint_array(n):
+  # Big-endian variable-length quantities as (N, 4) bytes and valid mask
+  shifts = np.array([21, 14, 7, 0], dtype=np.int64)
+  vlq = (n[:, np.newaxis] >> shifts) & 0x7f
+  nbytes = 1 + (n >= (1 << 7)).astype(np.int64) + (n >= (1 << 14)) + (n >= (1 << 21))
+  valid = np.arange(4)[np.newaxis, :] >= (4 - nbytes)[:, np.newaxis]
+  vlq[:, :3] |= 0x80
+  return vlq, valid
+
+
+def _midi_chunk(ident, data):
+  return _MIDI_CHUNK.pack(ident, len(data)) + bytes(data)
+
+
+def _midi_voice_track(name, program, channel, notes, ccs):
+  # notes is (start, end, pitch, velocity) and ccs is (samp, number, value)
+  assert notes.shape[0] == 0 or (notes[:, 2:].min() >= 0 and notes[:, 2:].max() < 128)
+  assert ccs.shape[0] == 0 or (ccs[:, 1:].min() >= 0 and ccs[:, 1:].max() < 128)
+  nnotes = notes.shape[0]
+
+  # Events in insertion order: each note's on and off, then CCs
+  tick = np.concatenate([notes[:, :2].ravel(), ccs[:, 0]])
+  status = np.concatenate([
+    np.full(nnotes * 2, 0x90 | channel, dtype=np.int64),
+    np.full(ccs.shape[0], 0xb0 | channel, dtype=np.int64)])
+  data1 = np.concatenate([np.repeat(notes[:, 2], 2), ccs[:, 1]])
+  data2 = np.concatenate([
+    np.stack([notes[:, 3], np.zeros(nnotes, dtype=np.int64)], axis=1).ravel(),
+    ccs[:, 2]])
+
+  # Same tick: CCs by number and value, then notes by pitch and velocity
+  order = np.lexsort((data1 * 256 + data2, status >> 4 == 0x9, tick))
+  tick = tick[order]
+  status = status[order]
+  data1 = data1[order]
+  data2 = data2[order]
+
+  # Delta times with running status
+  delta = np.diff(np.append(0, tick))
+  vlq, valid = _midi_varint_array(delta)
+  events = np.concatenate([vlq, np.stack([status, data1, data2], axis=1)], axis=1)
+  valid = np.concatenate([valid, np.ones((tick.shape[0], 3), dtype=np.bool)], axis=1)
+  valid[1:, 4] = status[1:] != status[:-1]
+
+  data = bytearray('\x00\xff\x03') + _midi_varint(len(name)) + bytearray(name)
+  data += bytearray([0x00, 0xc0 | channel, program])
+  data += bytearray(events[valid].astype(np.uint8).tobytes())
+  data += bytearray([0x01, 0xff, 0x2f, 0x00])
+  return _midi_chunk('MTrk', data)
 
-  # Write/read MIDI file
-  mf = tempfile.NamedTemporaryFile('wb')
-  mf.write(midi)
-  mf.seek(0)
-  midi = pretty_midi.PrettyMIDI(mf.name)
-  mf.close()
+
+def _midi_write(nsamps, voices):
+  """Encodes voices as NES-MDB MIDI bytes.
+
+  voices is a list of (notes, ccs) per voice in _MIDI_VOICES order.
+  """
+  tempo = bytearray('\x00\xff\x51\x03') + bytearray(struct.pack('>I', _MIDI_TEMPO)[1:])
+  timing = tempo
+  if nsamps > 0:
+    timing += bytearray('\x00\xff\x58\x04\x04\x02\x18\x08')
+  timing += _midi_varint(nsamps) + bytearray('\xff\x58\x04\x01\x00\x18\x08')
+  timing += bytearray('\x01\xff\x2f\x00')
+
+  tracks = [_midi_chunk('MTrk', timing)]
+  for name, program, channel, (notes, ccs) in zip(
+      _MIDI_VOICES, _MIDI_PROGRAMS, _MIDI_CHANNELS, voices):
+    tracks.append(_midi_voice_track(name, program, channel, notes, ccs))
+
+  header = _MIDI_HEADER.pack('MThd', 6, 1, len(tracks), _MIDI_RESOLUTION)
+  return header + ''.join(tracks)
+
+
+def _midi_read(midi):
+  """Decodes NES-MDB MIDI bytes.
+
+  Returns (nsamps, voices) where voices maps voice name to (notes, ccs) as
+  int64 arrays of (start, end, pitch, velocity) and (samp, number, value) in
+  sample units. Notes are paired and ordered as pretty_midi loads them: a
+  note on with velocity 0 is a note off, unfinished notes are dropped and
+  so are the CCs of tracks without notes.
+  """
+  data = bytearray(midi)
+  ident, hlen, fmt, ntracks, resolution = _MIDI_HEADER.unpack_from(str(data[:14]))
+  if ident != 'MThd':
+    raise ValueError('Not a MIDI file')
+  if resolution & 0x8000:
+    raise NotImplementedError('SMPTE time division is not supported')
+
+  i = 8 + hlen
+  tempos = set()
+  time_signatures = []
+  tracks = []
+  for track_idx in xrange(ntracks):
+    ident, tlen = _MIDI_CHUNK.unpack_from(str(data[i:i + 8]))
+    i += 8
+    end = i + tlen
+    if ident != 'MTrk':
+      i = end
+      continue
+
+    name = None
+    notes = []
+    ccs = []
+    open_notes = {}
+    tick = 0
+    status = None
+    while i < end:
+      # Delta time
+      b = data[i]
+      i += 1
+      delta = b & 0x7f
+      while b & 0x80:
+        b = data[i]
+        i += 1
+        delta = (delta << 7) | (b & 0x7f)
+      tick += delta
+
+      b = data[i]
+      if b == 0xff:
+        meta = data[i + 1]
+        i += 2
+        b = data[i]
+        i += 1
+        mlen = b & 0x7f
+        while b & 0x80:
+          b = data[i]
+          i += 1
+          mlen = (mlen << 7) | (b & 0x7f)
+        mdata = data[i:i + mlen]
+        i += mlen
+
+        if meta == 0x03:
+          name = str(mdata)
+        elif meta == 0x51 and track_idx == 0:
+          tempos.add((mdata[0] << 16) | (mdata[1] << 8) | mdata[2])
+        elif meta == 0x58 and track_idx == 0:
+          time_signatures.append(tick)
+        elif meta == 0x2f:
+          break
+        status = None
+        continue
+      elif b == 0xf0 or b == 0xf7:
+        i += 1
+        b = data[i]
+        i += 1
+        slen = b & 0x7f
+        while b & 0x80:
+          b = data[i]
+          i += 1
+          slen = (slen << 7) | (b & 0x7f)
+        i += slen
+        status = None
+        continue
+
+      # Channel message (with running status)
+      if b & 0x80:
+        status = b
+        i += 1
+      kind = status & 0xf0
+      if kind == 0xc0 or kind == 0xd0:
+        i += 1
+        continue
+      data1 = data[i]
+      data2 = data[i + 1]
+      i += 2
+
+      key = (status & 0x0f, data1)
+      if kind == 0x90 and data2 > 0:
+        open_notes.setdefault(key, []).append((tick, data2))
+      elif kind == 0x80 or kind == 0x90:
+        if key in open_notes:
+          # Close notes from previous ticks; keep one started on this tick
+          closing = [n for n in open_notes[key] if n[0] != tick]
+          keeping = [n for n in open_notes[key] if n[0] == tick]
+          for start, velocity in closing:
+            notes.append((start, tick, data1, velocity))
+          if len(closing) > 0 and len(keeping) > 0:
+            open_notes[key] = keeping
+          else:
+            del open_notes[key]
+      elif kind == 0xb0:
+        ccs.append((tick, data1, data2))
+
+    i = end
+    if len(notes) > 0:
+      tracks.append((name, notes, ccs))
+
+  if len(tempos) > 1:
+    raise NotImplementedError('MIDI files with tempo changes are not supported')
+  tempo = tempos.pop() if len(tempos) > 0 else _MIDI_TEMPO
+  samps_per_tick = (tempo * 44100.) / (resolution * 1e6)
+  to_samps = lambda t: np.round(np.array(t, dtype=np.float64) * samps_per_tick).astype(np.int64)
 
   # Recover number of samples from time signature change indicator
-  assert len(midi.time_signature_changes) == 2
-  nsamps = int(np.round(midi.time_signature_changes[1].time * 44100))
+  assert len(time_signatures) == 2
+  nsamps = int(to_samps(time_signatures[1]))
+
+  voices = {}
+  for name, notes, ccs in tracks:
+    notes = np.array(notes, dtype=np.int64).reshape(-1, 4)
+    ccs = np.array(ccs, dtype=np.int64).reshape(-1, 3)
+    notes[:, :2] = to_samps(notes[:, :2])
+    ccs[:, 0] = to_samps(ccs[:, 0])
+    voices[name] = (notes, ccs)
+
+  return nsamps, voices
+
+
+def exprsco_to_midi(exprsco):
+  rate, nsamps, exprsco = exprsco
+
+  # Find note and CC changes on all channels at once (channel-major)
+  note = np.ascontiguousarray(exprsco[:, :, 0].T)
+  velocity = np.ascontiguousarray(exprsco[:, :, 1].T)
+  timbre = np.ascontiguousarray(exprsco[:, :, 2].T)
+
+  # MIDI doesn't allow velocity 0 messages so set tr velocity to 1
+  velocity[2] = 1
+
+  # Pad with silence so notes still on at the end of the song are ended
+  zero = np.zeros((4, 1), dtype=np.uint8)
+  note_pad = np.concatenate([note, zero], axis=1)
+  note_last = np.concatenate([zero, note], axis=1)
+  velocity_last = np.concatenate([[[0], [0], [1], [0]], velocity[:, :-1]], axis=1)
+  timbre_last = np.concatenate([zero, timbre[:, :-1]], axis=1)
+
+  note_changed = note_pad != note_last
+  is_start = np.logical_and(note_changed, note_pad != 0)[:, :-1]
+  is_end = np.logical_and(note_changed, note_last != 0)
+  note_changed = note_changed[:, :-1]
+  is_velocity = np.logical_and(~note_changed, velocity != velocity_last)
+  is_timbre = timbre != timbre_last
+
+  # Gather notes and CCs for each voice
+  voices = []
+  for i in xrange(4):
+    start_samps = np.where(is_start[i])[0]
+    end_samps = np.where(is_end[i])[0]
+    assert start_samps.shape[0] == end_samps.shape[0]
+    assert np.all(end_samps > start_samps)
+    notes = np.stack([
+      start_samps,
+      end_samps,
+      note[i, start_samps],
+      velocity[i, start_samps]], axis=1).astype(np.int64)
+
+    velocity_samps = np.where(is_velocity[i])[0]
+    timbre_samps = np.where(is_timbre[i])[0]
+    ccs = np.stack([
+      np.concatenate([velocity_samps, timbre_samps]),
+      np.repeat([11, 12], [velocity_samps.shape[0], timbre_samps.shape[0]]),
+      np.concatenate([velocity[i, velocity_samps], timbre[i, timbre_samps]])], axis=1).astype(np.int64)
+
+    voices.append((notes, ccs))
+
+  return _midi_write(nsamps, voices)
+
+
+def _fill_last(nsamps, samps, vals):
+  # Value of the last event at or before each sample (0 before the first);
+  # samps must be sorted and events at the same sample in application order
+  out = np.zeros(nsamps, dtype=np.uint8)
+  keep = samps < nsamps
+  samps = samps[keep]
+  vals = vals[keep]
+  if samps.shape[0] == 0:
+    return out
+
+  # Last event at each sample
+  last = np.append(samps[1:] != samps[:-1], True)
+  samps = samps[last]
+  vals = vals[last]
+
+  run_ends = np.append(samps[1:], nsamps)
+  out[samps[0]:] = np.repeat(vals.astype(np.uint8), run_ends - samps)
+  return out
+
+
+def midi_to_exprsco(midi):
+  nsamps, voices = _midi_read(midi)
 
   # Find voices in MIDI
   exprsco = np.zeros((nsamps, 4, 3), dtype=np.uint8)
-  ins_names = ['p1', 'p2', 'tr', 'no']
-  for ins in midi.instruments:
-    ch = ins_names.index(ins.name)
-
-    # Process note messages
-    comms = defaultdict(list)
-    for note in ins.notes:
-      start = int(np.round(note.start * 44100))
-      end = int(np.round(note.end * 44100))
-      velocity = note.velocity if ch != 2 else 0
-      note = note.pitch
-
-      comms[start].append(('note_on', note, velocity))
-      comms[end].append(('note_off',))
-
-    # Process CC messages
-    for cc in ins.control_changes:
-      samp = int(np.round(cc.time * 44100))
-      if cc.number == 11:
-        velocity = cc.value
-        assert velocity > 0
-        comms[samp].append(('cc_velo', velocity))
-      elif cc.number == 12:
-        timbre = cc.value
-        comms[samp].append(('cc_timbre', timbre))
-      else:
-        assert False
-
-    # Write score
-    note = 0
-    velocity = 0
-    timbre = 0
-    for i in xrange(nsamps):
-      for comm in comms[i]:
-        if comm[0] == 'note_on':
-          note = comm[1]
-          velocity = comm[2]
-        elif comm[0] == 'note_off':
-          note = 0
-          velocity = 0
-        elif comm[0] == 'cc_velo':
-          velocity = comm[1]
-        elif comm[0] == 'cc_timbre':
-          timbre = comm[1]
-        else:
-          assert False
-
-      exprsco[i, ch] = (note, velocity, timbre)
+  for name, (notes, ccs) in voices.items():
+    ch = _MIDI_VOICES.index(name)
+
+    # Events in application order: each note's on and off, then CCs
+    starts, ends, pitches, velocities = notes.T
+    if ch == 2:
+      velocities = np.zeros_like(velocities)
+    cc_samps, cc_nums, cc_vals = ccs.T
+    assert np.all(np.in1d(cc_nums, [11, 12]))
+    assert np.all(cc_vals[cc_nums == 11] > 0)
+
+    nnotes = notes.shape[0]
+    note_samps = np.stack([starts, ends], axis=1).ravel()
+    note_vals = np.stack([pitches, np.zeros(nnotes, dtype=np.int64)], axis=1).ravel()
+    note_velocities = np.stack([velocities, np.zeros(nnotes, dtype=np.int64)], axis=1).ravel()
+
+    # Note
+    order = np.argsort(note_samps, kind='mergesort')
+    exprsco[:, ch, 0] = _fill_last(nsamps, note_samps[order], note_vals[order])
+
+    # Velocity (set by notes and CC11)
+    velo_samps = np.concatenate([note_samps, cc_samps[cc_nums == 11]])
+    velo_vals = np.concatenate([note_velocities, cc_vals[cc_nums == 11]])
+    order = np.argsort(velo_samps, kind='mergesort')
+    exprsco[:, ch, 1] = _fill_last(nsamps, velo_samps[order], velo_vals[order])
+
+    # Timbre (set by CC12)
+    timbre_samps = cc_samps[cc_nums == 12]
+    timbre_vals = cc_vals[cc_nums == 12]
+    order = np.argsort(timbre_samps, kind='mergesort')
+    exprsco[:, ch, 2] = _fill_last(nsamps, timbre_samps[order], timbre_vals[order])
 
   return 44100, nsamps, exprsco
@@ -4,14 +4,62 @@ import numpy as np
 from scipy.stats import mode
 
 import nesmdb.apu
+from nesmdb.vgm.nd_array import ND_WAIT, ND_APU, ND_CHANNELS, ND_FUNCTIONS
 
 
 fs = 44100.
 dt = 1. / fs
 
 
-def ndf_to_rawsco(ndf):
+def _fc_next_tick(fc_t, fc_dt):
+  # Accumulate sample periods exactly as a per-sample loop would (cumsum is
+  # sequential in float64) to find how many samples until the next tick
+  n = int(fc_dt * fs) + 2
+  fc_ts = np.empty(n + 1, dtype=np.float64)
+  fc_ts[0] = fc_t
+  fc_ts[1:] = dt
+  fc_ts = np.cumsum(fc_ts)
+  k = int(np.argmax(fc_ts[1:] > fc_dt)) + 1
+  return k, fc_ts[k]
+
+
+def _ndf_timings(ndf):
+  # Returns clock, total samples and the (ch, fu, val) writes at each sample
+  samp_to_comms = defaultdict(list)
+
+  if isinstance(ndf, np.ndarray):
+    clock = float(ndf[0]['val'])
+    ndf = ndf[1:]
+
+    comm = ndf['comm']
+    waits = np.where(comm == ND_WAIT, ndf['val'], 0).astype(np.int64)
+    samps = np.cumsum(waits) - waits
+    apu = np.where(comm == ND_APU)[0]
+    ch = ndf['ch'][apu].astype(np.int64)
+    fu = ndf['fu'][apu].astype(np.int64)
+    chs = [ND_CHANNELS[c] for c in ch.tolist()]
+    fus = [ND_FUNCTIONS[c][f] for c, f in zip(ch.tolist(), fu.tolist())]
+    for samp, c, f, val in zip(samps[apu].tolist(), chs, fus, ndf['val'][apu].tolist()):
+      samp_to_comms[samp].append((c, f, val))
+
+    return clock, int(np.sum(waits)), samp_to_comms
+
   clock = float(ndf[0][1])
+  nsamps = 0
+  for comm in ndf[1:]:
+    if comm[0] == 'wait':
+      nsamps += comm[1]
+    else:
+      assert comm[0] == 'apu'
+      samp_to_comms[nsamps].append(comm[1:4])
+
+  return clock, nsamps, samp_to_comms
+
+
+def ndf_to_rawsco_runs(ndf):
+  # Gather timings
+  clock, nsamps, samp_to_comms = _ndf_timings(ndf)
+
   if abs(clock - 1789773) < 2:
     # NTSC
     fc_rate_4 = 240.
@@ -22,17 +70,6 @@ def ndf_to_rawsco(ndf):
     fc_rate_5 = 160.
   fc_rate_4_inv = 1. / fc_rate_4
   fc_rate_5_inv = 1. / fc_rate_5
-  ndf = ndf[1:]
-
-  # Gather timings
-  samp_to_comms = defaultdict(list)
-  nsamps = 0
-  for comm in ndf:
-    if comm[0] == 'wait':
-      nsamps += comm[1]
-    else:
-      assert comm[0] == 'apu'
-      samp_to_comms[nsamps].append(comm)
 
   # Set up APU register state
   ch_to_status = {'p1': 1, 'p2': 1, 'tr': 1, 'no': 1}
@@ -68,10 +105,16 @@ def ndf_to_rawsco(ndf):
   fc_t = 0.
   fc_tick = 0
   fc_changed = False
+  fc_tick_samp, fc_t_tick = _fc_next_tick(fc_t, fc_dt)
+  fc_tick_samp -= 1
 
   # Set up score state
   ch_to_midi = {'p1': 0, 'p2': 0, 'tr': 0, 'no': 0}
-  rawsco = np.zeros((nsamps, 4, 4), dtype=np.uint8)
+  comm_samps = sorted([s for s in samp_to_comms.keys() if s < nsamps])
+  comm_samps.append(nsamps)
+  comm_i = 0
+  run_starts = []
+  run_frames = []
 
   # Set up function to sweep
   def sweep(ch):
@@ -82,7 +125,10 @@ def ndf_to_rawsco(ndf):
     ch_to_stimer[ch] = ch_to_timer[ch] + shifted
 
   # Extract musical transcript by emulating APU
-  for samp in xrange(nsamps):
+  # State only changes at register writes and frame counter ticks, so we jump
+  # between those samples and emit one run per stretch of unchanged state
+  samp = 0
+  while samp < nsamps:
     # Frame counter (in between samples)
     quarter_frame = False
     half_frame = False
@@ -90,12 +136,13 @@ def ndf_to_rawsco(ndf):
       quarter_frame = True
       half_frame = True
       fc_changed = False
-    fc_t += dt
-    if fc_t > fc_dt:
+    if samp == fc_tick_samp:
       quarter_frame = True
       half_frame = fc_tick % 2 == 1
-      fc_t -= fc_dt
+      fc_t = fc_t_tick - fc_dt
       fc_tick += 1
+      fc_tick_nsamps, fc_t_tick = _fc_next_tick(fc_t, fc_dt)
+      fc_tick_samp = samp + fc_tick_nsamps
 
     if quarter_frame:
       # Update triangle linear counter
@@ -149,8 +196,12 @@ def ndf_to_rawsco(ndf):
             ch_to_swe_write[ch] = False
 
     # Update state based on commands
-    for comm in samp_to_comms[samp]:
-      ch, fu, val = comm[1:4]
+    samp_comms = []
+    if comm_samps[comm_i] == samp:
+      samp_comms = samp_to_comms[samp]
+      comm_i += 1
+    for comm in samp_comms:
+      ch, fu, val = comm
       if ch == 'dm' or fu == 'dm':
         continue
 
@@ -209,157 +260,230 @@ def ndf_to_rawsco(ndf):
         fc_t = 0.
         fc_tick = 0
         fc_changed = True
+        fc_tick_nsamps, fc_t_tick = _fc_next_tick(fc_t, fc_dt)
+        fc_tick_samp = samp + fc_tick_nsamps
+
+    frame = np.zeros((4, 4), dtype=np.uint8)
 
     # Fill in pulse score
     for i, ch in zip([0, 1], ['p1', 'p2']):
       if ch_to_length_counter[ch] > 0:
         vo = ch_to_vo[ch] if ch_to_cv[ch] else ch_to_env_decay_level[ch]
         if vo > 0 and ch_to_timer[ch] >= 8 and ch_to_stimer[ch] < 0x800:
-          rawsco[samp, i, 0] = (ch_to_timer[ch] & 0b11100000000) >> 8
-          rawsco[samp, i, 1] = (ch_to_timer[ch] & 0b00011111111)
-          rawsco[samp, i, 2] = vo
-      rawsco[samp, i, 3] = ch_to_du[ch]
-      #rawsco[samp, i, 4] = int(ch_to_retrigger[ch])
+          frame[i, 0] = (ch_to_timer[ch] & 0b11100000000) >> 8
+          frame[i, 1] = (ch_to_timer[ch] & 0b00011111111)
+          frame[i, 2] = vo
+      frame[i, 3] = ch_to_du[ch]
+      #frame[i, 4] = int(ch_to_retrigger[ch])
       ch_to_retrigger[ch] = False
 
     # Fill in triangle score
     lc = min(ch_to_length_counter['tr'], tr_linear_counter)
     if lc > 0:
-      rawsco[samp, 2, 0] = (ch_to_timer['tr'] & 0b11100000000) >> 8
-      rawsco[samp, 2, 1] = (ch_to_timer['tr'] & 0b00011111111)
-    #rawsco[samp, 2, 2] = 0
-    #rawsco[samp, 2, 3] = 0
+      frame[2, 0] = (ch_to_timer['tr'] & 0b11100000000) >> 8
+      frame[2, 1] = (ch_to_timer['tr'] & 0b00011111111)
+    #frame[2, 2] = 0
+    #frame[2, 3] = 0
 
     # Fill in noise score
     if ch_to_length_counter['no'] > 0:
       vo = ch_to_vo['no'] if ch_to_cv['no'] else ch_to_env_decay_level['no']
       if vo > 0:
-        #rawsco[samp, 3, 0] = 0
-        rawsco[samp, 3, 1] = 16 - no_np
-        rawsco[samp, 3, 2] = vo
-    rawsco[samp, 3, 3] = no_nl
+        #frame[3, 0] = 0
+        frame[3, 1] = 16 - no_np
+        frame[3, 2] = vo
+    frame[3, 3] = no_nl
+
+    run_starts.append(samp)
+    run_frames.append(frame)
+
+    # Advance to next state change
+    samp_next = min(fc_tick_samp, comm_samps[comm_i])
+    if fc_changed:
+      samp_next = samp + 1
+    samp = min(samp_next, nsamps)
+
+  run_starts = np.array(run_starts, dtype=np.int64)
+  if len(run_frames) > 0:
+    run_frames = np.array(run_frames, dtype=np.uint8)
+  else:
+    run_frames = np.zeros((0, 4, 4), dtype=np.uint8)
+
+  # Merge adjacent runs with identical frames
+  if run_starts.shape[0] > 1:
+    changed = np.any(run_frames[1:] != run_frames[:-1], axis=(1, 2))
+    keep = np.concatenate([[True], changed])
+    run_starts = run_starts[keep]
+    run_frames = run_frames[keep]
+
+  return (clock, 44100, nsamps, run_starts, run_frames)
+
 
-  return (clock, 44100, nsamps, rawsco)
+def rawsco_runs_to_rawsco(rawsco_runs):
+  clock, rate, nsamps, run_starts, run_frames = rawsco_runs
+
+  run_ends = np.append(run_starts[1:], nsamps)
+  rawsco = np.repeat(run_frames, run_ends - run_starts, axis=0)
+
+  return (clock, rate, nsamps, rawsco)
+
+
+def ndf_to_rawsco(ndf):
+  rawsco_runs = ndf_to_rawsco_runs(ndf)
+  return rawsco_runs_to_rawsco(rawsco_runs)
+
+
+# Initial NDF commands of a synthesized song
+# ('apu', ch, func, func_val, natoms, offset)
+_RAWSCO_NDF_HEADER = [
+    ('apu', 'ch', 'p1', 0, 0, 0),
+    ('apu', 'ch', 'p2', 0, 0, 0),
+    ('apu', 'ch', 'tr', 0, 0, 0),
+    ('apu', 'ch', 'no', 0, 0, 0),
+    ('apu', 'p1', 'du', 0, 1, 0),
+    ('apu', 'p1', 'lh', 1, 1, 0),
+    ('apu', 'p1', 'cv', 1, 1, 0),
+    ('apu', 'p1', 'vo', 0, 1, 0),
+    ('apu', 'p1', 'ss', 7, 2, 1), # This is necessary to prevent channel silence for low notes
+    ('apu', 'p2', 'du', 0, 3, 0),
+    ('apu', 'p2', 'lh', 1, 3, 0),
+    ('apu', 'p2', 'cv', 1, 3, 0),
+    ('apu', 'p2', 'vo', 0, 3, 0),
+    ('apu', 'p2', 'ss', 7, 4, 1), # This is necessary to prevent channel silence for low notes
+    ('apu', 'tr', 'lh', 1, 5, 0),
+    ('apu', 'tr', 'lr', 127, 5, 0),
+    ('apu', 'no', 'lh', 1, 6, 0),
+    ('apu', 'no', 'cv', 1, 6, 0),
+    ('apu', 'no', 'vo', 0, 6, 0),
+]
+
+# Commands that may be emitted for each frame, in emission order:
+# (ch, func, offset)
+_RAWSCO_NDF_SLOTS = [
+    ('ch', 'p1', 0),
+    ('p1', 'du', 0),
+    ('p1', 'vo', 0),
+    ('p1', 'tl', 2),
+    ('p1', 'th', 3),
+    ('ch', 'p2', 0),
+    ('p2', 'du', 0),
+    ('p2', 'vo', 0),
+    ('p2', 'tl', 2),
+    ('p2', 'th', 3),
+    ('ch', 'tr', 0),
+    ('tr', 'tl', 2),
+    ('tr', 'th', 3),
+    ('ch', 'no', 0),
+    ('no', 'vo', 0),
+    ('no', 'nl', 2),
+    ('no', 'np', 2),
+    ('no', 'll', 3),
+]
+
+
+def _frames_to_ndf_events(score):
+  # Which per-frame commands are emitted (nframes, nslots) and their values
+  nframes = score.shape[0]
+  score = score.astype(np.int64)
+  prev = np.zeros_like(score)
+  prev[1:] = score[:-1]
+
+  emit = []
+  vals = []
+
+  def onoff(on, on_prev):
+    emit.append(on != on_prev)
+    vals.append(on.astype(np.int64))
+
+  def changed(val, val_prev, cond=None):
+    e = val != val_prev
+    emit.append(e if cond is None else np.logical_and(cond, e))
+    vals.append(val)
+
+  # NOTE: This will never be perfect reconstruction because phase is not incremented when the channel is off
+  for j in [0, 1]:
+    th, tl, volume, du = [score[:, j, k] for k in xrange(4)]
+    th_prev, tl_prev, volume_prev, du_prev = [prev[:, j, k] for k in xrange(4)]
+    timer = (th << 8) + tl
+    timer_prev = (th_prev << 8) + tl_prev
+    retrigger = np.logical_and(timer_prev == 0, timer != 0)
+
+    onoff(timer != 0, timer_prev != 0)
+    changed(du, du_prev)
+    changed(volume, volume_prev, volume > 0)
+    changed(tl, tl_prev)
+    emit.append(np.logical_or(retrigger, th != th_prev))
+    vals.append(th)
+
+  th, tl = score[:, 2, 0], score[:, 2, 1]
+  timer = (th << 8) + tl
+  timer_prev = (prev[:, 2, 0] << 8) + prev[:, 2, 1]
+  onoff(timer != 0, timer_prev != 0)
+  tr_changed = timer != timer_prev
+  emit.extend([tr_changed, tr_changed])
+  vals.extend([tl, th])
+
+  _, np_, volume, nl = [score[:, 3, k] for k in xrange(4)]
+  _, np_prev, volume_prev, nl_prev = [prev[:, 3, k] for k in xrange(4)]
+  onoff(np_ != 0, np_prev != 0)
+  changed(volume, volume_prev, volume > 0)
+  changed(nl, nl_prev)
+  np_changed = np.logical_and(np_ > 0, np_ != np_prev)
+  emit.append(np_changed)
+  vals.append(16 - np_)
+  emit.append(np_changed)
+  vals.append(np.zeros(nframes, dtype=np.int64))
+
+  return np.stack(emit, axis=1), np.stack(vals, axis=1)
 
 
 def rawsco_to_ndf(rawsco):
+  """Synthesizes NDF commands reproducing a raw score.
+
+  Each frame emits the commands for state that changed since the previous
+  frame followed by a wait; consecutive waits are merged.
+  """
   clock, rate, nsamps, score = rawsco
+  nframes = score.shape[0]
 
+  # Samples to wait after each frame
   if rate == 44100:
-    ar = True
+    ends = np.arange(1, nframes + 1, dtype=np.int64)
   else:
-    ar = False
-
-  max_i = score.shape[0]
-
-  samp = 0
-  t = 0.
-  # ('apu', ch, func, func_val, natoms, offset)
-  ndf = [
-      ('clock', int(clock)),
-      ('apu', 'ch', 'p1', 0, 0, 0),
-      ('apu', 'ch', 'p2', 0, 0, 0),
-      ('apu', 'ch', 'tr', 0, 0, 0),
-      ('apu', 'ch', 'no', 0, 0, 0),
-      ('apu', 'p1', 'du', 0, 1, 0),
-      ('apu', 'p1', 'lh', 1, 1, 0),
-      ('apu', 'p1', 'cv', 1, 1, 0),
-      ('apu', 'p1', 'vo', 0, 1, 0),
-      ('apu', 'p1', 'ss', 7, 2, 1), # This is necessary to prevent channel silence for low notes
-      ('apu', 'p2', 'du', 0, 3, 0),
-      ('apu', 'p2', 'lh', 1, 3, 0),
-      ('apu', 'p2', 'cv', 1, 3, 0),
-      ('apu', 'p2', 'vo', 0, 3, 0),
-      ('apu', 'p2', 'ss', 7, 4, 1), # This is necessary to prevent channel silence for low notes
-      ('apu', 'tr', 'lh', 1, 5, 0),
-      ('apu', 'tr', 'lr', 127, 5, 0),
-      ('apu', 'no', 'lh', 1, 6, 0),
-      ('apu', 'no', 'cv', 1, 6, 0),
-      ('apu', 'no', 'vo', 0, 6, 0),
-  ]
-  ch_to_last_tl = {ch:0 for ch in ['p1', 'p2']}
-  ch_to_last_th = {ch:0 for ch in ['p1', 'p2']}
-  ch_to_last_timer = {ch:0 for ch in ['p1', 'p2', 'tr']}
-  ch_to_last_du = {ch:0 for ch in ['p1', 'p2']}
-  ch_to_last_volume = {ch:0 for ch in ['p1', 'p2', 'no']}
-  last_no_np = 0
-  last_no_nl = 0
-
-  for i in xrange(max_i):
-    for j, ch in enumerate(['p1', 'p2']):
-      th, tl, volume, du = score[i, j]
-      timer = (th << 8) + tl
-      last_timer = ch_to_last_timer[ch]
-
-      # NOTE: This will never be perfect reconstruction because phase is not incremented when the channel is off
-      retrigger = False
-      if last_timer == 0 and timer != 0:
-        ndf.append(('apu', 'ch', ch, 1, 0, 0))
-        retrigger = True
-      elif last_timer != 0 and timer == 0:
-        ndf.append(('apu', 'ch', ch, 0, 0, 0))
-
-      if du != ch_to_last_du[ch]:
-        ndf.append(('apu', ch, 'du', du, 0, 0))
-        ch_to_last_du[ch] = du
-
-      if volume > 0 and volume != ch_to_last_volume[ch]:
-        ndf.append(('apu', ch, 'vo', volume, 0, 0))
-      ch_to_last_volume[ch] = volume
-
-      if tl != ch_to_last_tl[ch]:
-        ndf.append(('apu', ch, 'tl', tl, 0, 2))
-        ch_to_last_tl[ch] = tl
-      if retrigger or th != ch_to_last_th[ch]:
-        ndf.append(('apu', ch, 'th', th, 0, 3))
-        ch_to_last_th[ch] = th
-
-      ch_to_last_timer[ch] = timer
-
-    j = 2
-    ch = 'tr'
-    th, tl, _, _ = score[i, j]
-    timer = (th << 8) + tl
-    last_timer = ch_to_last_timer[ch]
-    if last_timer == 0 and timer != 0:
-      ndf.append(('apu', 'ch', ch, 1, 0, 0))
-    elif last_timer != 0 and timer == 0:
-      ndf.append(('apu', 'ch', ch, 0, 0, 0))
-    if timer != last_timer:
-      ndf.append(('apu', ch, 'tl', tl, 0, 2))
-      ndf.append(('apu', ch, 'th', th, 0, 3))
-    ch_to_last_timer[ch] = timer
-
-    j = 3
-    ch = 'no'
-    _, np, volume, nl = score[i, j]
-    if last_no_np == 0 and np != 0:
-      ndf.append(('apu', 'ch', ch, 1, 0, 0))
-    elif last_no_np != 0 and np == 0:
-      ndf.append(('apu', 'ch', ch, 0, 0, 0))
-    if volume > 0 and volume != ch_to_last_volume[ch]:
-      ndf.append(('apu', ch, 'vo', volume, 0, 0))
-    ch_to_last_volume[ch] = volume
-    if nl != last_no_nl:
-      ndf.append(('apu', ch, 'nl', nl, 0, 2))
-      last_no_nl = nl
-    if np > 0 and np != last_no_np:
-      ndf.append(('apu', ch, 'np', 16 - np, 0, 2))
-      ndf.append(('apu', ch, 'll', 0, 0, 3))
-    last_no_np = np
-
-    if ar:
-      wait_amt = 1
+    # Accumulate frame periods sequentially as a per-frame loop would
+    t = np.cumsum(np.full(nframes, 1. / rate))
+    ends = np.minimum((fs * t).astype(np.int64), nsamps)
+  assert nframes == 0 or ends[-1] <= nsamps
+
+  emit, vals = _frames_to_ndf_events(score)
+
+  # Each frame's wait lasts until the next frame with commands (or the end)
+  has_comms = np.any(emit, axis=1)
+  wait_emit = np.ones(nframes, dtype=np.bool_)
+  wait_emit[:-1] = has_comms[1:]
+  wait_ends = np.where(wait_emit)[0]
+  wait_amts = np.diff(np.concatenate([[0], ends[wait_ends]]))
+  if nframes > 0:
+    wait_amts[-1] += nsamps - ends[-1]
+  waits = np.zeros(nframes, dtype=np.int64)
+  waits[wait_ends] = wait_amts
+
+  # Flatten (frame, slot) in emission order; the wait is the last slot
+  emit = np.concatenate([emit, wait_emit[:, np.newaxis]], axis=1)
+  vals = np.concatenate([vals, waits[:, np.newaxis]], axis=1)
+  slot = np.tile(np.arange(emit.shape[1]), nframes)[emit.ravel()]
+  val = vals.ravel()[emit.ravel()]
+
+  slots = _RAWSCO_NDF_SLOTS + [None]
+  ndf = [('clock', int(clock))] + list(_RAWSCO_NDF_HEADER)
+  for s, v in zip(slot.tolist(), val.tolist()):
+    if slots[s] is None:
+      ndf.append(('wait', v))
     else:
-      t += 1. / rate
-      wait_amt = min(int(fs * t) - samp, nsamps - samp)
-
-    ndf.append(('wait', wait_amt))
-    samp += wait_amt
+      ch, fu, offset = slots[s]
+      ndf.append(('apu', ch, fu, v, 0, offset))
 
-  remaining = nsamps - samp
-  assert remaining >= 0
-  if remaining > 0:
-    ndf.append(('wait', remaining))
+  if nframes == 0 and nsamps > 0:
+    ndf.append(('wait', nsamps))
 
   return ndf
@@ -0,0 +1,506 @@
+import numpy as np
+from scipy.signal import lfilter, lfilter_zi
+
+import nesmdb.apu
+from nesmdb.vgm.nd_array import ND_WAIT, ND_APU, ffill_idx
+from nesmdb.vgm.ndr_ndf import ndf_to_ndr
+
+
+# Register-level NES APU synthesizer
+#
+# Emulates the pulse, triangle, noise and DMC channels from the NDR register
+# writes. Length counters, envelopes, sweeps and the triangle linear counter
+# are clocked by a frame counter running in CPU cycles (and reset by $4017
+# writes), and the DMC plays the samples loaded by VGM RAM writes. Waveforms
+# are rendered by averaging each sequencer over the span of every output
+# sample. The emulation follows https://wiki.nesdev.com/w/index.php/APU and is
+# tested against the analytic behaviour of each channel, but it has not been
+# validated against vgm2wav, which remains the default renderer of
+# nesmdb.vgm.vgm_to_wav.
+
+
+fs = 44100.
+
+
+def _noise_table(tap):
+  # Noise output (1 while shift register bit 0 is clear) over one period
+  reg = 1
+  out = []
+  while True:
+    out.append(1 - (reg & 1))
+    feedback = (reg & 1) ^ ((reg >> tap) & 1)
+    reg = (reg >> 1) | (feedback << 14)
+    if reg == 1:
+      break
+  return out
+
+
+_PULSE_TABLES = np.array(nesmdb.apu.pulse_duty_table, dtype=np.float64)
+_TRIANGLE_TABLES = np.array([nesmdb.apu.triangle_table], dtype=np.float64)
+_NOISE_LONG_TABLES = np.array([_noise_table(1)], dtype=np.float64)
+_NOISE_SHORT_TABLES = np.array([_noise_table(6)], dtype=np.float64)
+
+
+class _APU(object):
+  # 2A03 state machine. Times are in CPU cycles; state() describes the
+  # channels until the next write or frame counter clock.
+
+  def __init__(self, clock):
+    ntsc = abs(clock - nesmdb.apu.ntsc_clock) < 2
+    self.fc_cycles = clock / (240. if ntsc else 200.)
+    self.dm_rates = nesmdb.apu.dmc_rate_table_ntsc if ntsc else nesmdb.apu.dmc_rate_table_pal
+
+    # Channels are enabled after reset (as in VGMPlay)
+    # Per-channel lists are indexed p1, p2, tr, no
+    self.enabled = [True] * 4
+    self.length = [0] * 4
+    self.halt = [0] * 4
+    self.timer = [0] * 3
+
+    # Envelopes are indexed p1, p2, no
+    self.const = [0] * 3
+    self.vol = [0] * 3
+    self.env_start = [False] * 3
+    self.env_div = [0] * 3
+    self.env_decay = [0] * 3
+
+    self.duty = [0] * 2
+    self.restart = [False] * 2
+    self.swe_enable = [0] * 2
+    self.swe_period = [0] * 2
+    self.swe_negate = [0] * 2
+    self.swe_shift = [0] * 2
+    self.swe_div = [0] * 2
+    self.swe_reload = [False] * 2
+
+    self.tr_linear = 0
+    self.tr_linear_load = 0
+    self.tr_reload = False
+
+    self.no_mode = 0
+    self.no_period = 0
+
+    self.fc_steps = 4
+    self.fc_step = 1
+    self.fc_next = self.fc_cycles
+
+    self.mem = bytearray(0x10000)
+    self.dm_rate = self.dm_rates[0]
+    self.dm_loop = 0
+    self.dm_addr_load = 0xc000
+    self.dm_length_load = 1
+    self.dm_addr = 0xc000
+    self.dm_remaining = 0
+    self.dm_buffer = -1
+    self.dm_shift = 0
+    self.dm_bits = 8
+    self.dm_silence = True
+    self.dm_level = 0
+    self.dm_next = float(self.dm_rate)
+    self.dm_changes = []
+
+  def _sweep_target(self, i):
+    change = self.timer[i] >> self.swe_shift[i]
+    if self.swe_negate[i]:
+      # Pulse 1 negates with ones' complement
+      return self.timer[i] - change - (1 if i == 0 else 0)
+    return self.timer[i] + change
+
+  def _sweep_muted(self, i):
+    return self.timer[i] < 8 or self._sweep_target(i) > 0x7ff
+
+  def _quarter_frame(self):
+    for i, ch in enumerate([0, 1, 3]):
+      if self.env_start[i]:
+        self.env_start[i] = False
+        self.env_decay[i] = 15
+        self.env_div[i] = self.vol[i]
+      elif self.env_div[i] == 0:
+        self.env_div[i] = self.vol[i]
+        if self.env_decay[i] > 0:
+          self.env_decay[i] -= 1
+        elif self.halt[ch]:
+          self.env_decay[i] = 15
+      else:
+        self.env_div[i] -= 1
+
+    if self.tr_reload:
+      self.tr_linear = self.tr_linear_load
+    elif self.tr_linear > 0:
+      self.tr_linear -= 1
+    if not self.halt[2]:
+      self.tr_reload = False
+
+  def _half_frame(self):
+    for ch in xrange(4):
+      if not self.halt[ch] and self.length[ch] > 0:
+        self.length[ch] -= 1
+
+    for i in xrange(2):
+      if (self.swe_div[i] == 0 and self.swe_enable[i] and self.swe_shift[i] > 0
+          and not self._sweep_muted(i)):
+        self.timer[i] = self._sweep_target(i)
+      if self.swe_div[i] == 0 or self.swe_reload[i]:
+        self.swe_div[i] = self.swe_period[i]
+        self.swe_reload[i] = False
+      else:
+        self.swe_div[i] -= 1
+
+  def _frame_step(self):
+    step = self.fc_step
+    if step < 4:
+      self._quarter_frame()
+      if step == 0 or step == 2:
+        self._half_frame()
+    self.fc_step = (step + 1) % self.fc_steps
+
+  def frame_tick(self):
+    # Clocks the frame counter at fc_next
+    self.dmc_run(self.fc_next)
+    self._frame_step()
+    self.fc_next += self.fc_cycles
+
+  def _dmc_fetch(self):
+    if self.dm_buffer < 0 and self.dm_remaining > 0:
+      self.dm_buffer = self.mem[self.dm_addr]
+      self.dm_addr = self.dm_addr + 1 if self.dm_addr < 0xffff else 0x8000
+      self.dm_remaining -= 1
+      if self.dm_remaining == 0 and self.dm_loop:
+        self.dm_addr = self.dm_addr_load
+        self.dm_remaining = self.dm_length_load
+
+  def dmc_run(self, t):
+    # Clocks the DMC output unit up to time t, recording level changes
+    while self.dm_next <= t:
+      if self.dm_silence and self.dm_buffer < 0 and self.dm_remaining == 0:
+        # Nothing to play until the next write
+        n = int((t - self.dm_next) // self.dm_rate) + 1
+        self.dm_next += n * self.dm_rate
+        self.dm_bits = (self.dm_bits - 1 - n) % 8 + 1
+        break
+
+      if not self.dm_silence:
+        level = self.dm_level
+        if self.dm_shift & 1:
+          if level <= 125:
+            level += 2
+        elif level >= 2:
+          level -= 2
+        if level != self.dm_level:
+          self.dm_level = level
+          self.dm_changes.append((self.dm_next, level))
+        self.dm_shift >>= 1
+
+      self.dm_bits -= 1
+      if self.dm_bits == 0:
+        self.dm_bits = 8
+        if self.dm_buffer < 0:
+          self.dm_silence = True
+        else:
+          self.dm_silence = False
+          self.dm_shift = self.dm_buffer
+          self.dm_buffer = -1
+          self._dmc_fetch()
+
+      self.dm_next += self.dm_rate
+
+  def ram_write(self, data, t):
+    # VGM RAM data blocks start with a 16-bit address
+    self.dmc_run(t)
+    data = bytearray(data)
+    addr = data[0] | (data[1] << 8)
+    data = data[2:]
+    end = min(addr + len(data), 0x10000)
+    self.mem[addr:end] = data[:end - addr]
+
+  def write(self, addr, val, t):
+    self.dmc_run(t)
+
+    if addr < 0x08:
+      i = addr >> 2
+      reg = addr & 3
+      if reg == 0:
+        self.duty[i] = val >> 6
+        self.halt[i] = (val >> 5) & 1
+        self.const[i] = (val >> 4) & 1
+        self.vol[i] = val & 0xf
+      elif reg == 1:
+        self.swe_enable[i] = val >> 7
+        self.swe_period[i] = (val >> 4) & 7
+        self.swe_negate[i] = (val >> 3) & 1
+        self.swe_shift[i] = val & 7
+        self.swe_reload[i] = True
+      elif reg == 2:
+        self.timer[i] = (self.timer[i] & 0x700) | val
+      else:
+        self.timer[i] = (self.timer[i] & 0xff) | ((val & 7) << 8)
+        if self.enabled[i]:
+          self.length[i] = nesmdb.apu.length_counter_table[val >> 3]
+        self.env_start[i] = True
+        self.restart[i] = True
+    elif addr == 0x08:
+      self.halt[2] = val >> 7
+      self.tr_linear_load = val & 0x7f
+    elif addr == 0x0a:
+      self.timer[2] = (self.timer[2] & 0x700) | val
+    elif addr == 0x0b:
+      self.timer[2] = (self.timer[2] & 0xff) | ((val & 7) << 8)
+      if self.enabled[2]:
+        self.length[2] = nesmdb.apu.length_counter_table[val >> 3]
+      self.tr_reload = True
+    elif addr == 0x0c:
+      self.halt[3] = (val >> 5) & 1
+      self.const[2] = (val >> 4) & 1
+      self.vol[2] = val & 0xf
+    elif addr == 0x0e:
+      self.no_mode = val >> 7
+      self.no_period = val & 0xf
+    elif addr == 0x0f:
+      if self.enabled[3]:
+        self.length[3] = nesmdb.apu.length_counter_table[val >> 3]
+      self.env_start[2] = True
+    elif addr == 0x10:
+      self.dm_loop = (val >> 6) & 1
+      self.dm_rate = self.dm_rates[val & 0xf]
+    elif addr == 0x11:
+      self.dm_level = val & 0x7f
+      self.dm_changes.append((t, self.dm_level))
+    elif addr == 0x12:
+      self.dm_addr_load = 0xc000 + val * 64
+    elif addr == 0x13:
+      self.dm_length_load = val * 16 + 1
+    elif addr == 0x15:
+      for ch in xrange(4):
+        self.enabled[ch] = bool((val >> ch) & 1)
+        if not self.enabled[ch]:
+          self.length[ch] = 0
+      if val & 0x10:
+        if self.dm_remaining == 0:
+          self.dm_addr = self.dm_addr_load
+          self.dm_remaining = self.dm_length_load
+          self._dmc_fetch()
+      else:
+        self.dm_remaining = 0
+    elif addr == 0x17:
+      # Resets the frame counter (5-step mode clocks everything right away)
+      self.fc_next = t + self.fc_cycles
+      if val & 0x80:
+        self.fc_steps = 5
+        self.fc_step = 0
+        self._frame_step()
+      else:
+        self.fc_steps = 4
+        self.fc_step = 1
+
+  def state(self):
+    # (pulse timer, duty, volume, restarted) x2, triangle timer and whether
+    # its sequencer runs, noise period, mode and volume
+    state = []
+    for i in xrange(2):
+      vol = 0
+      if self.length[i] > 0 and not self._sweep_muted(i):
+        vol = self.vol[i] if self.const[i] else self.env_decay[i]
+      state.extend([self.timer[i], self.duty[i], vol, int(self.restart[i])])
+      self.restart[i] = False
+
+    state.append(self.timer[2])
+    state.append(int(self.length[2] > 0 and self.tr_linear > 0))
+
+    vol = 0
+    if self.length[3] > 0:
+      vol = self.vol[2] if self.const[2] else self.env_decay[2]
+    state.extend([self.no_period, self.no_mode, vol])
+
+    return state
+
+
+def _ndr_writes(ndr):
+  # Returns clock, total samples and the writes (sample, register, value) in
+  # order, where RAM writes have register None and their data as value
+  if isinstance(ndr, np.ndarray):
+    clock = float(ndr[0]['val'])
+    ndr = ndr[1:]
+
+    comm = ndr['comm']
+    waits = np.where(comm == ND_WAIT, ndr['val'], 0).astype(np.int64)
+    samps = np.cumsum(waits) - waits
+    apu = comm == ND_APU
+    addrs = nesmdb.apu.ch_base_table[ndr['ch'][apu].astype(np.int64)] + ndr['offset'][apu]
+    writes = zip(samps[apu].tolist(), addrs.tolist(), ndr['val'][apu].tolist())
+
+    return clock, int(np.sum(waits)), writes
+
+  clock = float(ndr[0][1])
+  nsamps = 0
+  writes = []
+  for comm in ndr[1:]:
+    if comm[0] == 'wait':
+      nsamps += comm[1]
+    elif comm[0] == 'apu':
+      writes.append((nsamps, int(comm[1], 16), int(comm[2], 16)))
+    elif comm[0] == 'ram':
+      writes.append((nsamps, None, comm[2]))
+    else:
+      raise NotImplementedError()
+
+  return clock, nsamps, writes
+
+
+def _samp_at(t, cycles_per_samp):
+  # First sample starting at or after time t (writes land on their own sample)
+  return int(np.ceil(t / cycles_per_samp - 1e-6))
+
+
+def _ndr_to_runs(ndr):
+  # Emulates the APU, returning channel state at every sample where it may
+  # change and the DMC output level changes
+  clock, nsamps, writes = _ndr_writes(ndr)
+  cycles_per_samp = clock / fs
+  t_end = nsamps * cycles_per_samp
+
+  apu = _APU(clock)
+  run_starts = []
+  run_states = []
+  i = 0
+  while True:
+    # Writes happen at the start of their sample, frame counter clocks in
+    # between samples
+    if i < len(writes) and writes[i][0] * cycles_per_samp < apu.fc_next:
+      samp, addr, val = writes[i]
+      t = samp * cycles_per_samp
+      if addr is None:
+        apu.ram_write(val, t)
+      else:
+        apu.write(addr, val, t)
+      i += 1
+    elif apu.fc_next < t_end:
+      samp = _samp_at(apu.fc_next, cycles_per_samp)
+      apu.frame_tick()
+    else:
+      break
+
+    if samp >= nsamps:
+      continue
+    state = apu.state()
+    if len(run_starts) > 0 and run_starts[-1] == samp:
+      # Keep sequencer restarts from earlier writes in the same sample
+      for k in [3, 7]:
+        state[k] |= run_states[-1][k]
+      run_states[-1] = state
+    else:
+      run_starts.append(samp)
+      run_states.append(state)
+  apu.dmc_run(t_end)
+
+  if len(run_starts) == 0 or run_starts[0] > 0:
+    run_starts.insert(0, 0)
+    run_states.insert(0, _APU(clock).state())
+
+  # DMC level changes take effect from the next sample (level starts at 0)
+  dm_changes = [(0., 0)] + apu.dm_changes
+  dm_samps = np.array([_samp_at(t, cycles_per_samp) for t, _ in dm_changes], dtype=np.int64)
+  dm_levels = np.array([level for _, level in dm_changes], dtype=np.float64)
+
+  return (clock, nsamps,
+      np.array(run_starts, dtype=np.int64), np.array(run_states, dtype=np.int64),
+      dm_samps, dm_levels)
+
+
+def _integrate(tables, cums, sel, x):
+  # Integral from 0 to x of the periodic step function tables[sel]
+  n = tables.shape[1]
+  i = np.floor(x)
+  k = i.astype(np.int64) % n
+  return np.floor(i / n) * cums[sel, -1] + cums[sel, k] + (x - i) * tables[sel, k]
+
+
+def _box(tables, sel, phase, inc):
+  # Average of tables[sel] over the sequencer steps covered by each sample,
+  # which band-limits the waveform enough to avoid most aliasing
+  cums = np.zeros((tables.shape[0], tables.shape[1] + 1), dtype=np.float64)
+  cums[:, 1:] = np.cumsum(tables, axis=1)
+
+  moving = inc > 0
+  inc_safe = np.where(moving, inc, 1.)
+  area = _integrate(tables, cums, sel, phase + inc_safe) - _integrate(tables, cums, sel, phase)
+  held = tables[sel, np.floor(phase).astype(np.int64) % tables.shape[1]]
+  return np.where(moving, area / inc_safe, held)
+
+
+def _run_phases(run_incs, run_lens, run_restarts):
+  # Sequencer position at the start of each run (continuous unless the run
+  # restarts the sequencer)
+  steps = run_incs * run_lens[:, np.newaxis]
+  run_phases = np.cumsum(steps, axis=0) - steps
+  for c in xrange(run_phases.shape[1]):
+    restart = ffill_idx(run_restarts[:, c])
+    run_phases[:, c] -= np.where(restart >= 0, run_phases[np.maximum(restart, 0), c], 0.)
+  return run_phases
+
+
+def ndr_to_wav(ndr, block_size=65536):
+  """Renders NDR (list or array) to float32 audio at 44.1 kHz.
+
+  Arrays carry no RAM writes, so their DMC only plays zeros.
+  """
+  clock, nsamps, run_starts, run_states, dm_samps, dm_levels = _ndr_to_runs(ndr)
+
+  if abs(clock - nesmdb.apu.ntsc_clock) < 2:
+    noise_periods = np.array(nesmdb.apu.noise_period_table_ntsc, dtype=np.float64)
+  else:
+    noise_periods = np.array(nesmdb.apu.noise_period_table_pal, dtype=np.float64)
+
+  run_lens = (np.append(run_starts[1:], nsamps) - run_starts).astype(np.float64)
+  timer = run_states[:, [0, 4, 8]]
+  duty = run_states[:, [1, 5]]
+  vol = run_states[:, [2, 6, 12]].astype(np.float64)
+  tr_on = run_states[:, 9] > 0
+  no_period = run_states[:, 10]
+  no_mode = run_states[:, 11]
+
+  # Sequencer steps per sample for p1, p2, tr, no
+  run_incs = np.zeros((run_states.shape[0], 4), dtype=np.float64)
+  run_incs[:, :2] = clock / (2. * (timer[:, :2] + 1))
+  run_incs[:, 2] = np.where(tr_on, clock / (timer[:, 2] + 1.), 0.)
+  run_incs[:, 3] = clock / noise_periods[no_period]
+  run_incs /= fs
+  run_restarts = np.zeros_like(run_incs, dtype=np.bool_)
+  run_restarts[:, :2] = run_states[:, [3, 7]] > 0
+  run_phases = _run_phases(run_incs, run_lens, run_restarts)
+
+  wav = np.zeros(nsamps, dtype=np.float64)
+  for samp in xrange(0, nsamps, block_size):
+    samps = np.arange(samp, min(samp + block_size, nsamps))
+    runs = np.searchsorted(run_starts, samps, side='right') - 1
+    incs = run_incs[runs]
+    phases = run_phases[runs] + incs * (samps - run_starts[runs])[:, np.newaxis]
+    vols = vol[runs]
+
+    # Channel outputs in DAC units (0-15, DMC 0-127)
+    p1 = vols[:, 0] * _box(_PULSE_TABLES, duty[runs, 0], phases[:, 0], incs[:, 0])
+    p2 = vols[:, 1] * _box(_PULSE_TABLES, duty[runs, 1], phases[:, 1], incs[:, 1])
+    tr = _box(_TRIANGLE_TABLES, 0, phases[:, 2], incs[:, 2])
+    no = np.where(
+        no_mode[runs] == 1,
+        _box(_NOISE_SHORT_TABLES, 0, phases[:, 3], incs[:, 3]),
+        _box(_NOISE_LONG_TABLES, 0, phases[:, 3], incs[:, 3]))
+    no *= vols[:, 2]
+    dm = dm_levels[np.searchsorted(dm_samps, samps, side='right') - 1]
+
+    # Nonlinear mixer
+    # https://wiki.nesdev.com/w/index.php/APU_Mixer
+    pulse = p1 + p2
+    tnd = (tr / 8227.) + (no / 12241.) + (dm / 22638.)
+    wav[samp:samp + samps.shape[0]] = (95.88 * pulse) / (8128. + 100. * pulse) + (159.79 * tnd) / (1. + 100. * tnd)
+
+  # Output high-pass (removes DC offset, starting from the initial level)
+  rc = 1. / (2. * np.pi * 90.)
+  a = rc / (rc + (1. / fs))
+  if nsamps > 0:
+    wav, _ = lfilter([a, -a], [1., -a], wav, zi=lfilter_zi([a, -a], [1., -a]) * wav[0])
+
+  return wav.astype(np.float32)
+
+
+def ndf_to_wav(ndf):
+  return ndr_to_wav(ndf_to_ndr(ndf))
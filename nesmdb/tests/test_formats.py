@@ -1,13 +1,46 @@
+import contextlib
 import glob
+import io
 import os
+import shutil
+import struct
+import tempfile
 from unittest import TestCase
 
+import numpy as np
+
 from nesmdb.vgm import vgm_simplify, vgm_shorten
+import nesmdb.convert
 import nesmdb.cycle
+import nesmdb.score
+import nesmdb.vgm
 
 _TEST_DIR = os.path.dirname(os.path.abspath(__file__))
 _EXAMPLE_VGMS = sorted(glob.glob(os.path.join(_TEST_DIR, 'data', '*.vgm')))
 
+
+@contextlib.contextmanager
+def _temp_dir():
+  # Yields a scratch directory that is removed afterwards
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    yield tmp_dir
+  finally:
+    shutil.rmtree(tmp_dir)
+
+
+def _convert_main(argv):
+  # Runs the nesmdb_convert CLI and returns what it printed
+  import sys
+  stdout, stderr = sys.stdout, sys.stderr
+  sys.stdout, sys.stderr = io.BytesIO(), io.BytesIO()
+  try:
+    nesmdb.convert.main(argv)
+    return sys.stdout.getvalue()
+  finally:
+    sys.stdout, sys.stderr = stdout, stderr
+
+
 class TestFormats(TestCase):
   @classmethod
   def setUpClass(cls):
@@ -39,6 +72,18 @@ class TestFormats(TestCase):
     # Make sure we have deleted the right number of commands
     self.assertListEqual(delcmds, [5, 5, 4, 4, 5])
 
+    # Make sure deletion stats agree with the count (data blocks and APU writes)
+    for vgm, delcmd in zip(self.vgms_full, delcmds):
+      _, _, stats = vgm_simplify(vgm, return_stats=True)
+      self.assertEqual(stats['opcode'].get('67', 0) + stats['opcode'].get('b4', 0), delcmd)
+      self.assertDictEqual(stats['channel'], {'dm': delcmd})
+
+    # Make sure expansion chip writes are only counted in the stats
+    vgm = self.vgms_full[3]
+    _, delcmd, stats = vgm_simplify(vgm[:0xc0] + '\x54\x00\x00' + vgm[0xc0:], return_stats=True)
+    self.assertEqual(delcmd, delcmds[3])
+    self.assertEqual(stats['opcode']['54'], 1)
+
     # Make sure simplified lengths are correct
     self.assertListEqual(
         [len(v) for v in vgms_simple],
@@ -55,6 +100,664 @@ class TestFormats(TestCase):
         [3193, 3193, 1756, 1192, 3193])
 
 
+  def test_apu_tables(self):
+    import nesmdb.apu
+
+    # Make sure decoding a write and re-encoding its functions is lossless
+    for addr, (ch, offset, decoded) in nesmdb.apu.register_decode_table.items():
+      i = nesmdb.apu.channels.index(ch)
+      self.assertEqual(nesmdb.apu.addr_ch_table[addr], i)
+      for val in xrange(256):
+        byte = 0
+        for k, (fu, fu_val) in enumerate(decoded[val]):
+          j = nesmdb.apu.channel_functions[i].index(fu)
+          self.assertEqual(nesmdb.apu.register_funcs_table[i, offset, k], j)
+          self.assertEqual(nesmdb.apu.register_values_table[i, offset, val, k], fu_val)
+          self.assertLess(fu_val, nesmdb.apu.func_to_max(ch, fu))
+          byte |= nesmdb.apu.func_encode_table[i, j, fu_val]
+        used = sum([mask for _, mask in nesmdb.apu.register_function_bitmasks[ch][offset]])
+        self.assertEqual(byte, val & used)
+
+
+  def test_nd_array(self):
+    for vgm in self.vgms:
+      ndr = nesmdb.vgm.vgm_to_ndr(vgm)
+      ndf = nesmdb.vgm.ndr_to_ndf(ndr)
+      nlm = nesmdb.vgm.ndf_to_nlm(ndf)
+
+      # Make sure array NDR matches tuple NDR
+      ndr_arr = nesmdb.vgm.vgm_to_ndr(vgm, as_array=True)
+      self.assertEqual(ndr_arr.dtype.itemsize, 10)
+      self.assertListEqual(nesmdb.vgm.array_to_ndr(ndr_arr), ndr)
+      self.assertEqual(nesmdb.vgm.ndr_to_array(ndr).tobytes(), ndr_arr.tobytes())
+
+      # Make sure array conversions match tuple conversions
+      ndf_arr = nesmdb.vgm.ndr_to_ndf(ndr_arr)
+      self.assertListEqual(nesmdb.vgm.array_to_ndf(ndf_arr), ndf)
+      nlm_arr = nesmdb.vgm.ndf_to_nlm(ndf_arr)
+      self.assertListEqual(nesmdb.vgm.array_to_nlm(nlm_arr), nlm)
+      ndf_arr = nesmdb.vgm.nlm_to_ndf(nlm_arr)
+      self.assertListEqual(nesmdb.vgm.array_to_ndf(ndf_arr), nesmdb.vgm.nlm_to_ndf(nlm))
+      ndr_arr = nesmdb.vgm.ndf_to_ndr(ndf_arr)
+      self.assertListEqual(nesmdb.vgm.array_to_ndr(ndr_arr), nesmdb.vgm.ndf_to_ndr(nesmdb.vgm.nlm_to_ndf(nlm)))
+
+      _, _, _, rawsco = nesmdb.score.ndf_to_rawsco(ndf)
+      _, _, _, rawsco_arr = nesmdb.score.ndf_to_rawsco(nesmdb.vgm.ndf_to_array(ndf))
+      self.assertTrue(np.array_equal(rawsco, rawsco_arr))
+
+
+  def test_ndr_to_vgm(self):
+    vgms_ndr = []
+    for vgm in self.vgms:
+      ndr = nesmdb.vgm.vgm_to_ndr(vgm)
+      vgm_ndr = nesmdb.vgm.ndr_to_vgm(ndr)
+      vgms_ndr.append(vgm_ndr)
+
+      # Make sure streamed output matches in-memory output
+      f = io.BytesIO()
+      nesmdb.vgm.ndr_to_vgm_file(ndr, f, chunk_size=100)
+      self.assertEqual(f.getvalue(), vgm_ndr)
+
+      # Make sure compact waits are shorter and decode to the same NDR
+      vgm_compact = nesmdb.vgm.ndr_to_vgm(ndr, compact_waits=True)
+      self.assertLess(len(vgm_compact), len(vgm_ndr))
+      self.assertListEqual(nesmdb.vgm.vgm_to_ndr(vgm_compact), ndr)
+
+    # Make sure output lengths are correct
+    self.assertListEqual(
+        [len(v) for v in vgms_ndr],
+        [97006, 105598, 2956, 2392, 104365])
+
+    # Make sure output is byte-identical to the original writer
+    import hashlib
+    self.assertListEqual(
+        [hashlib.sha1(v).hexdigest() for v in vgms_ndr],
+        ['16a976fbc89911f2f5da3554a86060129ae663ee',
+         '4f96d05e8a117a998035192d6f2b054907c9854b',
+         '8ac49b2148897b72bbe6f2012a96014496cb08c0',
+         '008578b42752101416e0ddd8e8084fbbbbb35614',
+         '91a9ee6f7a6d9a9056c34c3c6e628723d33ba53b'])
+
+
+  def test_vgm_index(self):
+    for vgm in self.vgms:
+      ndr = nesmdb.vgm.vgm_to_ndr(vgm)
+      for src in [vgm, nesmdb.vgm.ndr_to_vgm(ndr)]:
+        index = nesmdb.vgm.VGMIndex(src)
+        self.assertEqual(len(index), len(ndr) - 1)
+
+        # Make sure slices match re-serialized NDR slices
+        for start, stop in [(0, 100), (50, 450), (len(index) - 10, len(index) + 10)]:
+          self.assertEqual(index.slice(start, stop), nesmdb.vgm.ndr_to_vgm(ndr[:1] + ndr[1:][start:stop]))
+
+        # Make sure time slices keep the commands starting in the range
+        starts = index.samps[:-1]
+        sel = np.where((starts >= 22050) & (starts < 44100))[0]
+        self.assertEqual(index.slice_time(22050, 44100), index.slice(sel[0], sel[-1] + 1))
+
+
+  def test_nd_iter(self):
+    for vgm in self.vgms:
+      ndr = nesmdb.vgm.vgm_to_ndr(vgm)
+      ndf = nesmdb.vgm.ndr_to_ndf(ndr)
+      nlm = nesmdb.vgm.ndf_to_nlm(ndf)
+
+      # Make sure streaming conversions match list conversions
+      ndr_iter = nesmdb.vgm.vgm_to_ndr_iter(io.BytesIO(vgm), block_size=1000)
+      self.assertListEqual(list(ndr_iter), ndr)
+      nlm_iter = nesmdb.vgm.ndf_to_nlm_iter(nesmdb.vgm.ndr_to_ndf_iter(nesmdb.vgm.vgm_to_ndr_iter(vgm)))
+      self.assertListEqual(list(nlm_iter), nlm)
+      self.assertListEqual(list(nesmdb.vgm.vgm_to_ndr_iter(bytearray(vgm))), ndr)
+
+      # Make sure incremental text matches
+      f = io.BytesIO()
+      nesmdb.vgm.nd_to_txt_file(nesmdb.vgm.ndr_to_ndf_iter(ndr), f)
+      self.assertEqual(f.getvalue(), nesmdb.vgm.nd_to_txt(ndf))
+      f.seek(0)
+      self.assertListEqual(list(nesmdb.vgm.txt_to_nd_iter(f)), ndf)
+
+      # Make sure streamed NLM text reads back (as in the README example)
+      f = io.BytesIO()
+      nesmdb.vgm.nd_to_txt_file(nesmdb.vgm.ndf_to_nlm_iter(nesmdb.vgm.ndr_to_ndf_iter(nesmdb.vgm.vgm_to_ndr_iter(vgm))), f)
+      self.assertListEqual(nesmdb.vgm.txt_to_nd(f.getvalue()), nlm)
+
+      # Make sure streams with a wrong EOF offset are rejected
+      with self.assertRaises(Exception):
+        list(nesmdb.vgm.vgm_to_ndr_iter(io.BytesIO(vgm + '\x00'), block_size=1000))
+
+
+  def test_nlm_tokens(self):
+    nlms = []
+    for vgm in self.vgms:
+      nlm = nesmdb.vgm.ndf_to_nlm(nesmdb.vgm.ndr_to_ndf(nesmdb.vgm.vgm_to_ndr(vgm)))
+      nlms.append(nlm)
+
+      # Make sure tokenization is invertible at both levels
+      for level, wait_max in [('char', 1024), ('func', 1024), ('func', 100)]:
+        tokens = nesmdb.vgm.nlm_to_tokens(nlm, level=level, wait_max=wait_max)
+        self.assertLess(tokens.max(), len(nesmdb.vgm.nlm_vocab(level, wait_max)))
+        self.assertListEqual(nesmdb.vgm.tokens_to_nlm(tokens, level=level, wait_max=wait_max, clock=nlm[0][1]), nlm)
+
+    self.assertEqual(len(nesmdb.vgm.nlm_vocab('char')), 50)
+    vocab = nesmdb.vgm.nlm_vocab('char')
+    tokens = nesmdb.vgm.nlm_to_tokens([('clock', 1789773), ('tr_tl', 172), ('w', 13)])
+    self.assertListEqual([vocab[t] for t in tokens], ['<sos>', 'tr_tl', '1', '7', '2', 'w', '1', '3', '<sos>'])
+
+    # Make sure packed corpus returns the same tokens
+    with _temp_dir() as corpus_dir:
+      nesmdb.vgm.write_nlm_corpus(corpus_dir, enumerate(nlms), level='func')
+      corpus = nesmdb.vgm.NLMCorpus(corpus_dir)
+      self.assertEqual(len(corpus), len(nlms))
+      self.assertEqual(corpus.tokens.dtype, np.uint16)
+      self.assertEqual(corpus.tokens.shape[0], sum([len(nesmdb.vgm.nlm_to_tokens(n, level='func')) for n in nlms]))
+      for i, nlm in enumerate(nlms):
+        self.assertListEqual(corpus.to_nlm(str(i), clock=nlm[0][1]), nlm)
+
+
+  def test_rawsco(self):
+    import hashlib
+
+    hashes = []
+    for vgm in self.vgms:
+      ndf = nesmdb.vgm.ndr_to_ndf(nesmdb.vgm.vgm_to_ndr(vgm))
+      clock, rate, nsamps, rawsco = nesmdb.score.ndf_to_rawsco(ndf)
+      self.assertEqual(rawsco.shape, (nsamps, 4, 4))
+      hashes.append(hashlib.sha1(rawsco.tobytes()).hexdigest())
+
+      # Make sure run-length emulation expands to the same score
+      _, _, _, rawsco_runs = nesmdb.score.rawsco_runs_to_rawsco(nesmdb.score.ndf_to_rawsco_runs(ndf))
+      self.assertTrue(np.array_equal(rawsco_runs, rawsco))
+
+    # Make sure scores are bit-identical to the per-sample emulator
+    self.assertListEqual(hashes, [
+        '91ac2adf62bcba03f94f5eb61b3e59f1141970b2',
+        'cbc57b34bae39b7d746853ea821ab2658cd78d17',
+        'd1af0f94d41e779cd6eb0164e4631af966574aff',
+        '2ab1622ae4a7825a4af57b94395f7830b718326c',
+        '87f5786dcf94773acc77e359c8198e85b4721749'])
+
+
+  def test_exprsco_fused(self):
+    for vgm in self.vgms:
+      ndf = nesmdb.vgm.ndr_to_ndf(nesmdb.vgm.vgm_to_ndr(vgm))
+
+      rawsco = nesmdb.score.ndf_to_rawsco(ndf)
+      exprsco = nesmdb.score.rawsco_to_exprsco(rawsco)
+
+      for rate in [24., 7.3]:
+        _, _, score_dense = nesmdb.score.exprsco_downsample(exprsco, rate, False)
+        _, _, score_fused = nesmdb.convert.ndf_to_exprsco(ndf, rate)
+
+        # Make sure fused conversion matches downsampling the full score
+        self.assertEqual(score_fused.dtype, np.uint8)
+        self.assertTrue(np.array_equal(score_dense, score_fused))
+
+
+  def test_blndsco_ragged(self):
+    for vgm in self.vgms:
+      ndf = nesmdb.vgm.ndr_to_ndf(nesmdb.vgm.vgm_to_ndr(vgm))
+      exprsco = nesmdb.convert.ndf_to_exprsco(ndf, 24.)
+
+      rate, nsamps, notes, offsets = nesmdb.score.exprsco_to_blndsco_ragged(exprsco)
+      _, _, blndsco = nesmdb.score.exprsco_to_blndsco(exprsco)
+
+      # Make sure ragged frames match the list-of-lists form
+      self.assertEqual(notes.dtype, np.uint8)
+      self.assertEqual(offsets.shape[0], exprsco[2].shape[0] + 1)
+      self.assertEqual(len(blndsco), exprsco[2].shape[0])
+      for i in xrange(0, len(blndsco), 7):
+        self.assertListEqual(notes[offsets[i]:offsets[i + 1]].tolist(), blndsco[i])
+        self.assertListEqual(blndsco[i], sorted(filter(lambda x: x > 0, exprsco[2][i, :3, 0].tolist())))
+
+      # Make sure both forms convert back to the same score
+      _, _, score_ragged = nesmdb.score.blndsco_ragged_to_exprsco((rate, nsamps, notes, offsets))
+      _, _, score_lists = nesmdb.score.blndsco_to_exprsco((rate, nsamps, blndsco))
+      self.assertTrue(np.array_equal(score_ragged, score_lists))
+
+      # Compatibility shim
+      _, _, notes_shim, offsets_shim = nesmdb.score.blndsco_to_blndsco_ragged((rate, nsamps, blndsco))
+      self.assertTrue(np.array_equal(notes_shim, notes))
+      self.assertTrue(np.array_equal(offsets_shim, offsets))
+      self.assertListEqual(nesmdb.score.blndsco_ragged_to_blndsco((rate, nsamps, notes, offsets))[2], blndsco)
+
+
+  def test_midi_pretty_midi(self):
+    import pretty_midi
+
+    for vgm in self.vgms[2:4]:
+      ndf = nesmdb.vgm.ndr_to_ndf(nesmdb.vgm.vgm_to_ndr(vgm))
+      rate, nsamps, exprsco = nesmdb.score.rawsco_to_exprsco(nesmdb.score.ndf_to_rawsco(ndf))
+      midi = nesmdb.score.exprsco_to_midi((rate, nsamps, exprsco))
+
+      # Make sure the MIDI layout is readable by pretty_midi
+      pm = pretty_midi.PrettyMIDI(io.BytesIO(midi))
+      self.assertEqual(pm.resolution, 22050)
+      self.assertEqual(len(pm.time_signature_changes), 2)
+      self.assertEqual(int(round(pm.time_signature_changes[1].time * 44100)), nsamps)
+      for ins in pm.instruments:
+        ch = ['p1', 'p2', 'tr', 'no'].index(ins.name)
+        self.assertEqual(ins.is_drum, ch == 3)
+        for note in ins.notes:
+          start = int(round(note.start * 44100))
+          end = int(round(note.end * 44100))
+          self.assertEqual(exprsco[start, ch, 0], note.pitch)
+          self.assertEqual(exprsco[end - 1, ch, 0], note.pitch)
+
+      # Make sure pretty_midi output decodes to the same score
+      pm_midi = io.BytesIO()
+      pm.write(pm_midi)
+      _, _, pm_exprsco = nesmdb.score.midi_to_exprsco(pm_midi.getvalue())
+      _, _, cycle_exprsco = nesmdb.score.midi_to_exprsco(midi)
+      self.assertTrue(np.array_equal(pm_exprsco, cycle_exprsco))
+
+
+  def test_exprsco_downsample(self):
+    from scipy.stats import mode
+
+    # Few distinct values and short windows to exercise mode ties
+    rng = np.random.RandomState(0)
+    nsamps = 44100
+    exprsco = rng.randint(0, 3, size=(nsamps, 4, 3)).astype(np.uint8)
+    exprsco = np.repeat(exprsco[::20], 20, axis=0)[:nsamps]
+
+    rate = 1000.
+    _, _, score_low = nesmdb.score.exprsco_downsample((44100, nsamps, exprsco), rate, False)
+
+    # Compare to per-window scipy mode
+    ndown = int((nsamps / 44100.) * rate)
+    self.assertEqual(score_low.shape, (ndown, 4, 3))
+    for i in xrange(ndown):
+      samp_lo, samp_hi = [int(t * 44100.) for t in [i / rate, (i + 1) / rate]]
+      for ch in xrange(4):
+        score_slice_ch = exprsco[samp_lo:samp_hi, ch, :]
+        on_frames = np.where(score_slice_ch[:, 0] != 0)[0]
+        if len(on_frames) > 0:
+          expected = mode(score_slice_ch[on_frames])[0][0]
+        else:
+          expected = [0, 0, mode(score_slice_ch[:, 2])[0][0]]
+        self.assertListEqual(list(score_low[i, ch]), list(expected))
+
+
+  def test_exprsco_estimate_rate(self):
+    rates = []
+    for vgm in self.vgms:
+      ndf = nesmdb.vgm.ndr_to_ndf(nesmdb.vgm.vgm_to_ndr(vgm))
+      exprsco = nesmdb.score.rawsco_to_exprsco(nesmdb.score.ndf_to_rawsco(ndf))
+
+      rate, cand_rates, errors = nesmdb.score.exprsco_estimate_rate(exprsco)
+      self.assertEqual(cand_rates.shape, errors.shape)
+      self.assertEqual(rate, cand_rates[np.argmin(errors)])
+      rates.append(rate)
+
+    # Make sure estimated rates are unchanged
+    self.assertListEqual(
+        [round(r, 3) for r in rates],
+        [15.136, 15.114, 22.559, 15.094, 15.308])
+
+
+  def test_synth(self):
+    import distutils.spawn
+    import librosa
+
+    vgm2wav = 'VGMTOWAV' in os.environ or distutils.spawn.find_executable('vgm2wav') is not None
+    for vgm in self.vgms:
+      wav = nesmdb.vgm.vgm_to_wav(vgm, renderer='native')
+
+      # Make sure rendering covers the whole VGM
+      self.assertEqual(wav.dtype, np.float32)
+      self.assertEqual(wav.shape[0], struct.unpack('<I', vgm[0x18:0x1c])[0])
+      self.assertTrue(np.all(np.abs(wav) <= 1.))
+
+      # Make sure register formats render identically
+      ndr = nesmdb.vgm.vgm_to_ndr(vgm)
+      self.assertTrue(np.array_equal(nesmdb.synth.ndr_to_wav(ndr), wav))
+      self.assertTrue(np.array_equal(nesmdb.synth.ndr_to_wav(nesmdb.vgm.vgm_to_ndr(vgm, as_array=True)), wav))
+      ndf = nesmdb.vgm.ndr_to_ndf(ndr)
+      self.assertTrue(np.array_equal(nesmdb.convert.ndf_to_wav(ndf, renderer='native'), nesmdb.synth.ndf_to_wav(ndf)))
+
+      # Sanity check the spectrogram against VGMPlay (the renderer is not validated against it)
+      if vgm2wav:
+        ref_wav = nesmdb.vgm.vgm_to_wav(vgm, renderer='vgm2wav')
+        nsamps = min(wav.shape[0], ref_wav.shape[0])
+        spec = librosa.feature.melspectrogram(wav[:nsamps], sr=44100, n_mels=128).ravel()
+        ref_spec = librosa.feature.melspectrogram(ref_wav[:nsamps], sr=44100, n_mels=128).ravel()
+        sim = np.dot(spec, ref_spec) / (np.linalg.norm(spec) * np.linalg.norm(ref_spec))
+        self.assertGreater(sim, 0.9)
+
+
+  def test_synth_channels(self):
+    import nesmdb.synth
+
+    def render(writes, nsamps, ram=None):
+      ndr = [('clock', 1789773)]
+      if ram is not None:
+        ndr.append(('ram', 'c2', ram))
+      ndr += [('apu', addr, val) for addr, val in writes]
+      ndr.append(('wait', nsamps))
+      return nesmdb.synth.ndr_to_wav(ndr)
+
+    def peak_hz(wav):
+      mag = np.abs(np.fft.rfft(wav * np.hanning(wav.shape[0])))
+      return np.argmax(mag) * 44100. / wav.shape[0]
+
+    # Make sure pulse and triangle play at their timer frequencies (440.4 Hz)
+    wav = render([('15', '0f'), ('00', 'bf'), ('01', '00'), ('02', 'fd'), ('03', '00')], 44100)
+    self.assertLess(abs(peak_hz(wav) - 1789773 / (16. * 254)), 2.)
+    wav = render([('15', '0f'), ('08', 'ff'), ('0a', '7e'), ('0b', '00')], 44100)
+    self.assertLess(abs(peak_hz(wav) - 1789773 / (32. * 127)), 2.)
+
+    # Make sure the length counter silences the pulse after 10 half frames (3675 samples)
+    wav = render([('15', '0f'), ('00', '9f'), ('02', 'fd'), ('03', '00')], 8820)
+    self.assertGreater(np.abs(wav[3300:3600]).max(), 0.01)
+    self.assertLess(np.abs(wav[4500:]).max(), 1e-3)
+
+    # Make sure the envelope decays to silence within 60 quarter frames
+    wav = render([('15', '0f'), ('00', '83'), ('02', 'fd'), ('03', '08')], 22050)
+    ptps = [np.ptp(wav[int(a * 44100):int(b * 44100)]) for a, b in [(0.02, 0.05), (0.15, 0.2), (0.3, 0.4)]]
+    self.assertGreater(ptps[0], ptps[1])
+    self.assertGreater(ptps[1], 0.01)
+    self.assertLess(ptps[2], 1e-3)
+
+    # Make sure the sweep lowers the pitch until the target period mutes the pulse
+    wav = render([('15', '0f'), ('00', 'bf'), ('01', '91'), ('02', '00'), ('03', '01')], 44100)
+    crossings = lambda a, b: np.sum(np.diff(np.sign(wav[int(a * 44100):int(b * 44100)])) != 0)
+    self.assertGreater(crossings(0., 0.015), crossings(0.02, 0.035))
+    self.assertLess(np.abs(wav[int(0.3 * 44100):]).max(), 1e-3)
+
+    # Make sure the noise channel sounds
+    wav = render([('15', '0f'), ('0c', '3f'), ('0e', '04'), ('0f', '00')], 4410)
+    self.assertGreater(np.std(wav), 0.01)
+
+    # Make sure the DMC plays samples from RAM writes and saturates its output level
+    writes = [('10', '0f'), ('12', '00'), ('13', '01'), ('15', '1f')]
+    ram = '\x00\xc0' + '\xff' * 17
+    ndr = [('clock', 1789773), ('ram', 'c2', ram)] + [('apu', addr, val) for addr, val in writes] + [('wait', 4410)]
+    self.assertEqual(nesmdb.synth._ndr_to_runs(ndr)[-1].max(), 126)
+    self.assertGreater(np.abs(render(writes, 4410, ram=ram)).max(), 0.1)
+    self.assertLess(np.abs(render(writes, 4410)).max(), 1e-3)
+
+
+  def test_render_pool(self):
+    vgms = self.vgms[2:4]
+
+    # Make sure pooled rendering matches serial rendering
+    with nesmdb.vgm.VGMRenderPool(2, renderer='native') as pool:
+      wavs = pool.render(vgms)
+      wavs_imap = list(pool.imap(vgms))
+    for vgm, wav, wav_imap in zip(vgms, wavs, wavs_imap):
+      self.assertTrue(np.array_equal(wav, nesmdb.vgm.vgm_to_wav(vgm, renderer='native')))
+      self.assertTrue(np.array_equal(wav, wav_imap))
+
+    # Make sure each pool resolves vgm2wav from the current $VGMTOWAV
+    with _temp_dir() as bin_dir:
+      vgmtowav = os.environ.get('VGMTOWAV')
+      try:
+        for fn in ['a', 'b']:
+          bin_fp = os.path.join(bin_dir, fn)
+          with open(bin_fp, 'w') as f:
+            f.write('#!/bin/sh\n')
+          os.chmod(bin_fp, 0o755)
+          os.environ['VGMTOWAV'] = bin_fp
+          with nesmdb.vgm.VGMRenderPool(1) as pool:
+            self.assertEqual(pool.bin_fp, bin_fp)
+      finally:
+        if vgmtowav is None:
+          del os.environ['VGMTOWAV']
+        else:
+          os.environ['VGMTOWAV'] = vgmtowav
+
+
+  def test_cache(self):
+    import nesmdb.cache
+
+    with _temp_dir() as cache_dir:
+      calls = []
+      def stage(x, k):
+        calls.append(k)
+        return x + [k]
+
+      try:
+        cache = nesmdb.cache.configure(cache_dir)
+        stages = [('a', stage, {'k': 1}), ('b', stage, {'k': 2})]
+
+        # Make sure results are cached per stage
+        self.assertListEqual(nesmdb.cache.run_stages([0], stages), [0, 1, 2])
+        self.assertListEqual(nesmdb.cache.run_stages([0], stages), [0, 1, 2])
+        self.assertListEqual(calls, [1, 2])
+
+        # Make sure chains resume from the last cached stage
+        stages.append(('c', stage, {'k': 3}))
+        self.assertListEqual(nesmdb.cache.run_stages([0], stages), [0, 1, 2, 3])
+        self.assertListEqual(calls, [1, 2, 3])
+
+        # Make sure parameters and inputs are part of the key
+        stages[0] = ('a', stage, {'k': 4})
+        self.assertListEqual(nesmdb.cache.run_stages([0], stages), [0, 4, 2, 3])
+        self.assertListEqual(nesmdb.cache.run_stages([5], stages[:1]), [5, 4])
+        self.assertListEqual(calls, [1, 2, 3, 4, 2, 3, 4])
+
+        # Make sure the stage function is part of the key
+        def other_stage(x, k):
+          calls.append(-k)
+          return x + [-k]
+        self.assertListEqual(nesmdb.cache.run_stages([5], [('a', other_stage, {'k': 4})]), [5, -4])
+
+        # Make sure bypass skips the cache
+        nesmdb.cache.set_bypass(True)
+        nesmdb.cache.run_stages([0], stages)
+        self.assertListEqual(calls, [1, 2, 3, 4, 2, 3, 4, -4, 4, 2, 3])
+        nesmdb.cache.set_bypass(False)
+
+        # Make sure conversions are unchanged by caching
+        vgm = self.vgms[2]
+        nlm = nesmdb.convert.vgm_to_nlm(vgm)
+        self.assertListEqual(nesmdb.convert.vgm_to_nlm(vgm), nlm)
+        nesmdb.cache.set_bypass(True)
+        self.assertListEqual(nesmdb.convert.vgm_to_nlm(vgm), nlm)
+        nesmdb.cache.set_bypass(False)
+
+        # Make sure eviction respects the size cap
+        cache.evict(0)
+        self.assertEqual(len(cache._entries()), 0)
+
+        # Make sure equal inputs share a key however their objects are shared
+        ndr = [('clock', 1789773), ('apu', '08', '80')]
+        self.assertEqual(cache.input_key(ndr * 2), cache.input_key(ndr + [(c[0],) + c[1:] for c in ndr]))
+        self.assertEqual(cache.input_key(nesmdb.vgm.ndr_to_array(ndr)), cache.input_key(nesmdb.vgm.ndr_to_array(ndr)))
+        self.assertNotEqual(cache.input_key([1]), cache.input_key([1.0]))
+
+        # Make sure bypassing or unconfiguring the cache stops reads and writes
+        nesmdb.cache.set_bypass(True)
+        self.assertIsNone(nesmdb.cache.get_cache())
+        nesmdb.convert.vgm_to_nlm(vgm)
+        self.assertEqual(len(cache._entries()), 0)
+        nesmdb.cache.set_bypass(False)
+        self.assertIs(nesmdb.cache.get_cache(), cache)
+        nesmdb.cache.configure(None)
+        self.assertIsNone(nesmdb.cache.get_cache())
+        nesmdb.convert.vgm_to_nlm(vgm)
+        self.assertEqual(len(cache._entries()), 0)
+      finally:
+        nesmdb.cache.set_bypass(False)
+        nesmdb.cache.configure(None)
+
+
+  def test_plan_conversion(self):
+    # Make sure planned paths are the shortest ones
+    plan = lambda src, dst: [s[0] for s in nesmdb.convert.plan_conversion(src, dst)]
+    self.assertListEqual(plan('vgm', 'exprsco'), ['vgm_to_ndr', 'ndr_to_ndf', 'ndf_to_exprsco'])
+    self.assertListEqual(plan('midi', 'nlm'), ['midi_to_exprsco', 'exprsco_to_rawsco', 'rawsco_to_ndf', 'ndf_to_nlm'])
+    with self.assertRaises(ValueError):
+      nesmdb.convert.plan_conversion('wav', 'vgm')
+
+    # Make sure only reachable pairs are offered as conversions
+    self.assertIn('midi_to_wav', nesmdb.convert._PLANNED)
+    self.assertIn('ndf_txt_to_ndr_txt', nesmdb.convert._PLANNED)
+    self.assertNotIn('wav_to_vgm', nesmdb.convert._PLANNED)
+
+    # Make sure planned conversions match the dedicated ones
+    for vgm in self.vgms[2:4]:
+      ndf = nesmdb.convert.vgm_to_ndf(vgm)
+      self.assertListEqual(nesmdb.convert.convert(vgm, 'vgm', 'ndf'), ndf)
+      self.assertListEqual(nesmdb.convert.convert(nesmdb.convert.convert(vgm, 'vgm', 'ndf_txt'), 'ndf_txt', 'ndf'), ndf)
+      self.assertListEqual(nesmdb.convert.convert(nesmdb.convert.convert(vgm, 'vgm', 'ndr_txt'), 'ndr_txt', 'ndf'), ndf)
+      self.assertListEqual(nesmdb.convert.convert(vgm, 'vgm', 'nlm'), nesmdb.convert.vgm_to_nlm(vgm))
+
+      _, _, exprsco = nesmdb.convert.convert(vgm, 'vgm', 'exprsco', score_rate=24.)
+      _, _, exprsco_ref = nesmdb.convert.ndf_to_exprsco(ndf, 24.)
+      self.assertTrue(np.array_equal(exprsco, exprsco_ref))
+
+
+  def test_export(self):
+    formats = nesmdb.convert.export_formats
+    for vgm in self.vgms[2:4]:
+      fmt_to_out = dict(nesmdb.convert.vgm_export(vgm, formats, score_rate=24., renderer='native'))
+      self.assertEqual(len(fmt_to_out), len(formats))
+
+      # Make sure exports match the dedicated conversions
+      ndf = nesmdb.convert.vgm_to_ndf(vgm)
+      exprsco = nesmdb.convert.ndf_to_exprsco(ndf, 24.)
+      self.assertListEqual(fmt_to_out['ndr'], nesmdb.convert.vgm_to_ndr(vgm))
+      self.assertListEqual(fmt_to_out['ndf'], ndf)
+      self.assertListEqual(fmt_to_out['nlm'], nesmdb.convert.vgm_to_nlm(vgm))
+      self.assertEqual(fmt_to_out['ndr_txt'], nesmdb.convert.ndr_to_txt(nesmdb.convert.vgm_to_ndr(vgm)))
+      self.assertEqual(fmt_to_out['ndf_txt'], nesmdb.convert.ndf_to_txt(ndf))
+      self.assertTrue(np.array_equal(fmt_to_out['rawsco'][3], nesmdb.score.ndf_to_rawsco(ndf)[3]))
+      self.assertTrue(np.array_equal(fmt_to_out['exprsco'][2], exprsco[2]))
+      self.assertTrue(np.array_equal(fmt_to_out['seprsco'][2], nesmdb.convert.exprsco_to_seprsco(exprsco)[2]))
+      self.assertTrue(np.array_equal(fmt_to_out['blndsco'][2], nesmdb.convert.exprsco_to_blndsco(exprsco)[2]))
+      self.assertEqual(fmt_to_out['midi'], nesmdb.convert.ndf_to_midi(ndf))
+      self.assertTrue(np.array_equal(fmt_to_out['wav'], nesmdb.convert.vgm_to_wav(vgm, renderer='native')))
+
+    # Make sure exported text files use the NDR/NDF text extensions
+    with _temp_dir() as out_dir:
+      in_fp = os.path.join(out_dir, 'song.vgm')
+      with open(in_fp, 'wb') as f:
+        f.write(self.vgms[2])
+      _convert_main(['vgm_export', '--export_formats', 'ndr_txt,ndf_txt', in_fp])
+      self.assertListEqual(sorted(os.listdir(out_dir)), ['song.ndf.txt', 'song.ndr.txt', 'song.vgm'])
+
+
+  def test_convert_jobs(self):
+    import cPickle as pickle
+
+    with _temp_dir() as in_dir:
+      in_fps = []
+      for i, vgm in enumerate(self.vgms):
+        in_fps.append(os.path.join(in_dir, '{}.vgm'.format(i)))
+        with open(in_fps[-1], 'wb') as f:
+          f.write(vgm)
+      bad_fp = os.path.join(in_dir, 'bad.vgm')
+      with open(bad_fp, 'wb') as f:
+        f.write('not a vgm')
+      missing_fp = os.path.join(in_dir, 'missing.vgm')
+
+      for jobs in [1, 2]:
+        out_dir = os.path.join(in_dir, 'out{}'.format(jobs))
+        out = _convert_main(['vgm_to_ndr', '--out_dir', out_dir, '--jobs', str(jobs), '--chunksize', '1']
+            + in_fps[:2] + [bad_fp, missing_fp] + in_fps[2:])
+
+        # Make sure serial and parallel runs convert every good file
+        for in_fp, vgm in zip(in_fps, self.vgms):
+          out_fp = os.path.join(out_dir, os.path.basename(in_fp).replace('.vgm', '.ndr.pkl'))
+          with open(out_fp, 'rb') as f:
+            self.assertListEqual(pickle.load(f), nesmdb.vgm.vgm_to_ndr(vgm))
+
+        # Make sure conversion and load errors both end up in the failure summary
+        summary = out.split('Failed to convert ')[1].splitlines()
+        self.assertEqual(summary[0], '2 of 7 files:')
+        self.assertListEqual(summary[1:], [bad_fp, missing_fp])
+        self.assertListEqual(sorted(os.listdir(out_dir)), ['{}.ndr.pkl'.format(i) for i in range(5)])
+
+
+  def test_convert_incremental(self):
+    with _temp_dir() as in_dir:
+      in_fps = []
+      for i, vgm in enumerate(self.vgms[:3]):
+        in_fps.append(os.path.join(in_dir, '{}.vgm'.format(i)))
+        with open(in_fps[-1], 'wb') as f:
+          f.write(vgm)
+      out_dir = os.path.join(in_dir, 'out')
+      out_fps = [os.path.join(out_dir, '{}.ndr.pkl'.format(i)) for i in range(3)]
+      manifest_fp = os.path.join(out_dir, 'nesmdb_manifest.jsonl')
+      argv = ['vgm_to_ndr', '--out_dir', out_dir, '--incremental'] + in_fps
+
+      # Make sure the manifest records every output
+      _convert_main(argv)
+      out_fp_to_record = nesmdb.convert._load_manifest(manifest_fp)
+      self.assertListEqual(sorted(out_fp_to_record.keys()), out_fps)
+      for in_fp, out_fp in zip(in_fps, out_fps):
+        record = out_fp_to_record[out_fp]
+        in_hash = nesmdb.convert._file_hash(in_fp)
+        self.assertTrue(nesmdb.convert._manifest_up_to_date(record, in_hash, record['signature']))
+        self.assertFalse(nesmdb.convert._manifest_up_to_date(record, in_hash, 'other'))
+        self.assertFalse(nesmdb.convert._manifest_up_to_date(None, in_hash, record['signature']))
+
+      # Make sure only removed or corrupted outputs are redone
+      for i, fp in enumerate(out_fps):
+        os.utime(fp, (i, i))
+      os.remove(out_fps[0])
+      with open(out_fps[1], 'ab') as f:
+        f.write('x')
+      out = _convert_main(argv)
+      self.assertIn('Skipping 1 of 3 files', out)
+      self.assertEqual(os.path.getmtime(out_fps[2]), 2)
+      for in_fp, out_fp in zip(in_fps, out_fps):
+        with open(in_fp, 'rb') as f, open(out_fp, 'rb') as g:
+          self.assertEqual(g.read(), nesmdb.convert.pickle.dumps(nesmdb.vgm.vgm_to_ndr(f.read())))
+
+      # Make sure a truncated final manifest line is tolerated
+      with open(manifest_fp, 'a') as f:
+        f.write('{"in_fp": ')
+      self.assertEqual(len(nesmdb.convert._load_manifest(manifest_fp)), 3)
+      out = _convert_main(argv)
+      self.assertIn('Skipping 3 of 3 files', out)
+
+      # Make sure failed saves leave no partial files behind
+      shutil.rmtree(out_dir)
+      os.makedirs(out_fps[1])
+      out = _convert_main(argv)
+      self.assertIn('Failed to convert 1 of 3 files', out)
+      self.assertListEqual(
+          sorted(os.listdir(out_dir)),
+          ['0.ndr.pkl', '1.ndr.pkl', '2.ndr.pkl', 'nesmdb_manifest.jsonl'])
+      self.assertEqual(nesmdb.convert._load_manifest(manifest_fp)[out_fps[1]]['status'], 'failed')
+
+      # Make sure a missing input fails on its own instead of stopping the run
+      shutil.rmtree(out_dir)
+      out = _convert_main(argv + [os.path.join(in_dir, 'missing.vgm')])
+      self.assertIn('Failed to convert 1 of 4 files', out)
+      self.assertListEqual(
+          sorted(os.listdir(out_dir)),
+          ['0.ndr.pkl', '1.ndr.pkl', '2.ndr.pkl', 'nesmdb_manifest.jsonl'])
+      self.assertEqual(nesmdb.convert._load_manifest(manifest_fp)[os.path.join(out_dir, 'missing.ndr.pkl')]['status'], 'failed')
+
+
+  def test_score_corpus(self):
+    exprscos = []
+    for vgm in self.vgms:
+      exprscos.append(nesmdb.convert.ndf_to_exprsco(nesmdb.convert.vgm_to_ndf(vgm), 24.))
+    seprscos = [nesmdb.score.exprsco_to_seprsco(exprsco) for exprsco in exprscos]
+    song_ids = [os.path.basename(fp).split('.')[0] for fp in _EXAMPLE_VGMS]
+
+    with _temp_dir() as corpus_dir:
+      for kind, scores in [('exprsco', exprscos), ('seprsco', seprscos)]:
+        kind_dir = os.path.join(corpus_dir, kind)
+        nesmdb.score.write_score_corpus(kind_dir, zip(song_ids, scores), kind=kind, shard_nbytes=8192)
+        corpus = nesmdb.score.ScoreCorpus(kind_dir)
+
+        # Make sure songs were split across shards
+        self.assertGreater(len(corpus._shard_fns), 1)
+        self.assertListEqual(corpus.song_ids, song_ids)
+
+        # Make sure songs read back as views of the mapped shards
+        for song_id, score, song in zip(song_ids, scores, corpus):
+          self.assertEqual(song[:2], score[:2])
+          self.assertTrue(np.array_equal(song[2], score[2]))
+          self.assertIsInstance(song[2].base, np.memmap)
+          self.assertTrue(np.array_equal(corpus[song_id][2], score[2]))
+
+
   def test_nlm(self):
     total_dist = 0.
     cycle_vgms = []
@@ -83,7 +786,7 @@ class TestFormats(TestCase):
     # Make sure shortened lengths are correct
     self.assertListEqual(
         [len(v) for v in cycle_vgms],
-        [12283, 16303, 1162, 1063, 15880])
+        [11980, 15688, 1138, 1030, 15736])
 
     # Make sure the MIDI files are the same as expressive score
     avg_dist = total_dist / len(self.vgms)
@@ -101,7 +804,7 @@ class TestFormats(TestCase):
     # Make sure shortened lengths are correct
     self.assertListEqual(
         [len(v) for v in cycle_vgms],
-        [12283, 16303, 1162, 1063, 15880])
+        [11980, 15688, 1138, 1030, 15736])
 
     # Make sure the expressive scores are within acceptable range
     avg_dist = total_dist / len(self.vgms)
@@ -119,7 +822,7 @@ class TestFormats(TestCase):
     # Make sure shortened lengths are correct
     self.assertListEqual(
         [len(v) for v in cycle_vgms],
-        [8026, 10573, 850, 790, 10330])
+        [6343, 8557, 790, 709, 9220])
 
     # Make sure the expressive scores are within acceptable range
     avg_dist = total_dist / len(self.vgms)
@@ -137,7 +840,7 @@ class TestFormats(TestCase):
     # Make sure shortened lengths are correct
     self.assertListEqual(
         [len(v) for v in cycle_vgms],
-        [9589, 10630, 895, 853, 12361])
+        [7855, 8344, 823, 763, 11134])
 
     # Make sure the expressive scores are within acceptable range
     avg_dist = total_dist / len(self.vgms)
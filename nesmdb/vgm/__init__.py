@@ -1,6 +1,8 @@
-from vgm_ndr import vgm_to_ndr, ndr_to_vgm
-from ndr_ndf import ndr_to_ndf, ndf_to_ndr
-from ndf_nlm import ndf_to_nlm, nlm_to_ndf
-from nd_txt import nd_to_txt, txt_to_nd
+from vgm_ndr import vgm_to_ndr, vgm_to_ndr_iter, ndr_to_vgm, ndr_to_vgm_file, VGMIndex
+from ndr_ndf import ndr_to_ndf, ndr_to_ndf_iter, ndf_to_ndr
+from ndf_nlm import ndf_to_nlm, ndf_to_nlm_iter, nlm_to_ndf
+from nd_txt import nd_to_txt, nd_to_txt_file, txt_to_nd, txt_to_nd_iter
+from nd_array import nd_dtype, ND_CLOCK, ND_WAIT, ND_APU, nd_columns_to_array, ndr_to_array, array_to_ndr, ndf_to_array, array_to_ndf, nlm_to_array, array_to_nlm
+from nlm_tokens import nlm_vocab, nlm_to_tokens, tokens_to_nlm, write_nlm_corpus, NLMCorpus
 from vgm_simplify import vgm_simplify, vgm_shorten
-from vgm_to_wav import vgm_to_wav, load_vgmwav, save_vgmwav
+from vgm_to_wav import vgm_to_wav, vgms_to_wavs, VGMRenderPool, load_vgmwav, save_vgmwav
@@ -5,6 +5,9 @@ import struct
 b2h = lambda x: binascii.hexlify(x)
 h2b = lambda x: binascii.unhexlify(x)
 
+# Byte value to hex (lookup table)
+i2h = ['{:02x}'.format(x) for x in xrange(256)]
+
 # Bytes to 4-byte ([l]ittle/[b]ig) unsigned ints
 b2lu = lambda x: struct.unpack('<I', x)[0]
 b2bu = lambda x: struct.unpack('>I', x)[0]
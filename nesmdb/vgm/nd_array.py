@@ -0,0 +1,138 @@
+import numpy as np
+
+from nesmdb.apu import channels, channel_functions, func_offset_table, addr_ch_table, addr_offset_table, ch_base_table
+
+
+# Columnar NDR/NDF/NLM: one record per command, first record is the clock.
+# Fields are NumPy views (e.g. nd['val']), so slicing and column access never
+# copy. NDR writes have fu == -1, NLM commands have natom == 0.
+ND_CLOCK = 0
+ND_WAIT = 1
+ND_APU = 2
+# RAM writes only appear while parsing VGMs; arrays never store them
+ND_RAM = 3
+nd_dtype = np.dtype([
+    ('comm', np.uint8),
+    ('ch', np.int8),
+    ('fu', np.int8),
+    ('val', np.uint32),
+    ('natom', np.uint16),
+    ('offset', np.uint8)
+])
+
+ND_CHANNELS = channels
+ND_FUNCTIONS = channel_functions
+_CH_TO_ID = {ch:i for i, ch in enumerate(ND_CHANNELS)}
+_FU_TO_ID = [{fu:i for i, fu in enumerate(fus)} for fus in ND_FUNCTIONS]
+
+
+def nd_columns_to_array(comm, ch, fu, val, natom, offset, clock):
+  # Builds an array from per-command columns (scalars broadcast) after the clock
+  nd = np.zeros(len(comm) + 1, dtype=nd_dtype)
+  nd[0] = (ND_CLOCK, -1, -1, clock, 0, 0)
+  nd['comm'][1:] = comm
+  nd['ch'][1:] = ch
+  nd['fu'][1:] = fu
+  nd['val'][1:] = val
+  nd['natom'][1:] = natom
+  nd['offset'][1:] = offset
+  return nd
+
+
+def ffill_idx(valid):
+  # Index of the last valid position at or before each position (-1 if none)
+  idxs = np.where(valid, np.arange(valid.shape[0]), -1)
+  return np.maximum.accumulate(idxs) if idxs.shape[0] > 0 else idxs
+
+
+def prev_in_group(groups):
+  # Index of the previous position with the same group (-1 if none)
+  order = np.argsort(groups, kind='mergesort')
+  prev = np.full(groups.shape[0], -1, dtype=np.int64)
+  same = groups[order][1:] == groups[order][:-1]
+  prev[order[1:][same]] = order[:-1][same]
+  return prev
+
+
+def ndr_arrays_to_array(comm, arg1, arg2, clock):
+  # Waits carry their length in arg1, writes their address/value in arg1/arg2
+  apu = comm == ND_APU
+  addr = np.where(apu, arg1, 0)
+  ch = np.where(apu, addr_ch_table[addr], -1)
+  offset = np.where(apu, addr_offset_table[addr], 0)
+  val = np.where(apu, arg2, arg1)
+
+  return nd_columns_to_array(comm, ch, -1, val, 0, offset, clock)
+
+
+def ndr_to_array(ndr):
+  assert ndr[0][0] == 'clock'
+  comms = [c for c in ndr[1:] if c[0] != 'ram']
+
+  comm = np.array([ND_WAIT if c[0] == 'wait' else ND_APU for c in comms], dtype=np.uint8)
+  arg1 = np.array([c[1] if c[0] == 'wait' else int(c[1], 16) for c in comms], dtype=np.int64)
+  arg2 = np.array([0 if c[0] == 'wait' else int(c[2], 16) for c in comms], dtype=np.int64)
+
+  return ndr_arrays_to_array(comm, arg1, arg2, ndr[0][1])
+
+
+def array_to_ndr(nd):
+  ndr = [('clock', int(nd[0]['val']))]
+  comm, ch, val, offset = [nd[k][1:].tolist() for k in ['comm', 'ch', 'val', 'offset']]
+  for c, h, v, o in zip(comm, ch, val, offset):
+    if c == ND_WAIT:
+      ndr.append(('wait', v))
+    else:
+      addr = o if h < 0 else int(ch_base_table[h]) + o
+      ndr.append(('apu', '{:02x}'.format(addr), '{:02x}'.format(v)))
+  return ndr
+
+
+def ndf_to_array(ndf):
+  assert ndf[0][0] == 'clock'
+  comms = [c for c in ndf[1:] if c[0] != 'ram']
+
+  comm = np.array([ND_WAIT if c[0] == 'wait' else ND_APU for c in comms], dtype=np.uint8)
+  ch = np.array([-1 if c[0] == 'wait' else _CH_TO_ID[c[1]] for c in comms], dtype=np.int8)
+  fu = np.array([-1 if c[0] == 'wait' else _FU_TO_ID[_CH_TO_ID[c[1]]][c[2]] for c in comms], dtype=np.int8)
+  val = np.array([c[1] if c[0] == 'wait' else c[3] for c in comms], dtype=np.int64)
+  natom = np.array([0 if c[0] == 'wait' else c[4] for c in comms], dtype=np.int64)
+  offset = np.array([0 if c[0] == 'wait' else c[5] for c in comms], dtype=np.int64)
+
+  return nd_columns_to_array(comm, ch, fu, val, natom, offset, ndf[0][1])
+
+
+def array_to_ndf(nd):
+  ndf = [('clock', int(nd[0]['val']))]
+  comm, ch, fu, val, natom, offset = [nd[k][1:].tolist() for k in ['comm', 'ch', 'fu', 'val', 'natom', 'offset']]
+  for c, h, f, v, n, o in zip(comm, ch, fu, val, natom, offset):
+    if c == ND_WAIT:
+      ndf.append(('wait', v))
+    else:
+      ndf.append(('apu', ND_CHANNELS[h], ND_FUNCTIONS[h][f], v, n, o))
+  return ndf
+
+
+def nlm_to_array(nlm):
+  comms = nlm[1:]
+
+  comm = np.array([ND_WAIT if c[0] == 'w' else ND_APU for c in comms], dtype=np.uint8)
+  chfu = [None if c[0] == 'w' else c[0].split('_') for c in comms]
+  ch = np.array([-1 if c is None else _CH_TO_ID[c[0]] for c in chfu], dtype=np.int8)
+  fu = np.array([-1 if c is None else _FU_TO_ID[_CH_TO_ID[c[0]]][c[1]] for c in chfu], dtype=np.int8)
+  val = np.array([c[1] for c in comms], dtype=np.int64)
+  apu = comm == ND_APU
+  offset = np.where(apu, func_offset_table[ch, np.maximum(fu, 0)], 0)
+
+  return nd_columns_to_array(comm, ch, fu, val, 0, offset, nlm[0][1])
+
+
+def array_to_nlm(nd):
+  nlm = [('clock', int(nd[0]['val']))]
+  comm, ch, fu, val = [nd[k][1:].tolist() for k in ['comm', 'ch', 'fu', 'val']]
+  for c, h, f, v in zip(comm, ch, fu, val):
+    if c == ND_WAIT:
+      nlm.append(('w', v))
+    else:
+      nlm.append(('{}_{}'.format(ND_CHANNELS[h], ND_FUNCTIONS[h][f]), v))
+  return nlm
@@ -6,27 +6,46 @@ def nd_to_txt(nd):
   return txt
 
 
+def nd_to_txt_file(nd, f):
+  """Writes nd_to_txt(nd) to file-like f one command at a time.
+
+  nd may be any iterable of commands (e.g. a chain of *_iter generators).
+  """
+  first = True
+  for c in nd:
+    if c[0] == 'ram':
+      continue
+    if not first:
+      f.write('\n')
+    f.write(','.join([str(x) for x in c]))
+    first = False
+
+
 def txt_to_nd(txt):
-  txt = [l.strip() for l in txt.splitlines()]
+  return list(txt_to_nd_iter(txt.splitlines()))
+
 
-  nd = []
-  for l in txt:
+def txt_to_nd_iter(lines):
+  """Yields commands from an iterable of text lines (e.g. an open file)."""
+  for l in lines:
+    l = l.strip()
     if len(l) == 0 or l.startswith('//'):
       continue
 
     comm = l.split(',')
     if comm[0] == 'clock':
-      nd.append(('clock', int(comm[1])))
+      yield ('clock', int(comm[1]))
     elif comm[0] == 'wait':
-      nd.append(('wait', int(comm[1])))
+      yield ('wait', int(comm[1]))
     elif comm[0] == 'apu':
       if len(comm) == 3:
         # NDR
-        nd.append(('apu', comm[1], comm[2]))
+        yield ('apu', comm[1], comm[2])
       else:
         # NDF
-        nd.append(('apu', comm[1], comm[2], int(comm[3]), int(comm[4]), int(comm[5])))
+        yield ('apu', comm[1], comm[2], int(comm[3]), int(comm[4]), int(comm[5]))
+    elif comm[0] == 'w' or (len(comm) == 2 and '_' in comm[0]):
+      # NLM
+      yield (comm[0], int(comm[1]))
     else:
       raise NotImplementedError('Invalid command: {}'.format(comm))
-
-  return nd
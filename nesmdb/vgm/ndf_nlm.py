@@ -1,9 +1,13 @@
-from collections import defaultdict
+from collections import Counter, defaultdict
 
-from nesmdb.apu import func_to_offset
+import numpy as np
 
+from nesmdb.apu import func_table, func_offset_table
+from nesmdb.vgm.nd_array import ND_WAIT, ND_APU, ND_CHANNELS, ND_FUNCTIONS
+from nesmdb.vgm.nd_array import nd_columns_to_array, ffill_idx, prev_in_group
 
-_DELETE = [
+
+NLM_DELETE = [
     'ch_dm',
     'fc_iq'
 ]
@@ -25,6 +29,17 @@ _VOLATILE = [
 
 
 def ndf_to_nlm(ndf):
+  if isinstance(ndf, np.ndarray):
+    return _ndf_to_nlm_array(ndf)
+
+  return list(ndf_to_nlm_iter(ndf))
+
+
+def ndf_to_nlm_iter(ndf):
+  """Yields NLM commands for an iterable of NDF commands (clock first)."""
+  ndf = iter(ndf)
+  yield next(ndf)
+
   func_to_val = defaultdict(int)
   func_to_val['ch_p1'] = 1
   func_to_val['ch_p2'] = 1
@@ -32,27 +47,17 @@ def ndf_to_nlm(ndf):
   func_to_val['ch_no'] = 1
   func_to_val['ch_dm'] = 1
 
-  funcs = set()
-
-  lm = [ndf[0]]
-  natom = 0
-  for comm in ndf[1:]:
+  for comm in ndf:
     if comm[0] == 'wait':
-      lm.append(comm)
-      natom = 0
+      yield ('w', comm[1])
     elif comm[0] == 'apu':
       ch = comm[1]
       fu = comm[2]
       val = comm[3]
-      natom = comm[4]
-      offset = comm[5]
 
       func = '{}_{}'.format(ch, fu)
-      reg = '{}_{}'.format(ch, offset)
-
-      funcs.add(func)
 
-      delete = func in _DELETE
+      delete = func in NLM_DELETE
       changed = func_to_val[func] != val
 
       preserve = func in _VOLATILE
@@ -62,24 +67,17 @@ def ndf_to_nlm(ndf):
         preserve = True
 
       if (changed or preserve) and not delete:
-        lm.append(comm)
+        yield (func, val)
 
       func_to_val[func] = val
     else:
       raise NotImplementedError()
 
-  # Simplify syntax
-  lm_nu = [ndf[0]]
-  for comm in lm[1:]:
-    if comm[0] == 'wait':
-      lm_nu.append(('w', comm[1]))
-    else:
-      lm_nu.append(('{}_{}'.format(comm[1], comm[2]), comm[3]))
-
-  return lm_nu
-
 
 def nlm_to_ndf(lm):
+  if isinstance(lm, np.ndarray):
+    return _nlm_to_ndf_array(lm)
+
   ndf = [lm[0]]
 
   offset_last = None
@@ -94,10 +92,9 @@ def nlm_to_ndf(lm):
       natoms = 0
       atom_funcs = set()
     else:
-      ch, fu = comm[0].split('_')
-      offset = func_to_offset(ch, fu)
-
-      func = '{}_{}'.format(ch, fu)
+      func = comm[0]
+      ch, fu = func.split('_')
+      offset = func_table[(ch, fu)][0]
 
       if offset_last is not None and offset_last != offset or func in atom_funcs:
         atom_funcs = set()
@@ -105,6 +102,97 @@ def nlm_to_ndf(lm):
       atom_funcs.add(func)
       offset_last = offset
 
-      ndf.append(('apu', ch, fu, comm[1], natoms, func_to_offset(ch, fu)))
+      ndf.append(('apu', ch, fu, comm[1], natoms, offset))
 
   return ndf
+
+
+def _func_ids(funcs):
+  ids = []
+  for func in funcs:
+    ch, fu = func.split('_')
+    ch = ND_CHANNELS.index(ch)
+    ids.append(ch * 16 + ND_FUNCTIONS[ch].index(fu))
+  return ids
+
+
+def _ndf_to_nlm_array(ndf):
+  clock = ndf[0]['val']
+  ndf = ndf[1:]
+
+  comm = ndf['comm']
+  apu = comm == ND_APU
+  val = ndf['val'].astype(np.int64)
+  func = np.where(apu, ndf['ch'].astype(np.int64) * 16 + ndf['fu'], -1)
+
+  # Compare against each function's previous value
+  prev = prev_in_group(func)
+  initial = np.where(np.in1d(func, _func_ids(['ch_p1', 'ch_p2', 'ch_tr', 'ch_no', 'ch_dm'])), 1, 0)
+  val_prev = np.where(prev >= 0, val[np.maximum(prev, 0)], initial)
+  changed = val != val_prev
+
+  # Timer writes are kept while the sweep unit is enabled
+  preserve = np.in1d(func, _func_ids(_VOLATILE))
+  for ch in ['p1', 'p2']:
+    se_id, tl_id = _func_ids([ch + '_se', ch + '_tl'])
+    se_last = ffill_idx(func == se_id)
+    se = np.where(se_last >= 0, val[np.maximum(se_last, 0)], 0)
+    preserve |= np.logical_and(func == tl_id, se == 1)
+
+  delete = np.in1d(func, _func_ids(NLM_DELETE))
+  keep = np.logical_or(~apu, np.logical_and(np.logical_or(changed, preserve), ~delete))
+  nlm = ndf[keep]
+
+  return nd_columns_to_array(
+      nlm['comm'], nlm['ch'], nlm['fu'], nlm['val'], 0,
+      np.where(nlm['comm'] == ND_APU, nlm['offset'], 0),
+      clock)
+
+
+def _nlm_to_ndf_array(nlm):
+  clock = nlm[0]['val']
+  nlm = nlm[1:]
+
+  comm = nlm['comm']
+  apu = comm == ND_APU
+  ch = np.where(apu, nlm['ch'], 0).astype(np.int64)
+  fu = np.where(apu, nlm['fu'], 0).astype(np.int64)
+  offset = np.where(apu, func_offset_table[ch, fu], 0)
+
+  # A new atom starts when the register changes or a function repeats
+  n = comm.shape[0]
+  idx = np.arange(n)
+  wait = comm == ND_WAIT
+  brk = wait.copy()
+  brk[:1] = True
+  brk[1:] |= np.logical_or(wait[:-1], offset[1:] != offset[:-1])
+  run = np.cumsum(brk)
+  func = ch * 16 + fu
+  prev = prev_in_group(np.where(apu, run * 256 + func, -1 - idx))
+
+  # Next atom start for an atom starting at each position: the first repeated
+  # function (at most one atom's worth of functions away) or the end of the run
+  brks = np.where(brk)[0]
+  nxt = np.append(brks, n)[np.searchsorted(brks, idx, side='right')]
+  atom_max = max(Counter(v[0] for v in func_table.values()).values())
+  for d in xrange(atom_max, 0, -1):
+    i = idx[:-d] if d < n else idx[:0]
+    repeat = np.logical_and(run[i + d] == run[i], prev[i + d] >= i)
+    nxt[i[repeat]] = i[repeat] + d
+
+  # Atoms start at positions reachable from run starts (pointer doubling)
+  start = brk.copy()
+  jump = np.append(nxt, n)
+  while np.any(jump[:-1] < n):
+    reached = np.zeros(n + 1, dtype=np.bool_)
+    reached[jump[:-1][start]] = True
+    start |= reached[:-1]
+    jump = jump[jump]
+
+  # Atom index is the number of atom starts since the last wait
+  nstart = np.cumsum(np.logical_and(start, apu))
+  wait_idx = ffill_idx(wait)
+  natom = np.where(apu, nstart - 1 - np.where(wait_idx >= 0, nstart[np.maximum(wait_idx, 0)], 0), 0)
+
+  return nd_columns_to_array(
+      comm, np.where(apu, ch, -1), np.where(apu, fu, -1), nlm['val'], natom, offset, clock)
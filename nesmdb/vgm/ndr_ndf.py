@@ -1,83 +1,49 @@
 from collections import Counter, OrderedDict
 
+import numpy as np
+
 from nesmdb.apu import *
 from nesmdb.vgm.bintypes import *
+from nesmdb.vgm.nd_array import ND_WAIT, ND_APU, ND_CHANNELS, ND_FUNCTIONS
+from nesmdb.vgm.nd_array import nd_columns_to_array, ffill_idx
 
 
 def ndr_to_ndf(ndr):
-  ndf = ndr[:1]
-  ndr = ndr[1:]
+  if isinstance(ndr, np.ndarray):
+    return _ndr_to_ndf_array(ndr)
+
+  # TODO: consider re-enabling compress
+  #return ndf_compress(ndf)
+  return list(ndr_to_ndf_iter(ndr))
 
-  registers = {
-      'p1': [0x00] * 4,
-      'p2': [0x00] * 4,
-      'tr': [0x00] * 4,
-      'no': [0x00] * 4,
-      'dm': [0x00] * 4,
-      'ch': [0x00],
-      'fc': [0x00]
-  }
+
+def ndr_to_ndf_iter(ndr):
+  """Yields NDF commands for an iterable of NDR commands (clock first)."""
+  ndr = iter(ndr)
+  yield next(ndr)
 
   # Expand
   natoms = 0
   for comm in ndr:
     if comm[0] == 'wait':
-      ndf.append(comm)
+      yield comm
       natoms = 0
     elif comm[0] == 'apu':
-      reg = b2c(h2b(comm[1]))
-      val = b2c(h2b(comm[2]))
-
-      # Determine channel
-      if reg >= 0x00 and reg < 0x04:
-        ch = 'p1'
-      elif reg >= 0x04 and reg < 0x08:
-        ch = 'p2'
-      elif reg >= 0x08 and reg < 0x0C:
-        ch = 'tr'
-      elif reg >= 0x0C and reg < 0x10:
-        ch = 'no'
-      elif reg >= 0x10 and reg < 0x14:
-        ch = 'dm'
-      elif reg == 0x15:
-        ch = 'ch'
-      elif reg == 0x17:
-        ch = 'fc'
-      else:
+      try:
+        ch, offset, decoded = register_decode_table[int(comm[1], 16)]
+      except KeyError:
         raise NotImplementedError('Unknown register {}'.format(comm[1]))
 
-      # Calculate offset for this channel
-      offset = reg - register_memory_offsets[ch]
-      assert offset >= 0
-
-      # Log write to this register
-      regtup = (ch, offset)
-      ch_regs = registers[ch]
-
       # Mask register change to functional changes
-      masks = register_function_bitmasks[ch][offset]
-      for func, mask in masks:
-        mask_bin = '{:08b}'.format(mask)
-        nbits = mask_bin.count('1')
-        shift = max(0, 7 - mask_bin.rfind('1')) % 8
-
-        func_val = (val & mask) >> shift
-
-        ndf.append(('apu', ch, func, func_val, natoms, offset))
+      for func, func_val in decoded[int(comm[2], 16)]:
+        yield ('apu', ch, func, func_val, natoms, offset)
 
-      # Write value to register
-      ch_regs[offset] = val
-      assert ch_regs[offset] < 256
       natoms += 1
     elif comm[0] == 'ram':
       continue
     else:
       raise NotImplementedError(comm[0])
 
-  # TODO: consider re-enabling compress
-  #return ndf_compress(ndf)
-  return ndf
-
 
 def ndf_compress(ndf):
   ndf_out = []
@@ -134,6 +100,9 @@ def ndf_compress(ndf):
 
 
 def ndf_to_ndr(ndf):
+  if isinstance(ndf, np.ndarray):
+    return _ndf_to_ndr_array(ndf)
+
   ndr = ndf[:1]
   ndf = ndf[1:]
 
@@ -168,20 +137,16 @@ def ndf_to_ndr(ndf):
 
       # Find offset/bitmask
       reg = registers[dest]
-      param_bitmask = func_to_bitmask(dest, param)
+      try:
+        _, param_bitmask, shift, nvals = func_table[(dest, param)]
+      except KeyError:
+        raise ValueError('Unknown function {}, {}'.format(dest, param))
 
       # Apply mask
-      mask_bin = '{:08b}'.format(param_bitmask)
-      nbits = mask_bin.count('1')
-      if val < 0 or val >= (2 ** nbits):
-        raise ValueError('{}, {} (0, {}]: invalid value specified {}'.format(comm[1], comm[2], (2 ** nbits), val))
-      assert val >= 0 and val < (2 ** nbits)
-      shift = max(0, 7 - mask_bin.rfind('1')) % 8
-      val_old = reg[param_offset]
+      if val < 0 or val >= nvals:
+        raise ValueError('{}, {} (0, {}]: invalid value specified {}'.format(comm[1], comm[2], nvals, val))
       reg[param_offset] &= (255 - param_bitmask)
       reg[param_offset] |= val << shift
-      assert reg[param_offset] < 256
-      val_new = reg[param_offset]
 
       arg1 = register_memory_offsets[dest] + param_offset
       arg2 = reg[param_offset]
@@ -197,3 +162,111 @@ def ndf_to_ndr(ndf):
     ndr.append(('apu', b2h(c2b(arg1)), b2h(c2b(arg2))))
 
   return ndr
+
+
+def _ndr_to_ndf_array(ndr):
+  clock = ndr[0]['val']
+  ndr = ndr[1:]
+
+  comm = ndr['comm']
+  apu = comm == ND_APU
+  ch = ndr['ch'].astype(np.int64)
+  offset = ndr['offset'].astype(np.int64)
+
+  bad = np.where(np.logical_and(apu, np.logical_or(ch < 0, ch >= len(ND_CHANNELS))))[0]
+  if bad.shape[0] > 0:
+    raise NotImplementedError('Unknown register {:02x}'.format(int(offset[bad[0]])))
+  ch = np.where(apu, ch, 0)
+  offset = np.where(apu, offset, 0)
+
+  # Atom index is the number of register writes since the last wait
+  napu = np.cumsum(apu)
+  wait_idx = ffill_idx(comm == ND_WAIT)
+  natoms = napu - 1 - np.where(wait_idx >= 0, napu[np.maximum(wait_idx, 0)], 0)
+
+  # Expand each register write into its functions
+  nout = np.where(apu, register_nfuncs_table[ch, offset], 1)
+  src = np.repeat(np.arange(ndr.shape[0]), nout)
+  k = np.arange(src.shape[0]) - np.repeat(np.cumsum(nout) - nout, nout)
+
+  out_apu = apu[src]
+  out_ch = ch[src]
+  out_offset = offset[src]
+  out_k = np.where(out_apu, k, 0)
+  out_fu = np.where(out_apu, register_funcs_table[out_ch, out_offset, out_k], -1)
+  val = ndr['val'][src]
+  out_val = np.where(
+      out_apu,
+      register_values_table[out_ch, out_offset, np.where(out_apu, val, 0), out_k],
+      val)
+
+  return nd_columns_to_array(
+      comm[src],
+      np.where(out_apu, out_ch, -1),
+      out_fu,
+      out_val,
+      np.where(out_apu, natoms[src], 0),
+      out_offset,
+      clock)
+
+
+def _ndf_to_ndr_array(ndf):
+  clock = ndf[0]['val']
+  ndf = ndf[1:]
+
+  comm = ndf['comm']
+  wait = comm == ND_WAIT
+  apu = np.where(comm == ND_APU)[0]
+
+  ch = ndf['ch'][apu].astype(np.int64)
+  fu = ndf['fu'][apu].astype(np.int64)
+  val = ndf['val'][apu].astype(np.int64)
+  natom = ndf['natom'][apu].astype(np.int64)
+  offset = func_offset_table[ch, fu].astype(np.int64)
+
+  # Validate values against function widths
+  nvals = func_nvals_table[ch, fu]
+  bad = np.where(val >= nvals)[0]
+  if bad.shape[0] > 0:
+    i = bad[0]
+    raise ValueError('{}, {} (0, {}]: invalid value specified {}'.format(
+      ND_CHANNELS[ch[i]], ND_FUNCTIONS[ch[i]][fu[i]], nvals[i], val[i]))
+  bits = func_encode_table[ch, fu, val].astype(np.int64)
+
+  # Register value after each write: OR of the latest value of each of the
+  # register's functions
+  reg = ch * 4 + offset
+  byte = np.zeros(apu.shape[0], dtype=np.int64)
+  order = np.argsort(reg, kind='mergesort')
+  reg_sorted = reg[order]
+  group_start = np.searchsorted(reg_sorted, reg_sorted, side='left')
+  for k in xrange(register_funcs_table.shape[2]):
+    fu_k = register_funcs_table[ch, offset, k].astype(np.int64)
+    written = (fu == fu_k)[order]
+    last = ffill_idx(written)
+    valid = last >= group_start
+    last_val = np.where(valid, bits[order][np.maximum(last, 0)], 0)
+    byte[order] |= last_val
+
+  # Writes to the same (register, atom) between waits collapse to one write
+  # (positioned at the first write, valued at the last)
+  seg = np.cumsum(wait)[apu]
+  key = (seg * (len(ND_CHANNELS) * 4) + reg) * 65536 + natom
+  _, first, inverse = np.unique(key, return_index=True, return_inverse=True)
+  last = np.zeros(first.shape[0], dtype=np.int64)
+  np.maximum.at(last, inverse, np.arange(key.shape[0]))
+
+  # Interleave collapsed writes with waits
+  waits = np.where(wait)[0]
+  nwrites = first.shape[0]
+  nwaits = waits.shape[0]
+  order = np.argsort(np.concatenate([apu[first], waits]), kind='mergesort')
+
+  return nd_columns_to_array(
+      np.concatenate([np.full(nwrites, ND_APU), np.full(nwaits, ND_WAIT)])[order],
+      np.concatenate([ch[last], np.full(nwaits, -1)])[order],
+      -1,
+      np.concatenate([byte[last], ndf['val'][waits]])[order],
+      0,
+      np.concatenate([offset[last], np.zeros(nwaits, dtype=np.int64)])[order],
+      clock)
@@ -0,0 +1,222 @@
+import numpy as np
+
+from nesmdb.apu import func_nvals_table, func_offset_table
+from nesmdb.corpus import write_corpus, Corpus
+from nesmdb.vgm.nd_array import ND_WAIT, ND_APU, ND_CHANNELS, ND_FUNCTIONS
+from nesmdb.vgm.nd_array import nd_columns_to_array, nlm_to_array, array_to_nlm
+from nesmdb.vgm.ndf_nlm import NLM_DELETE
+
+
+# NLM tokenization
+#
+# Token 0 is <sos>/<eos>, which surrounds every document. Two levels:
+#
+# - 'char': 38 function tokens, a wait token and the digits 0-9 (50 symbols);
+#   each command is its function (or wait) followed by the decimal digits of
+#   its value.
+# - 'func': one token per (function, value) pair plus one per wait length
+#   from 0 to wait_max. The wait_max token means "wait wait_max samples and
+#   continue with the next wait token", so a wait of n samples is
+#   n // wait_max of those followed by the remainder.
+#
+# The clock is not tokenized; it is passed back in when decoding.
+
+NLM_FUNCTIONS = [
+    '{}_{}'.format(ch, fu)
+    for ch, fus in zip(ND_CHANNELS, ND_FUNCTIONS) for fu in fus
+    if ch != 'dm' and '{}_{}'.format(ch, fu) not in NLM_DELETE]
+_SEP = 0
+
+# Function token -> (ch, fu) ids
+_TOK_CH = np.array([ND_CHANNELS.index(f.split('_')[0]) for f in NLM_FUNCTIONS], dtype=np.int64)
+_TOK_FU = np.array([ND_FUNCTIONS[c].index(f.split('_')[1]) for c, f in zip(_TOK_CH, NLM_FUNCTIONS)], dtype=np.int64)
+_TOK_NVAL = func_nvals_table[_TOK_CH, _TOK_FU]
+
+# ch * 16 + fu -> function token index (-1 if not tokenizable)
+_FUNC_TO_TOK = np.full(len(ND_CHANNELS) * 16, -1, dtype=np.int64)
+_FUNC_TO_TOK[_TOK_CH * 16 + _TOK_FU] = np.arange(len(NLM_FUNCTIONS))
+
+# Character level layout
+_CHAR_FUNC = 1
+_CHAR_WAIT = _CHAR_FUNC + len(NLM_FUNCTIONS)
+_CHAR_DIGIT = _CHAR_WAIT + 1
+_CHAR_VOCAB_SIZE = _CHAR_DIGIT + 10
+
+# Function level layout
+_FUNC_VAL = 1 + np.append(0, np.cumsum(_TOK_NVAL))[:-1]
+_FUNC_WAIT = 1 + int(np.sum(_TOK_NVAL))
+
+_POW10 = 10 ** np.arange(19, dtype=np.int64)
+
+
+def nlm_vocab(level='char', wait_max=1024):
+  """Returns the token names for a tokenization level."""
+  if level == 'char':
+    return ['<sos>'] + NLM_FUNCTIONS + ['w'] + [str(d) for d in xrange(10)]
+  elif level == 'func':
+    vocab = ['<sos>']
+    for func, nval in zip(NLM_FUNCTIONS, _TOK_NVAL):
+      vocab.extend(['{},{}'.format(func, v) for v in xrange(nval)])
+    vocab.extend(['w,{}'.format(w) for w in xrange(wait_max + 1)])
+    return vocab
+  else:
+    raise ValueError('Unknown tokenization level \'{}\''.format(level))
+
+
+def _nlm_columns(nlm):
+  if not isinstance(nlm, np.ndarray):
+    nlm = nlm_to_array(nlm)
+  nlm = nlm[1:]
+
+  wait = nlm['comm'] == ND_WAIT
+  func = np.where(wait, 0, nlm['ch'].astype(np.int64) * 16 + nlm['fu'])
+  tok = np.where(wait, -1, _FUNC_TO_TOK[func])
+  if np.any(~wait & (tok < 0)):
+    raise ValueError('NLM contains functions outside of the vocabulary')
+
+  return wait, tok, nlm['val'].astype(np.int64)
+
+
+def _columns_to_nlm(wait, tok, val, clock, as_array):
+  tok = np.where(wait, 0, tok)
+  ch = np.where(wait, -1, _TOK_CH[tok])
+  fu = np.where(wait, -1, _TOK_FU[tok])
+  offset = np.where(wait, 0, func_offset_table[np.maximum(ch, 0), np.maximum(fu, 0)])
+  nlm = nd_columns_to_array(
+      np.where(wait, ND_WAIT, ND_APU), ch, fu, val, 0, offset, clock)
+
+  return nlm if as_array else array_to_nlm(nlm)
+
+
+def nlm_to_tokens(nlm, level='char', wait_max=1024):
+  """Tokenizes NLM (list or array) to an int64 array surrounded by <sos>."""
+  wait, tok, val = _nlm_columns(nlm)
+
+  if level == 'char':
+    if np.any(val < 0):
+      raise ValueError('Negative values cannot be tokenized')
+    ndigits = np.searchsorted(_POW10[1:], val, side='right') + 1
+    starts = 1 + np.arange(val.shape[0]) + np.append(0, np.cumsum(ndigits))[:-1]
+
+    tokens = np.full(1 + val.shape[0] + np.sum(ndigits) + 1, _SEP, dtype=np.int64)
+    tokens[starts] = np.where(wait, _CHAR_WAIT, _CHAR_FUNC + tok)
+    for k in xrange(int(ndigits.max()) if ndigits.shape[0] > 0 else 0):
+      has = ndigits > k
+      digit = (val[has] // _POW10[ndigits[has] - 1 - k]) % 10
+      tokens[starts[has] + 1 + k] = _CHAR_DIGIT + digit
+  elif level == 'func':
+    if np.any(~wait & ((val < 0) | (val >= _TOK_NVAL[np.maximum(tok, 0)]))):
+      raise ValueError('NLM contains out-of-range function values')
+
+    # Split waits into continuation tokens and a remainder
+    nsplit = np.where(wait, val // wait_max + 1, 1)
+    idx = np.repeat(np.arange(val.shape[0]), nsplit)
+    last = np.cumsum(nsplit) - 1
+    split_val = np.where(wait[idx], wait_max, val[idx])
+    split_val[last] = np.where(wait, val % wait_max, val)
+
+    tokens = np.full(idx.shape[0] + 2, _SEP, dtype=np.int64)
+    tokens[1:-1] = np.where(
+        wait[idx],
+        _FUNC_WAIT + split_val,
+        _FUNC_VAL[np.maximum(tok[idx], 0)] + split_val)
+  else:
+    raise ValueError('Unknown tokenization level \'{}\''.format(level))
+
+  return tokens
+
+
+def tokens_to_nlm(tokens, level='char', wait_max=1024, clock=1789773, as_array=False):
+  """Inverse of nlm_to_tokens (<sos>/<eos> tokens are ignored)."""
+  tokens = np.asarray(tokens, dtype=np.int64)
+  tokens = tokens[tokens != _SEP]
+
+  if level == 'char':
+    if np.any((tokens < 0) | (tokens >= _CHAR_VOCAB_SIZE)):
+      raise ValueError('Invalid character-level token')
+    comm = tokens < _CHAR_DIGIT
+    if tokens.shape[0] > 0 and not comm[0]:
+      raise ValueError('Token sequence starts with a digit')
+    comm_idx = np.cumsum(comm) - 1
+    comm_pos = np.where(comm)[0]
+
+    # Digit place value counts back from the last digit of each command
+    ends = np.append(comm_pos[1:], tokens.shape[0]) - 1
+    digit = ~comm
+    place = ends[comm_idx[digit]] - np.where(digit)[0]
+    val = np.zeros(comm_pos.shape[0], dtype=np.int64)
+    np.add.at(val, comm_idx[digit], (tokens[digit] - _CHAR_DIGIT) * _POW10[place])
+
+    ctok = tokens[comm]
+    wait = ctok == _CHAR_WAIT
+    tok = ctok - _CHAR_FUNC
+  elif level == 'func':
+    if np.any((tokens < 0) | (tokens > _FUNC_WAIT + wait_max)):
+      raise ValueError('Invalid function-level token')
+    wait = tokens >= _FUNC_WAIT
+    tok = np.searchsorted(_FUNC_VAL, tokens, side='right') - 1
+    val = np.where(wait, tokens - _FUNC_WAIT, tokens - _FUNC_VAL[np.maximum(tok, 0)])
+
+    # Add continuation tokens to the wait that ends them
+    cont = wait & (val == wait_max)
+    if cont.shape[0] > 0 and cont[-1]:
+      raise ValueError('Token sequence ends with a wait continuation')
+    ncont = np.cumsum(cont)[~cont]
+    ncont[1:] -= ncont[:-1].copy()
+    wait = wait[~cont]
+    tok = tok[~cont]
+    val = val[~cont]
+    if np.any(~wait & (ncont > 0)):
+      raise ValueError('Wait continuation not followed by a wait')
+    val += ncont * wait_max
+  else:
+    raise ValueError('Unknown tokenization level \'{}\''.format(level))
+
+  return _columns_to_nlm(wait, tok, val, clock, as_array)
+
+
+# Packed token corpus
+#
+# Tokens of all documents are concatenated into a single flat uint16 shard
+# (tokens.bin) of a nesmdb.corpus corpus, whose metadata stores the
+# tokenization.
+
+_TOKENS_FN = 'tokens.bin'
+
+
+def write_nlm_corpus(corpus_dir, docs, level='char', wait_max=1024):
+  """Tokenizes (doc_id, nlm) pairs into a packed corpus in corpus_dir.
+
+  docs may be any iterable (e.g. a generator loading one file at a time).
+  """
+  vocab_size = len(nlm_vocab(level, wait_max))
+  if vocab_size > 65536:
+    raise ValueError('Vocabulary of size {} does not fit in uint16'.format(vocab_size))
+
+  items = ((doc_id, nlm_to_tokens(nlm, level=level, wait_max=wait_max)) for doc_id, nlm in docs)
+  write_corpus(
+      corpus_dir,
+      items,
+      np.uint16,
+      meta={'level': level, 'wait_max': wait_max, 'vocab_size': vocab_size},
+      shard_fn=_TOKENS_FN)
+
+
+class NLMCorpus(Corpus):
+  """Read-only view of a corpus written by write_nlm_corpus.
+
+  corpus.tokens is the memory-mapped uint16 token stream of all documents;
+  corpus[i] or corpus[doc_id] is the view of a single document.
+  """
+
+  def __init__(self, corpus_dir):
+    super(NLMCorpus, self).__init__(corpus_dir)
+    self.level = self.meta['level']
+    self.wait_max = self.meta['wait_max']
+    self.vocab_size = self.meta['vocab_size']
+    self.doc_ids = self.item_ids
+    self.offsets = np.array([item[2] for item in self._items], dtype=np.int64)
+    self.tokens = self._shard(0)
+
+  def to_nlm(self, key, clock=1789773):
+    return tokens_to_nlm(self[key], level=self.level, wait_max=self.wait_max, clock=clock)
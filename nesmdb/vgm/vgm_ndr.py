@@ -1,23 +1,40 @@
+import cStringIO
+import struct
+
+import numpy as np
+
 from nesmdb.apu import *
 from nesmdb.vgm.bintypes import *
+from nesmdb.vgm.nd_array import ND_WAIT, ND_APU, ND_RAM, ndr_arrays_to_array, array_to_ndr
 
 
-def vgm_to_ndr(vgm):
-  # Retrieve EOF offset
-  eof_offset = offset(b2p(vgm[0x04:0x08]), 0x04)
-  if b2bu(h2b(eof_offset)) != len(vgm):
-    raise Exception('EOF offset does not match file size')
+# VGM header fields up to the data offset (0x00-0x38)
+_VGM_HEADER = struct.Struct('<4sIIIIIIIIIHBBIII')
+_VGM_NES_CLOCK = struct.Struct('<I')
+_VGM_NES_CLOCK_OFFSET = 0x84
+
+# VGM command fields
+_VGM_U32 = struct.Struct('<I')
+_VGM_WAIT = struct.Struct('<BH')
+_VGM_APU = struct.Struct('<BBB')
+
+# In-memory VGM data (anything the struct parser reads directly)
+_VGM_BYTES_TYPES = (str, bytearray, buffer, memoryview)
+
+def _vgm_parse_header(vgm):
+  # Returns EOF offset, total samples, clock and start of data
+  (_, eof_offset, version, _, _,
+   gd3_offset, total_nsamps,
+   loop_offset, loop_nsamps, global_rate,
+   _, _, _, _, _, vgm_data_offset) = _VGM_HEADER.unpack_from(vgm, 0)
 
-  # Retrieve version
-  version = b2p(vgm[0x08:0x0c])[-3:]
+  # Check version
+  version = '{:03x}'.format(version & 0xfff)
   if version != '161':
     raise NotImplementedError('Invalid version {}'.format(version))
 
-  # Retrieve GD3 metadata
-  gd3_tag = read(vgm, offset(b2p(vgm[0x14:0x18]), 0x14))
-
   # Retrieve system clock
-  clock = b2lu(vgm[0x84:0x88])
+  clock = _VGM_NES_CLOCK.unpack_from(vgm, _VGM_NES_CLOCK_OFFSET)[0]
   use_fds = (clock & 0x80000000) != 0
   two_chips = (clock & 0x40000000) != 0
   if use_fds:
@@ -28,178 +45,447 @@ def vgm_to_ndr(vgm):
   if clock not in [1662607, 1789772, 1789773]:
     raise Exception('Invalid NES APU Clock rate {}'.format(clock))
 
-  # Find length
-  total_nsamps = b2lu(vgm[0x18:0x1c])
-
-  # Find loop offset
   # TODO: Put loop marker into output sequence
-  loop_offset = offset(b2p(vgm[0x1c:0x20]), 0x1c)
-
-  # Find loop samples
-  loop_nsamps = b2lu(vgm[0x20:0x24])
-
-  # Find rate
-  global_rate = b2lu(vgm[0x24:0x28])
   if global_rate != 0:
     raise NotImplementedError('Global rate is {} (nonzero)'.format(global_rate))
 
-  # Find data offset
-  vgm_data_offset = offset(b2p(vgm[0x34:0x38]), 0x34)
+  return eof_offset, total_nsamps, clock, vgm_data_offset + 0x34
 
-  # Find volume
-  volume = b2c(vgm[0x7c:0x7d])
 
-  # Find loop base
-  loop_base = b2c(vgm[0x7e:0x7f])
+# Decoded VGM command types
+_OP_APU = 0
+_OP_WAIT = 1
+_OP_RAM = 2
+_OP_HALT = 3
 
-  # Find loop modifier
-  loop_modifier = b2c(vgm[0x7f:0x80])
 
-  # Read VGM data
-  vgm_data = read(vgm, vgm_data_offset)
+def _vgm_decode(data, i):
+  # Decodes the command at data[i] (a bytearray) into (op, arg1, arg2, nbytes).
+  # APU writes carry register and value, waits their length and whether they
+  # are long (0x61) waits, RAM writes their data size (the data follows the
+  # nbytes of the command header).
+  byte = data[i]
 
-  # Parse VGM data
-  i = 0
-  ndr = [('clock', clock)]
-  while i < len(vgm_data):
-    byte = b2h(vgm_data[i])
-    i += 1
+  # NES APU write
+  if byte == 0xb4:
+    return _OP_APU, data[i + 1], data[i + 2], 3
 
-    # Wait (long)
-    if byte == '61':
-      arg1 = vgm_data[i]
-      i += 1
-      arg2 = vgm_data[i]
-      i += 1
+  # Wait (long)
+  elif byte == 0x61:
+    return _OP_WAIT, data[i + 1] | (data[i + 2] << 8), True, 3
 
-      wlen = b2lus(arg1 + arg2)
+  # Wait (short)
+  elif byte >= 0x70 and byte < 0x80:
+    return _OP_WAIT, (byte & 0x0f) + 1, False, 1
 
-      ndr.append(('wait', wlen))
+  # Wait (1/60th second for NTSC)
+  elif byte == 0x62:
+    return _OP_WAIT, 735, False, 1
 
-    # Wait (1/60th second for NTSC)
-    elif byte == '62':
-      ndr.append(('wait', 735))
+  # Wait (1/50th second for PAL)
+  elif byte == 0x63:
+    return _OP_WAIT, 882, False, 1
 
-    # Wait (1/50th second for PAL)
-    elif byte == '63':
-      ndr.append(('wait', 882))
+  # Halt
+  elif byte == 0x66:
+    return _OP_HALT, None, None, 1
 
-    # Halt
-    elif byte == '66':
+  # Data block
+  elif byte == 0x67:
+    assert data[i + 1] == 0x66
+
+    # NES APU RAM write
+    if data[i + 2] == 0xc2:
+      return _OP_RAM, _VGM_U32.unpack_from(data, i + 3)[0], None, 7
+    else:
+      raise NotImplementedError()
+
+  else:
+    raise NotImplementedError(i2h[byte])
+
+
+def _vgm_parse(vgm):
+  eof_offset, total_nsamps, clock, data_start = _vgm_parse_header(vgm)
+
+  # Check EOF offset
+  if eof_offset + 0x04 != len(vgm):
+    raise Exception('EOF offset does not match file size')
+
+  # Parse VGM data, merging adjacent waits as we go. Also records the byte
+  # offset of each command and which commands are not encoded exactly as
+  # ndr_to_vgm would write them.
+  data = bytearray(vgm)
+  i = data_start
+  ndata = len(data)
+
+  comms = []
+  args1 = []
+  args2 = []
+  rams = []
+  offsets = []
+  noncanonical = []
+  wait = None
+  wait_offset = None
+  wait_canonical = False
+  wlen = 0
+  nsamps = 0
+  while i < ndata:
+    op, arg1, arg2, nbytes = _vgm_decode(data, i)
+
+    if op == _OP_WAIT:
+      # Only runs of maximal long waits (ending in a long wait) are canonical
+      if wait is None:
+        wait_offset = i
+        wait_canonical = arg2
+      elif not arg2 or wlen != 65535:
+        wait_canonical = False
+      wlen = arg1
+      wait = wlen if wait is None else wait + wlen
+      nsamps += wlen
+      i += nbytes
+      continue
+    elif op == _OP_HALT:
       break
 
-    # Data block
-    elif byte == '67':
-      assert b2h(vgm_data[i]) == '66'
-      i += 1
-      data_type = b2h(vgm_data[i])
-      i += 1
+    if wait is not None:
+      comms.append(ND_WAIT)
+      args1.append(wait)
+      args2.append(0)
+      offsets.append(wait_offset)
+      if not (wait_canonical and (wlen > 0 or wait == 0)):
+        noncanonical.append(len(comms) - 1)
+      wait = None
+
+    if op == _OP_APU:
+      comms.append(ND_APU)
+      args1.append(arg1)
+      args2.append(arg2)
+      offsets.append(i)
+      i += nbytes
+    else:
+      comms.append(ND_RAM)
+      args1.append(len(rams))
+      args2.append(0)
+      offsets.append(i)
+      noncanonical.append(len(comms) - 1)
+      i += nbytes
+      rams.append(vgm[i:i+arg1])
+      i += arg1
 
-      # NES APU RAM write
-      if data_type == 'c2':
-        data_size = b2lu(vgm_data[i:i+4])
-        i += 4
-        ram_data = vgm_data[i:i+data_size]
-        i += data_size
+  if wait is not None:
+    comms.append(ND_WAIT)
+    args1.append(wait)
+    args2.append(0)
+    offsets.append(wait_offset)
+    if not (wait_canonical and (wlen > 0 or wait == 0)):
+      noncanonical.append(len(comms) - 1)
 
-        ndr.append(('ram', data_type, ram_data))
-      else:
-        raise NotImplementedError()
+  # End of command data
+  offsets.append(i)
 
-    # Wait (short)
-    elif byte[0] == '7':
-      ndr.append(('wait', b2c(h2b('0' + byte[1])) + 1))
+  assert nsamps == total_nsamps
+
+  return clock, comms, args1, args2, rams, offsets, noncanonical
 
-    # NES APU write
-    elif byte == 'b4':
-      reg = vgm_data[i]
-      i += 1
-      val = vgm_data[i]
-      i += 1
 
-      ndr.append(('apu', b2h(reg), b2h(val)))
+def vgm_to_ndr(vgm, as_array=False):
+  clock, comms, args1, args2, rams, _, _ = _vgm_parse(vgm)
 
+  if as_array:
+    comms = np.array(comms, dtype=np.uint8)
+    args1 = np.array(args1, dtype=np.int64)
+    args2 = np.array(args2, dtype=np.int64)
+
+    # RAM writes are dropped (downstream formats ignore them anyway)
+    keep = comms != ND_RAM
+    return ndr_arrays_to_array(comms[keep], args1[keep], args2[keep], clock)
+
+  ndr = [('clock', clock)]
+  for comm, arg1, arg2 in zip(comms, args1, args2):
+    if comm == ND_APU:
+      ndr.append(('apu', i2h[arg1], i2h[arg2]))
+    elif comm == ND_WAIT:
+      ndr.append(('wait', arg1))
     else:
-      raise NotImplementedError(byte)
+      ndr.append(('ram', 'c2', rams[arg1]))
+
+  return ndr
+
+
+def vgm_to_ndr_iter(vgm, block_size=65536):
+  """Yields the NDR commands of vgm, reading block_size bytes at a time.
+
+  vgm may be bytes-like (as for vgm_to_ndr) or a file-like object. Memory use is bounded by the
+  block size (and the largest RAM data block), so this also works for very
+  long VGM logs. Yields the same commands as vgm_to_ndr.
+  """
+  if isinstance(vgm, _VGM_BYTES_TYPES):
+    vgm = cStringIO.StringIO(vgm)
+
+  header = vgm.read(_VGM_NES_CLOCK_OFFSET + 0x04)
+  eof_offset, total_nsamps, clock, data_start = _vgm_parse_header(header)
+  yield ('clock', clock)
+
+  buf = bytearray(header + vgm.read(max(data_start - len(header), 0)))
+  nread = len(buf)
+  i = data_start
+  eof = False
+
+  wait = None
+  nsamps = 0
+  while True:
+    # Refill so that any fixed-size command is fully buffered
+    while len(buf) - i < 7 and not eof:
+      block = vgm.read(block_size)
+      nread += len(block)
+      eof = len(block) == 0
+      buf = buf[i:] + bytearray(block)
+      i = 0
+    if i >= len(buf):
+      break
 
-  nwaits_real = 0
-  for co in ndr:
-    if co[0] == 'wait':
-      nwaits_real += co[1]
-  assert nwaits_real == total_nsamps
+    op, arg1, arg2, nbytes = _vgm_decode(buf, i)
+    i += nbytes
 
-  ndr_collapsed = []
+    if op == _OP_WAIT:
+      wait = arg1 if wait is None else wait + arg1
+      nsamps += arg1
+      continue
+    elif op == _OP_HALT:
+      break
 
-  # Collapse adjacent waits
-  comm_i = 0
-  while comm_i < len(ndr):
-    comm = ndr[comm_i]
-    comm_i += 1
+    if wait is not None:
+      yield ('wait', wait)
+      wait = None
 
-    if comm[0] == 'wait':
-      wait_amt = comm[1]
-      while comm_i < len(ndr) and ndr[comm_i][0] == 'wait':
-        wait_amt += ndr[comm_i][1]
-        comm_i += 1
-      ndr_collapsed.append(('wait', wait_amt))
+    if op == _OP_APU:
+      yield ('apu', i2h[arg1], i2h[arg2])
     else:
-      ndr_collapsed.append(comm)
+      ram = str(buf[i:i + arg1])
+      if len(ram) < arg1:
+        extra = vgm.read(arg1 - len(ram))
+        nread += len(extra)
+        ram += extra
+      i += arg1
+      yield ('ram', 'c2', ram)
+
+  if wait is not None:
+    yield ('wait', wait)
+
+  assert nsamps == total_nsamps
+
+  # Check EOF offset against the rest of the stream
+  while not eof:
+    block = vgm.read(block_size)
+    nread += len(block)
+    eof = len(block) == 0
+  if eof_offset + 0x04 != nread:
+    raise Exception('EOF offset does not match file size')
 
-  return ndr_collapsed
 
+# VGM writer
+_VGM_HEADER_NBYTES = 0xc0
 
-def ndr_to_vgm(ndr):
-  assert ndr[0][0] == 'clock'
-  clock = ndr[0][1]
+# Hex string to byte lookup
+_HEX_TO_BYTE = {h:b for b, h in enumerate(i2h)}
 
-  ndr = ndr[1:]
 
-  EMPTYBYTE = i2lub(0)
-  flatten = lambda vgm: list(''.join(vgm))
-  vgm = flatten([EMPTYBYTE] * 48)
+def _hex_to_byte(h):
+  try:
+    return _HEX_TO_BYTE[h]
+  except KeyError:
+    return int(h, 16)
 
-  # VGM identifier
-  vgm[:0x04] = [c2b(c) for c in [0x56, 0x67, 0x6d, 0x20]]
-  # Version
-  vgm[0x08:0x0c] = i2lub(0x161)
-  # Clock rate
-  vgm[0x84:0x88] = i2lub(clock)
-  # Data offset
-  vgm[0x34:0x38] = i2lub(0xc0 - 0x34)
 
-  wait_sum = 0
-  for comm in ndr:
-    itype = comm[0]
-    if itype == 'wait':
-      amt = comm[1]
-      wait_sum += amt
+def _vgm_wait_nbytes(amt):
+  # Upper bound on bytes needed to encode a wait
+  return 3 * (amt // 65535 + 1)
 
-      while amt > 65535:
-        vgm.append(c2b(0x61))
-        vgm.append(i2lusb(65535))
-        amt -= 65535
 
-      vgm.append(c2b(0x61))
-      vgm.append(i2lusb(amt))
+def _vgm_pack_wait(buf, i, amt, compact_waits):
+  while amt > 65535:
+    _VGM_WAIT.pack_into(buf, i, 0x61, 65535)
+    i += 3
+    amt -= 65535
+
+  if compact_waits and amt == 735:
+    buf[i] = 0x62
+    i += 1
+  elif compact_waits and amt == 882:
+    buf[i] = 0x63
+    i += 1
+  elif compact_waits and amt > 0 and amt <= 32:
+    # One or two 0x7n waits (n + 1 samples each)
+    if amt > 16:
+      buf[i] = 0x7f
+      i += 1
+      amt -= 16
+    buf[i] = 0x70 + amt - 1
+    i += 1
+  else:
+    _VGM_WAIT.pack_into(buf, i, 0x61, amt)
+    i += 3
+
+  return i
+
+
+def _vgm_pack_comms(comms, compact_waits):
+  # Encode NDR commands into a VGM data block; returns (data, nsamps)
+  nbytes = 0
+  for comm in comms:
+    if comm[0] == 'wait':
+      nbytes += _vgm_wait_nbytes(comm[1])
+    else:
+      nbytes += 3
+  buf = bytearray(nbytes)
+
+  i = 0
+  nsamps = 0
+  for comm in comms:
+    itype = comm[0]
+    if itype == 'wait':
+      nsamps += comm[1]
+      i = _vgm_pack_wait(buf, i, comm[1], compact_waits)
     elif itype == 'apu':
-      arg1 = h2b(comm[1])
-      arg2 = h2b(comm[2])
-      vgm.append(c2b(0xb4))
-      vgm.append(arg1)
-      vgm.append(arg2)
+      _VGM_APU.pack_into(buf, i, 0xb4, _hex_to_byte(comm[1]), _hex_to_byte(comm[2]))
+      i += 3
     elif itype == 'ram':
       raise NotImplementedError()
     else:
       raise NotImplementedError()
 
-  # Halt
-  vgm.append(c2b(0x66))
-  vgm = flatten(vgm)
+  del buf[i:]
+  return buf, nsamps
 
-  # Total samples
-  vgm[0x18:0x1c] = i2lub(wait_sum)
+
+def _vgm_header(clock, nsamps, nbytes):
+  header = bytearray(_VGM_HEADER_NBYTES)
+
+  # VGM identifier
+  header[:0x04] = 'Vgm '
   # EoF offset
-  vgm[0x04:0x08] = i2lub(len(vgm) - 0x04)
+  _VGM_U32.pack_into(header, 0x04, nbytes - 0x04)
+  # Version
+  _VGM_U32.pack_into(header, 0x08, 0x161)
+  # Total samples
+  _VGM_U32.pack_into(header, 0x18, nsamps)
+  # Data offset
+  _VGM_U32.pack_into(header, 0x34, _VGM_HEADER_NBYTES - 0x34)
+  # Clock rate
+  _VGM_U32.pack_into(header, 0x84, clock)
+
+  return header
+
+
+def _ndr_comms(ndr):
+  if isinstance(ndr, np.ndarray):
+    ndr = array_to_ndr(ndr)
+  assert ndr[0][0] == 'clock'
+  return ndr[0][1], ndr[1:]
+
+
+def ndr_to_vgm(ndr, compact_waits=False):
+  clock, comms = _ndr_comms(ndr)
+
+  data, nsamps = _vgm_pack_comms(comms, compact_waits)
+
+  # Halt
+  data.append(0x66)
+
+  vgm = _vgm_header(clock, nsamps, _VGM_HEADER_NBYTES + len(data))
+  vgm += data
+
+  return str(vgm)
+
+
+def ndr_to_vgm_file(ndr, f, compact_waits=False, chunk_size=4096):
+  """Streams the VGM for ndr to seekable file-like f in chunks of commands.
+
+  The header is written last, once the sample count and size are known.
+  """
+  clock, comms = _ndr_comms(ndr)
+
+  start = f.tell()
+  f.write(bytearray(_VGM_HEADER_NBYTES))
+  nbytes = _VGM_HEADER_NBYTES
+  nsamps = 0
+  for i in xrange(0, len(comms), chunk_size):
+    data, chunk_nsamps = _vgm_pack_comms(comms[i:i + chunk_size], compact_waits)
+    f.write(data)
+    nbytes += len(data)
+    nsamps += chunk_nsamps
+
+  # Halt
+  f.write(bytearray([0x66]))
+  nbytes += 1
+
+  end = f.tell()
+  f.seek(start)
+  f.write(_vgm_header(clock, nsamps, nbytes))
+  f.seek(end)
+
+
+class VGMIndex(object):
+  """Byte offsets and start times of the NDR commands in a VGM.
+
+  Built once per VGM, after which clips by command range or time range cost
+  O(clip size). Clips are identical to ndr_to_vgm of the corresponding NDR
+  slice; commands already encoded the way ndr_to_vgm writes them are copied
+  directly from the source bytes.
+  """
+
+  def __init__(self, vgm):
+    clock, comms, args1, args2, _, offsets, noncanonical = _vgm_parse(vgm)
+
+    self.vgm = vgm
+    self.clock = clock
+    self.comms = np.array(comms, dtype=np.uint8)
+    self.args1 = np.array(args1, dtype=np.int64)
+    self.args2 = np.array(args2, dtype=np.int64)
+    self.offsets = np.array(offsets, dtype=np.int64)
+
+    # Sample at which each command starts (and total at the end)
+    waits = np.where(self.comms == ND_WAIT, self.args1, 0)
+    self.samps = np.zeros(len(comms) + 1, dtype=np.int64)
+    self.samps[1:] = np.cumsum(waits)
+
+    # Number of non-canonical commands before each command
+    self._noncanonical = np.zeros(len(comms) + 1, dtype=np.int64)
+    self._noncanonical[np.array(noncanonical, dtype=np.int64) + 1] = 1
+    self._noncanonical = np.cumsum(self._noncanonical)
+
+  def __len__(self):
+    return self.comms.shape[0]
+
+  def slice(self, start, stop):
+    """VGM of NDR commands [start:stop] (Python slice semantics)."""
+    start, stop, _ = slice(start, stop).indices(len(self))
+    stop = max(start, stop)
+
+    if self._noncanonical[stop] == self._noncanonical[start]:
+      data = bytearray(self.vgm[self.offsets[start]:self.offsets[stop]])
+    else:
+      comms = []
+      for comm, arg1, arg2 in zip(self.comms[start:stop], self.args1[start:stop], self.args2[start:stop]):
+        if comm == ND_WAIT:
+          comms.append(('wait', int(arg1)))
+        elif comm == ND_APU:
+          comms.append(('apu', i2h[arg1], i2h[arg2]))
+        else:
+          comms.append(('ram',))
+      data, _ = _vgm_pack_comms(comms, False)
+
+    # Halt
+    data.append(0x66)
+
+    nsamps = int(self.samps[stop] - self.samps[start])
+    vgm = _vgm_header(self.clock, nsamps, _VGM_HEADER_NBYTES + len(data))
+    vgm += data
+
+    return str(vgm)
 
-  vgm = ''.join(vgm)
-  return vgm
+  def slice_time(self, start_samp, stop_samp):
+    """VGM of the commands starting in samples [start_samp, stop_samp)."""
+    start = np.searchsorted(self.samps[:-1], start_samp, side='left')
+    stop = np.searchsorted(self.samps[:-1], stop_samp, side='left')
+    return self.slice(int(start), int(stop))
@@ -1,94 +1,125 @@
 from nesmdb.vgm.bintypes import *
-from nesmdb.vgm import vgm_to_ndr, ndr_to_vgm
+from nesmdb.vgm.vgm_ndr import VGMIndex
 
 
-def vgm_simplify(vgm, nop1=False, nop2=False, notr=False, nono=False, nodm=True):
-  # Clear loop
-  vgm = list(vgm)
-  vgm[0x1c:0x20] = i2lub(0)
-  vgm[0x20:0x24] = i2lub(0)
-  vgm[0x24:0x28] = i2lub(0)
+# APU register to channel name (for deletion stats)
+_REG_TO_CHANNEL = {reg:['p1', 'p2', 'tr', 'no', 'dm'][reg // 4] for reg in xrange(0x14)}
 
-  # Simplify rate
-  clock = b2lu(''.join(vgm[0x84:0x88])) & 0x3fffffff
-  vgm[0x84:0x88] = i2lub(clock)
 
-  # Clear volume
-  vgm[0x7c:0x80] = i2lub(0)
+def vgm_simplify(vgm, nop1=False, nop2=False, notr=False, nono=False, nodm=True, return_stats=False):
+  """Removes loop, volume and clock flags and writes to unwanted channels.
 
+  Returns (vgm, delcmds), or (vgm, delcmds, stats) if return_stats is set,
+  where stats counts deleted commands by opcode (hex) and APU writes by
+  channel. delcmds only counts data blocks (67) and APU writes (b4); the
+  opcode stats also include deleted expansion chip writes (54 and a0).
+  """
   # Filter out some channels
-  valid_registers = ['15', '17']
+  valid_registers = [0x15, 0x17]
   if not nop1:
-    valid_registers.extend(['00', '01', '02', '03'])
+    valid_registers.extend([0x00, 0x01, 0x02, 0x03])
   if not nop2:
-    valid_registers.extend(['04', '05', '06', '07'])
+    valid_registers.extend([0x04, 0x05, 0x06, 0x07])
   if not notr:
-    valid_registers.extend(['08', '09', '0a', '0b'])
+    valid_registers.extend([0x08, 0x09, 0x0a, 0x0b])
   if not nono:
-    valid_registers.extend(['0c', '0d', '0e', '0f'])
+    valid_registers.extend([0x0c, 0x0d, 0x0e, 0x0f])
   if not nodm:
-    valid_registers.extend(['10', '11', '12', '13'])
+    valid_registers.extend([0x10, 0x11, 0x12, 0x13])
   valid_registers = set(valid_registers)
 
-  # Gather writes to DMC and expansion chips
+  # Copy header
+  out = bytearray(vgm[:0xc0])
+
+  # Clear loop
+  out[0x1c:0x20] = i2lub(0)
+  out[0x20:0x24] = i2lub(0)
+  out[0x24:0x28] = i2lub(0)
+
+  # Simplify rate
+  clock = b2lu(vgm[0x84:0x88]) & 0x3fffffff
+  out[0x84:0x88] = i2lub(clock)
+
+  # Clear volume
+  out[0x7c:0x80] = i2lub(0)
+
+  # Copy commands, skipping writes to DMC and expansion chips
+  data = bytearray(vgm)
   i = 0xc0
-  delidxs = []
+  keep_start = i
+  delbytes = 0
   delcmds = 0
+  opcode_stats = {}
+  channel_stats = {}
   while True:
-    b = vgm[i]
-    bhex = b2h(b)
-    if bhex == '54':
-      delidxs.extend(range(i, i + 3))
-      i += 3
-    elif bhex == '61':
+    b = data[i]
+    dellen = 0
+    if b == 0x54:
+      dellen = 3
+    elif b == 0x61:
       i += 3
-    elif bhex == '62' or bhex == '63':
+    elif b == 0x62 or b == 0x63:
       i += 1
-    elif bhex == '66':
+    elif b == 0x66:
       break
-    elif bhex == '67':
-      data_size = b2lu(''.join(vgm[i+3:i+7]))
-      delidxs.extend(range(i, i + 3 + 4 + data_size))
+    elif b == 0x67:
+      data_size = b2lu(vgm[i+3:i+7])
+      dellen = 3 + 4 + data_size
       delcmds += 1
-      i += 3 + 4 + data_size
-    elif bhex[0] == '7':
+    elif (b >> 4) == 0x7:
       i += 1
-    elif bhex == 'a0':
-      delidxs.extend(range(i, i + 3))
-      i += 3
-    elif bhex == 'b4':
-      arg1 = vgm[i+1]
-      arg1hex = b2h(arg1)
-      if arg1hex not in valid_registers:
-        delidxs.extend(range(i, i + 3))
+    elif b == 0xa0:
+      dellen = 3
+    elif b == 0xb4:
+      reg = data[i+1]
+      if reg not in valid_registers:
+        dellen = 3
         delcmds += 1
-      i += 3
+        ch = _REG_TO_CHANNEL.get(reg, 'other')
+        channel_stats[ch] = channel_stats.get(ch, 0) + 1
+      else:
+        i += 3
     else:
-      context = b2h(''.join(vgm[i - 8:i+8]))
-      raise NotImplementedError('Unknown VGM command {}, context {}'.format(bhex, context))
+      context = b2h(vgm[i - 8:i+8])
+      raise NotImplementedError('Unknown VGM command {}, context {}'.format(i2h[b], context))
+
+    if dellen > 0:
+      opcode = i2h[b]
+      opcode_stats[opcode] = opcode_stats.get(opcode, 0) + 1
+      out += data[keep_start:i]
+      i += dellen
+      keep_start = i
+      delbytes += dellen
 
-  # Delete these extracurricular writes
-  for i in sorted(delidxs, reverse=True):
-    del vgm[i]
-  eof_offset = b2lu(''.join(vgm[0x04:0x08]))
-  eof_offset -= len(delidxs)
-  vgm[0x04:0x08] = i2lub(eof_offset)
+  out += data[keep_start:]
 
-  vgm = ''.join(vgm)
+  # Patch EOF offset
+  eof_offset = b2lu(vgm[0x04:0x08])
+  eof_offset -= delbytes
+  out[0x04:0x08] = i2lub(eof_offset)
 
-  return vgm, delcmds
+  vgm = str(out)
 
+  if return_stats:
+    stats = {
+        'opcode': opcode_stats,
+        'channel': channel_stats,
+    }
+    return vgm, delcmds, stats
+  else:
+    return vgm, delcmds
 
-def vgm_shorten(vgm, nmax, start=None):
-  ndr = vgm_to_ndr(vgm)
 
-  meta = ndr[:1]
-  ndr = ndr[1:]
+def vgm_shorten(vgm, nmax, start=None, index=None):
+  """Keeps NDR commands [start:start+nmax] of vgm.
 
-  if start is not None:
-    ndr = ndr[start:]
-  ndr = ndr[:nmax]
+  Pass a VGMIndex of vgm as index to take many clips from the same song.
+  """
+  if index is None:
+    index = VGMIndex(vgm)
 
-  vgm = ndr_to_vgm(meta + ndr)
+  # Same semantics as ndr[start:][:nmax]
+  start = slice(start, None).indices(len(index))[0]
+  stop = start + slice(None, nmax).indices(len(index) - start)[1]
 
-  return vgm
+  return index.slice(start, stop)
@@ -1,12 +1,15 @@
 import distutils.spawn
+import io
+import multiprocessing
 import os
 import subprocess
-import pkg_resources
 import tempfile
 
 import numpy as np
 from scipy.io.wavfile import read as wavread, write as wavwrite
 
+from nesmdb.vgm.vgm_ndr import vgm_to_ndr
+
 
 def load_vgmwav(wav_fp):
   fs, wav = wavread(wav_fp)
@@ -25,29 +28,26 @@ def save_vgmwav(wav_fp, wav):
   wavwrite(wav_fp, 44100, wav)
 
 
-def vgm_to_wav(vgm):
-  # Try to get binary fp from build dir
-  bin_fp = None
-  try:
-    import nesmdb
-    import inspect
-    bin_dir = os.path.dirname(inspect.getfile(nesmdb))
-    bin_fp = os.path.join(bin_dir, 'vgm2wav')
-  except:
-    pass
+# Scratch files for vgm2wav live in shared memory when available
+_SCRATCH_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
 
+def _find_vgm2wav():
   # Try to get binary fp at ${VGMTOWAV}
-  try:
-    env_var = os.environ['VGMTOWAV']
-    bin_fp = env_var
-  except:
-    pass
+  bin_fp = os.environ.get('VGMTOWAV')
 
   # Make sure it is accessible
   if bin_fp is not None:
     if not (os.path.isfile(bin_fp) and os.access(bin_fp, os.X_OK)):
       raise Exception('vgm2wav should be at \'{}\' but it does not exist or is not executable'.format(bin_fp))
 
+  # Try to get binary fp from package dir
+  if bin_fp is None:
+    bin_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    bin_fp = os.path.join(bin_dir, 'vgm2wav')
+    if not (os.path.isfile(bin_fp) and os.access(bin_fp, os.X_OK)):
+      bin_fp = None
+
   # Try finding it on global path otherwise
   if bin_fp is None:
     bin_fp = distutils.spawn.find_executable('vgm2wav')
@@ -56,23 +56,90 @@ def vgm_to_wav(vgm):
   if bin_fp is None:
     raise Exception('Could not find vgm2wav executable. Please set $VGMTOWAV environment variable')
 
-  vf = tempfile.NamedTemporaryFile('wb')
-  wf = tempfile.NamedTemporaryFile('rb')
+  return bin_fp
+
+
+def _vgm2wav(vgm, bin_fp=None):
+  if bin_fp is None:
+    bin_fp = _find_vgm2wav()
+
+  vf = tempfile.NamedTemporaryFile('wb', suffix='.vgm', dir=_SCRATCH_DIR)
+  wf = tempfile.NamedTemporaryFile('rb', suffix='.wav', dir=_SCRATCH_DIR)
+
+  try:
+    vf.write(vgm)
+    vf.flush()
 
-  vf.write(vgm)
-  vf.seek(0)
+    res = subprocess.call([bin_fp, '--loop-count', '1', vf.name, wf.name])
+    if res > 0:
+      raise Exception('Invalid return code {} from vgm2wav'.format(res))
 
-  res = subprocess.call('{} --loop-count 1 {} {}'.format(bin_fp, vf.name, wf.name).split())
-  if res > 0:
+    # Parse from memory rather than reopening the file
+    wav = load_vgmwav(io.BytesIO(wf.read()))
+  finally:
     vf.close()
     wf.close()
-    raise Exception('Invalid return code {} from vgm2wav'.format(res))
 
-  vf.close()
+  return wav
 
-  wf.seek(0)
-  wav = load_vgmwav(wf.name)
 
-  wf.close()
+def vgm_to_wav(vgm, renderer='vgm2wav'):
+  if renderer == 'native':
+    # Imported here as nesmdb.synth depends on nesmdb.vgm
+    from nesmdb.synth import ndr_to_wav
+    return ndr_to_wav(vgm_to_ndr(vgm))
+  elif renderer == 'vgm2wav':
+    return _vgm2wav(vgm)
+  else:
+    raise ValueError('Unknown renderer \'{}\''.format(renderer))
 
-  return wav
+
+def _vgm_to_wav_worker(args):
+  vgm, renderer, bin_fp = args
+  if renderer == 'vgm2wav':
+    return _vgm2wav(vgm, bin_fp)
+  return vgm_to_wav(vgm, renderer=renderer)
+
+
+class VGMRenderPool(object):
+  """Persistent worker processes for rendering many VGMs concurrently.
+
+  Workers are started once and reused across calls, so batches avoid paying
+  process startup per file. Use as a context manager or call close().
+  """
+
+  def __init__(self, nworkers=None, renderer='vgm2wav', chunksize=1):
+    if renderer not in ['native', 'vgm2wav']:
+      raise ValueError('Unknown renderer \'{}\''.format(renderer))
+    # Resolved once per pool so workers agree on the binary
+    self.bin_fp = _find_vgm2wav() if renderer == 'vgm2wav' else None
+    self.renderer = renderer
+    self.chunksize = chunksize
+    self._pool = multiprocessing.Pool(nworkers)
+
+  def render(self, vgms):
+    args = [(vgm, self.renderer, self.bin_fp) for vgm in vgms]
+    return self._pool.map(_vgm_to_wav_worker, args, chunksize=self.chunksize)
+
+  def imap(self, vgms):
+    args = ((vgm, self.renderer, self.bin_fp) for vgm in vgms)
+    return self._pool.imap(_vgm_to_wav_worker, args, chunksize=self.chunksize)
+
+  def close(self):
+    self._pool.close()
+    self._pool.join()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, tb):
+    if exc_type is None:
+      self.close()
+    else:
+      self._pool.terminate()
+      self._pool.join()
+
+
+def vgms_to_wavs(vgms, nworkers=None, renderer='vgm2wav'):
+  with VGMRenderPool(nworkers, renderer) as pool:
+    return pool.render(vgms)
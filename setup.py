@@ -3,6 +3,7 @@ from setuptools.command.install import install
 from setuptools.command.develop import develop
 
 import os
+import re
 import shutil
 import subprocess
 import tarfile
@@ -74,9 +75,14 @@ class VGMPlayInstall(install):
     _build_vgm_play('/tmp/build_vgmplay', install_dir)
 
 
+# Version is defined once in nesmdb/__init__.py
+with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'nesmdb', '__init__.py'), 'r') as f:
+  _VERSION = re.search(r"^__version__ = '([^']+)'", f.read(), re.M).group(1)
+
+
 setup(
     name='nesmdb',
-    version='0.1.8',
+    version=_VERSION,
     description='The NES Music Database (NES-MDB). Use machine learning to compose music for the Nintendo Entertainment System!',
     author='Chris Donahue',
     author_email='cdonahue@ucsd.edu',